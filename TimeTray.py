@@ -2,6 +2,57 @@
 # -*- coding: utf-8 -*-
 import os
 import sys
+
+INSTANCE_COMMANDS = ( "show", "start", "pause", "reset", "quit" )
+
+
+def instanceAddress():
+    """ Where the running instance listens for the commands, see SingleInstanceServer. """
+    if os.environ.get( "TIMETRAY_INSTANCE_ADDRESS" ):
+        return os.environ["TIMETRAY_INSTANCE_ADDRESS"]
+
+    user = os.environ.get( "USERNAME" ) or os.environ.get( "USER" ) or "user"
+    if sys.platform == "win32":
+        return f"\\\\.\\pipe\\TimeTray-{user}"
+    return os.path.join( os.environ.get( "TMPDIR" ) or "/tmp", f"TimeTray-{user}.socket" )
+
+
+def sendInstanceCommand(command, address=None, timeout=1.0):
+    """ Sends `command` to the running instance, returning False when there is none. It only uses
+    the standard library, so a second launch can hand off its command before loading Qt. """
+    address = address or instanceAddress()
+    try:
+        if sys.platform == "win32":
+            with open( address, "r+b", buffering=0 ) as pipe:
+                pipe.write( f"{command}\n".encode( "UTF-8" ) )
+        else:
+            import socket
+            with socket.socket( socket.AF_UNIX, socket.SOCK_STREAM ) as client:
+                client.settimeout( timeout )
+                client.connect( address )
+                client.sendall( f"{command}\n".encode( "UTF-8" ) )
+        return True
+    except OSError:
+        return False
+
+
+g_handOff = [None]
+
+
+def handOffCommand(command):
+    """ Sends the launch `command` to the running instance, only trying once per launch, whether it
+    was from the fast path below, or from main() for the launches with other options. """
+    if g_handOff[0] is None:
+        g_handOff[0] = sendInstanceCommand( command )
+    return g_handOff[0]
+
+
+# A second launch, i.e., `TimeTray.py` or `TimeTray.py pause`, only forwards its command, so this
+# comes before the other imports
+if __name__ == "__main__" and len( sys.argv ) <= 2 and set( sys.argv[1:] ) <= set( INSTANCE_COMMANDS ):
+    if handOffCommand( sys.argv[1] if len( sys.argv ) == 2 else "show" ):
+        sys.exit( 0 )
+
 import time
 import tempfile
 import math
@@ -12,10 +63,21 @@ import pathlib
 import subprocess
 import datetime
 import threading
-
-import pytest
-import inspect
-from pytest import approx
+import heapq
+import itertools
+import functools
+import hashlib
+import wave
+import collections
+import json
+import atexit
+import contextlib
+import bisect
+import queue
+
+# The audio backends only use the standard library, so the AudioWorker child process imports them alone
+import TimeTrayAudio
+from TimeTrayAudio import AudioBackend, FakeAudioBackend, PycawAudioBackend
 
 # Python 3.8.1
 # PyQt5
@@ -24,9 +86,6 @@ from pytest import approx
 os.environ["PATH"] = f'F:\\Python\\Library\\bin;{os.environ["PATH"]}'
 
 from numbers import Number
-from ctypes import cast, POINTER
-from comtypes import CLSCTX_ALL
-from pycaw.pycaw import AudioUtilities, IAudioEndpointVolume
 
 # https://python-catalin.blogspot.com/2018/11/python-qt5-tray-icon-example.html
 # https://stackoverflow.com/questions/6389580/quick-and-easy-trayicon-with-python
@@ -42,12 +101,188 @@ from PyQt5.QtGui import QPixmap, QPainter, QFont, QIcon
 from PyQt5.QtCore import Qt, QPoint, pyqtSignal, QFile, QTimer
 from PyQt5.QtWidgets import QApplication, QSystemTrayIcon, QMenu, QAction
 
-from PyQt5 import QtGui, QtCore, QtWidgets, QtMultimedia
+from PyQt5 import QtGui, QtCore, QtWidgets
 from PyQt5.QtCore import QSize, QSettings
 from PyQt5.QtWidgets import QMessageBox, QPushButton, QMainWindow, QLabel, QGridLayout, QWidget
 
-from debug_tools import getLogger
-log = getLogger( 127, __name__, file=str(pathlib.Path(__file__).resolve().parent / 'TimeTray.log') )
+def createDroppingQueueHandler(records):
+    """ A QueueHandler which never blocks the thread logging, when the `records` queue is full, the
+    record is counted and dropped. The logging import is only done by the first record. """
+    import logging.handlers
+
+    class DroppingQueueHandler(logging.handlers.QueueHandler):
+        dropped = 0
+
+        def enqueue(self, record):
+            try:
+                self.queue.put_nowait( record )
+            except queue.Full:
+                self.dropped += 1
+
+    return DroppingQueueHandler( records )
+
+
+class LogWriter(object):
+    """ Writes the records queued by its `handler` to `filename` on a single thread.
+
+    Records arriving together are written together, and the file is only flushed after being idle
+    for `flushInterval` seconds. When the file grows bigger than `maxBytes`, or a record arrives on
+    a new day, the file is rotated to `filename.1.gz`, keeping up to `backupCount` old files.
+    """
+    stop = object()
+
+    def __init__(self, filename, maxBytes=2**20, backupCount=5, flushInterval=1.0, maxQueued=10_000, clock=time.time):
+        self.filename = pathlib.Path( filename )
+        self.maxBytes = maxBytes
+        self.backupCount = backupCount
+        self.flushInterval = flushInterval
+        self.clock = clock
+        self.queue = queue.Queue( maxQueued )
+        self.queueHandler = None
+        self.thread = None
+        self.file = None
+        self.day = None
+
+    @property
+    def handler(self):
+        if self.queueHandler is None:
+            self.queueHandler = createDroppingQueueHandler( self.queue )
+        return self.queueHandler
+
+    def start(self):
+        self.thread = startThread( "logWriter", self.run )
+        atexit.register( self.close )
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put( self.stop )
+            self.thread.join( 5 )
+            self.thread = None
+
+    def open(self):
+        self.file = open( self.filename, "a", encoding="UTF-8" )
+        modified = self.filename.stat().st_mtime if self.file.tell() else self.clock()
+        self.day = datetime.date.fromtimestamp( modified )
+
+    def rotate(self):
+        import gzip
+        import shutil
+        self.file.close()
+        for index in range( self.backupCount - 1, 0, -1 ):
+            older = self.filename.with_name( f"{self.filename.name}.{index}.gz" )
+            if older.exists():
+                os.replace( older, self.filename.with_name( f"{self.filename.name}.{index + 1}.gz" ) )
+
+        with open( self.filename, "rb" ) as input, gzip.open( self.filename.with_name( f"{self.filename.name}.1.gz" ), "wb" ) as output:
+            shutil.copyfileobj( input, output )
+        os.remove( self.filename )
+        self.open()
+
+    def write(self, record):
+        if datetime.date.fromtimestamp( record.created ) != self.day or self.file.tell() > self.maxBytes:
+            self.rotate()
+        self.file.write( f"{record.getMessage()}\n" )
+
+    def run(self):
+        self.open()
+        flushDeadline = None
+        while True:
+            try:
+                timeout = None if flushDeadline is None else max( flushDeadline - self.clock(), 0 )
+                record = self.queue.get( timeout=timeout )
+            except queue.Empty:
+                record = None
+
+            if record is self.stop:
+                break
+
+            with instrumentWakeup( "logWriter" ):
+                if record is not None:
+                    try:
+                        self.write( record )
+                    except Exception as error:
+                        sys.stderr and sys.stderr.write( f"Could not write the log record {record}: {error}\n" )
+                    if flushDeadline is None:
+                        flushDeadline = self.clock() + self.flushInterval
+                    if self.queue.empty():
+                        self.writeDropped()
+
+                if flushDeadline is not None and ( record is None or self.clock() >= flushDeadline ):
+                    self.file.flush()
+                    flushDeadline = None
+
+        self.writeDropped()
+        self.file.close()
+
+    def writeDropped(self):
+        """ Once the writer caught up with the queue, tell how many records were lost. """
+        if self.handler.dropped:
+            dropped, self.handler.dropped = self.handler.dropped, 0
+            self.file.write( f"{dropped} log records were dropped because the writer was behind\n" )
+
+
+# Where the log records are written, which is changed by `--log-file`, or the tests, before the first record
+g_logFile = [pathlib.Path( __file__ ).resolve().parent / 'TimeTray.log']
+g_logWriter = [None]
+
+
+def getLogWriter():
+    """ Creates the `g_logFile` writer on its first use, so nothing opens the file on import. """
+    if g_logWriter[0] is None:
+        g_logWriter[0] = LogWriter( g_logFile[0] )
+    return g_logWriter[0]
+
+
+class LazyLogger(object):
+    """ Creates the debug_tools logger on its first use, keeping its import out of the startup, and
+    then replaces itself on the module globals by the real logger. Its records go through the
+    `getLogWriter()` queue, so logging never waits for the disk. """
+
+    lock = threading.Lock()
+
+    def create(self):
+        # Another thread, or a copy of this object from `from TimeTray import *`, created it already
+        with self.lock:
+            if not isinstance( globals()['log'], LazyLogger ):
+                return globals()['log']
+
+            from debug_tools import getLogger
+            logger = getLogger( 127, __name__ )
+
+            for handler in list( logger.handlers ):
+                logger.removeHandler( handler )
+
+            writer = getLogWriter()
+            writer.handler.setFormatter( logger.full_formatter )
+            logger.addHandler( writer.handler )
+            logger.setLevel( g_logLevel[0] )
+            writer.start()
+
+            globals()['log'] = logger
+            return logger
+
+    def __call__(self, *args, **kwargs):
+        return self.create()( *args, **kwargs )
+
+    def __getattr__(self, name):
+        # Introspection, like the pytest collection of `from TimeTray import *`, does not create it
+        if name.startswith( "__" ):
+            raise AttributeError( name )
+        return getattr( self.create(), name )
+
+log = LazyLogger()
+TimeTrayAudio.g_log[0] = lambda message: log( message )
+# The logging module levels, which is only imported by the first record
+g_logLevels = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+g_logLevel = [g_logLevels["debug"]]
+
+
+def setLogLevel(level):
+    """ Changes which records are logged while running, `log()` calls are on the debug level. """
+    g_logLevel[0] = g_logLevels.get( level, level )
+    if not isinstance( log, LazyLogger ):
+        log.setLevel( g_logLevel[0] )
+
 
 g_run_tests = [False]
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -58,47 +293,143 @@ SHOW_WINDOW_INTERVAL = 1800 - 60
 # ALARM_TIMEOUT = 2
 # SHOW_WINDOW_INTERVAL = 2
 
-g_setVolumeBase = """
-import sys
-import time
-
-from ctypes import cast, POINTER
-from comtypes import CLSCTX_ALL
-from pycaw.pycaw import AudioUtilities, IAudioEndpointVolume
+if hasattr( time, "CLOCK_BOOTTIME" ):
+    def monotonicClock():
+        """ Seconds from a clock which is not changed by the wall clock adjustments. On Linux, it uses
+        the boot time clock, which also counts the time the system was suspended, like Windows does. """
+        return time.clock_gettime( time.CLOCK_BOOTTIME )
+else:
+    monotonicClock = time.monotonic
 
-devices = AudioUtilities.GetSpeakers()
-interface = devices.Activate(
-    IAudioEndpointVolume._iid_, CLSCTX_ALL, None
-)"""
 
 def main():
     argumentsNamespace = g_argumentParser.parse_args()
     run_tests = argumentsNamespace.run_tests
+    if argumentsNamespace.log_file:
+        g_logFile[0] = pathlib.Path( argumentsNamespace.log_file ).resolve()
+    setLogLevel( argumentsNamespace.log_level )
+    g_configuration[0] = loadConfiguration( argumentsNamespace.config )
+
+    if isinstance(argumentsNamespace.benchmark, list):
+        from test_TimeTray import runBenchmarks
+        regressions = runBenchmarks(argumentsNamespace.benchmark, argumentsNamespace.benchmark_output,
+                argumentsNamespace.benchmark_baseline, argumentsNamespace.benchmark_save_baseline)
+        sys.exit(1 if regressions else 0)
 
     if isinstance(run_tests, list):
-        args = [sys.argv[0], '-vvv', '-rP', '--capture=no']
+        import pytest
+        args = [os.path.join(CURRENT_DIR, 'test_TimeTray.py'), '-vvv', '-rP', '--capture=no']
         if run_tests:
             args.append(f"-k {' '.join(run_tests)}")
         print(f'Running tests {args}')
         pytest.main(args)
         return
 
-    app = QApplication( [] )
+    if argumentsNamespace.simulate:
+        responseDelay = None if argumentsNamespace.simulate_response < 0 else argumentsNamespace.simulate_response
+        for seconds, event in simulateEyeRest( argumentsNamespace.simulate * 3600, responseDelay ):
+            print( f"{datetime.timedelta( seconds=round( seconds ) )} {event}" )
+        return
+
+    if argumentsNamespace.soak:
+        os.environ.setdefault( "QT_QPA_PLATFORM", "offscreen" )
+        app = QApplication( [] )
+        soak = SoakTest()
+        soak.run( argumentsNamespace.soak )
+        for sample in soak.samples[::24]:
+            print( soak.formatSample( sample ) )
+
+        leaks = soak.leaks()
+        for name, ( before, after ) in leaks.items():
+            print( f"{name} grew from {before} to {after}" )
+        print( f"{len( leaks )} resources growing after {argumentsNamespace.soak} days" )
+        sys.exit( 1 if leaks else 0 )
+
+    if argumentsNamespace.history is not None:
+        history = getHistory()
+        days = history.lastDays( argumentsNamespace.history )
+        if not days:
+            print( f"No eye rest was recorded on the last {argumentsNamespace.history} days" )
+            return
+        print( f"Days\n{formatHistory( days )}\n\nWeeks\n{formatHistory( history.weekly() )}" )
+        return
+
+    if argumentsNamespace.stats:
+        if not argumentsNamespace.stats_port:
+            g_argumentParser.error( "--stats needs the --stats-port of the running TimeTray" )
+        print( json.dumps( fetchMetrics( argumentsNamespace.stats_port ), indent=4 ) )
+        return
+
+    # The running instance gets the command before this one starts any server or background work
+    command = argumentsNamespace.command
+    singleInstance = not argumentsNamespace.quit_after_startup
+    if singleInstance and handOffCommand( command or "show" ):
+        return
+    if command == "quit":
+        return
+
+    app = ( ProfilingApplication if argumentsNamespace.profile else QApplication )( [] )
     app.setQuitOnLastWindowClosed( False )
 
-    global mainWin
-    mainWin = MainWindow()
+    if singleInstance:
+        instanceServer = SingleInstanceServer( {} )
+        if not instanceServer.listen():
+            # Another launch started at the same time is listening, so it gets the command
+            sendInstanceCommand( command or "show" )
+            return
 
-    global mainTray
-    mainTray = QSystemTrayIconListener()
+    if argumentsNamespace.profile:
+        startProfiler( argumentsNamespace.profile, argumentsNamespace.profile_interval, argumentsNamespace.profile_deterministic )
+
+    if argumentsNamespace.audio_backend:
+        setAudioBackend(g_audioBackends[argumentsNamespace.audio_backend]())
+
+    if argumentsNamespace.speech_backend:
+        g_speechEngine[0] = createSpeechEngine(argumentsNamespace.speech_backend)
+
+    if argumentsNamespace.stats_port:
+        serveMetrics( argumentsNamespace.stats_port )
 
-    mainWin.connectTray()
+    if argumentsNamespace.instrument:
+        startInstrumentation( argumentsNamespace.instrument, argumentsNamespace.idle_wakeup_budget )
+
+    phrases = [cue.argument for cue in getRoutine() if cue.action == "speak"] + ["beep"]
+    g_laneExecutor.submit("speech", getSpeechEngine().prerender, phrases, priority=1)
+
+    # The other threads reach the GUI one by scheduling on the timer service, see its dispatcher.
+    # It lives as long as the application, which keeps it
+    app.timerServiceDriver = QtTimerServiceDriver( g_timerService )
+    getVolumeState()
+
+    createMainWindowAndTray( argumentsNamespace.tooltip_resolution )
+    instanceCommands = {
+        "show": mainWin.showUp,
+        "start": mainWin.startEyeRest,
+        "pause": mainWin.pauseEyeRest,
+        "reset": mainWin.resetEyeRest,
+        "quit": mainWin.exitApplication,
+    }
+    if singleInstance:
+        instanceServer.handlers.update( instanceCommands )
+    if command:
+        instanceCommands[command]()
+
+    # Decodes the cues after the tray icon is shown, instead of on the first alarm
+    g_timerService.schedule( 1, getAudioCues )
+
+    if argumentsNamespace.quit_after_startup:
+        QTimer.singleShot( 0, app.quit )
     app.exec_()
 
 
-@pytest.fixture(scope="session", autouse=True)
-def enable_verbose(request):
-    g_run_tests[0] = request.config.getoption("--verbose")
+def createMainWindowAndTray(tooltipResolution, timerService=None):
+    global mainWin
+    mainWin = MainWindow( timerService )
+
+    global mainTray
+    mainTray = QSystemTrayIconListener( tooltipResolution=tooltipResolution )
+
+    return mainWin, mainTray
 
 
 class TemporaryFileContent:
@@ -116,218 +447,884 @@ class TemporaryFileContent:
         return self.filename
 
     def __exit__(self, type, value, traceback):
-        # os.unlink(self.filename)
+        os.unlink(self.filename)
+
+
+def loadConfiguration(filename):
+    """ Reads the optional json settings file, see README.md, returning {} when there is none. """
+    try:
+        with open(filename, encoding="UTF-8") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        log.exception(f'Ignoring the invalid configuration {filename}')
+        return {}
+
+
+g_configuration = [{}]
+
+
+def createSoundEffect():
+    from PyQt5.QtMultimedia import QSoundEffect
+    return QSoundEffect()
+
+
+class SilentSoundEffect(object):
+    """ The `QSoundEffect` methods used by `AudioCues`, playing nothing, i.e., for --soak. """
+
+    def __init__(self):
+        self.playing = False
+
+    def setSource(self, url):
+        pass
+
+    def setVolume(self, volume):
         pass
 
+    def isPlaying(self):
+        return self.playing
+
+    def play(self):
+        self.playing = True
+
+    def stop(self):
+        self.playing = False
+
+
+class AudioCues(object):
+    """ Keeps each cue sound decoded in memory by a `QSoundEffect`, so playing one does not touch
+    the disk. Every cue has its own gain, and playing a cue again restarts it. Like all Qt
+    multimedia objects, it has to be used from the GUI thread. """
+    defaultCues = {
+        "alarm": {"file": "Alarm06.wav", "gain": 1.0},
+    }
+
+    def __init__(self, createEffect=createSoundEffect, directory=CURRENT_DIR):
+        self.createEffect = createEffect
+        self.directory = pathlib.Path(directory)
+        self.effects = {}
+        self.gains = {}
+
+    def load(self, name, filename, gain=1.0):
+        """ Decodes `filename` as the cue `name`, replacing the previous sound of the cue. """
+        effect = self.effects.get(name)
+        if effect is None:
+            effect = self.effects[name] = self.createEffect()
+        else:
+            effect.stop()
+        effect.setSource(QtCore.QUrl.fromLocalFile(str(self.directory / filename)))
+        self.gains[name] = min(max(gain, 0.0), 1.0)
+        return effect
+
+    def configure(self, cues):
+        """ Loads the `defaultCues` updated by `cues`, i.e., the configuration "cues" entry, which
+        is validated by `parseCues()` before loading any of them. """
+        configured = parseCues(cues, self.directory)
+        defaults = {name: ( cue["file"], cue["gain"] ) for name, cue in self.defaultCues.items()}
+        for name, ( filename, gain ) in {**defaults, **configured}.items():
+            self.load(name, filename, gain)
+
+    def play(self, name, gain=None, replace=False):
+        """ Plays the cue with its gain, or `gain`. With `replace`, the other cues are stopped. """
+        if replace:
+            self.stop()
+        effect = self.effects[name]
+        if effect.isPlaying():
+            effect.stop()
+        effect.setVolume(self.gains[name] if gain is None else min(max(gain, 0.0), 1.0))
+        effect.play()
+
+    def playFile(self, filename, gain=None):
+        """ Plays a sound file, which is loaded as a cue named after it on its first use. """
+        name = str(filename)
+        if name not in self.effects:
+            self.load(name, filename)
+        self.play(name, gain)
+
+    def stop(self, name=None):
+        for effect in ( self.effects.values() if name is None else ( self.effects[name], ) ):
+            effect.stop()
+
+
+def parseCues(entry, directory=CURRENT_DIR):
+    """ Returns the ( file, gain ) of each cue of the configuration "cues" entry, e.g.,
+    `{"chime": {"file": "C:/Windows/Media/chimes.wav", "gain": 0.5}}`, where the files are relative
+    to `directory` or absolute. """
+    cues = {}
+    for name, cue in entry.items():
+        if not isinstance(name, str) or not name.strip():
+            raise ValueError(f"The cue name {name!r} is empty, on {entry}")
+
+        if not isinstance(cue.get("file"), str):
+            raise ValueError(f"The cue {name!r} needs a 'file', on {entry}")
+
+        filename = pathlib.Path(directory) / cue["file"]
+        if not filename.is_file():
+            raise ValueError(f"The cue {name!r} file {str(filename)!r} does not exist, on {entry}")
+        cues[name] = ( filename, float(cue.get("gain", 1.0)) )
+    return cues
+
+
+g_audioCues = [None]
+
+
+def getAudioCues():
+    if g_audioCues[0] is None:
+        # Only published once configured, so no caller plays from a half loaded one
+        cues = AudioCues()
+        try:
+            cues.configure(g_configuration[0].get("cues", {}))
+        except (ValueError, TypeError, AttributeError):
+            log.exception('Using the default cues instead of the configured ones')
+            cues.configure({})
+        g_audioCues[0] = cues
+    return g_audioCues[0]
+
+
+def playSound(filename):
+    getAudioCues().playFile(filename)
+
+
+class SpeechSynthesizer(object):
+    """ Renders a phrase into a wave file. """
+    name = None
+
+    def render(self, text, filename):
+        raise NotImplementedError
+
+
+def quoteVbscript(text):
+    """ Returns `text` as a VBScript string literal, where a quote is doubled and nothing else can
+    be escaped, so the line breaks become spaces. """
+    return '"' + " ".join(str(text).splitlines()).replace('"', '""') + '"'
+
+
+class SapiSpeechSynthesizer(SpeechSynthesizer):
+    """ Windows voice, rendered by a VBScript, which is only run once per phrase. The phrases come
+    from the configured routine, so they are quoted, instead of becoming part of the script. """
+    name = "sapi"
+
+    def render(self, text, filename):
+        with TemporaryFileContent(self.script(text, filename)) as script:
+            instrumentCount("speech", "processes")
+            subprocess.run(["wscript", str(script)], check=True)
+
+    def script(self, text, filename):
+        return f"""
+Set stream = CreateObject("SAPI.SpFileStream")
+stream.Open {quoteVbscript(filename)}, 3
 
-def speak(text):
-    with TemporaryFileContent(f"""
 Set speech = CreateObject("sapi.spvoice")
 Set speech.Voice = speech.GetVoices.Item(0)
+Set speech.AudioOutputStream = stream
 
 ' Speech speed from -10 to 10
 speech.Rate = -2
 speech.Volume = 100
 
-speech.Speak "{text}"
-    """) as filename:
-        a = subprocess.Popen(f'wscript "{filename}"')
-        ar = a.communicate()
-        # print(f'ar {ar}.')
-        threading.Timer( 10, os.unlink, args=(filename) )
+speech.Speak {quoteVbscript(text)}
+stream.Close
+    """
 
 
-def run_process(command_line, directory=None, verbose=False):
-    """ https://gist.github.com/evandrocoan/916976490aeecc7b93e658084bb2834d """
-    stdout_lines = []
-    stderr_lines = []
-    command = shlex.split(command_line)
+class SilentSpeechSynthesizer(SpeechSynthesizer):
+    """ Renders every phrase as a short silence, for running without a voice, i.e., on Linux. """
+    name = "silent"
+
+    def render(self, text, filename):
+        with wave.open(str(filename), "wb") as output:
+            output.setnchannels(1)
+            output.setsampwidth(2)
+            output.setframerate(8000)
+            output.writeframes(b"\0\0" * 800)
+
+
+class SpeechEngine(object):
+    """ Speaks phrases by playing wave files, which are rendered once per distinct phrase and kept
+    on `directory`, so the next time the phrase is only played, with the same player as the alarm. """
+
+    def __init__(self, synthesizer, directory, player=playSound, timerService=None):
+        self.synthesizer = synthesizer
+        self.directory = pathlib.Path(directory)
+        self.player = player
+        self.timerService = timerService
+        self.phrases = {}
+        self.lock = threading.Lock()
+
+    def filename(self, text):
+        key = hashlib.sha1(f"{self.synthesizer.name}:{text}".encode("UTF-8")).hexdigest()
+        return self.directory / f"{key}.wav"
+
+    def render(self, text):
+        """ Returns the wave file for `text`, rendering it when it is not on the cache yet. """
+        with self.lock:
+            filename = self.phrases.get(text)
+            if filename is not None:
+                return filename
+
+            filename = self.filename(text)
+            if not filename.exists():
+                self.directory.mkdir(parents=True, exist_ok=True)
+                partial = filename.with_suffix(".partial.wav")
+                self.synthesizer.render(text, partial)
+                os.replace(partial, filename)
+
+            self.phrases[text] = filename
+            return filename
+
+    def prerender(self, phrases):
+        for text in phrases:
+            with instrumentWakeup("speech"):
+                self.render(text)
+
+    def speak(self, text):
+        requested = time.perf_counter()
+        filename = self.phrases.get(text)
+        if filename is not None:
+            self.play(filename, requested)
+            return
+
+        # The player needs the GUI thread, so only the rendering happens on this one
+        g_metrics.count("speech.cacheMisses")
+        timerService = self.timerService or g_timerService
+
+        def render():
+            with instrumentWakeup("speech"):
+                timerService.schedule(0, self.play, self.render(text), requested)
+
+        try:
+            g_laneExecutor.submit("speech", render)
+        except queue.Full:
+            log.exception(f'Skipped speaking {text}')
+
+    def play(self, filename, requested):
+        self.player(filename)
+        g_metrics.record("speech.startLatency", time.perf_counter() - requested)
+
+
+g_speechSynthesizers = {
+    "sapi": SapiSpeechSynthesizer,
+    "silent": SilentSpeechSynthesizer,
+}
+g_speechEngine = [None]
+
+
+def createSpeechEngine(synthesizer):
+    return SpeechEngine(g_speechSynthesizers[synthesizer](), pathlib.Path(tempfile.gettempdir()) / "TimeTraySpeech")
 
-    if verbose:
-        print('run_process command', command, directory, file=sys.stderr)
 
-    with subprocess.Popen(
-        command,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
+def getSpeechEngine():
+    if g_speechEngine[0] is None:
+        g_speechEngine[0] = createSpeechEngine("sapi" if sys.platform == "win32" else "silent")
+    return g_speechEngine[0]
+
+
+def speak(text):
+    getSpeechEngine().speak(text)
+
+
+def decode_process_line(line):
+    line = line.decode("UTF-8", errors='replace')
+    return line.replace('\r\n', '\n').rstrip(' \n\r')
+
+
+async def run_process_async(command, directory, on_line, timeout=None):
+    """ Runs `command` calling `on_line(name, line)` for each line of its "stdout" and "stderr",
+    which are both drained by this same event loop. Raises subprocess.TimeoutExpired after killing
+    the process when it takes longer than `timeout` seconds. """
+    import asyncio
+    instrumentCount("process", "processes")
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
         cwd=directory,
-        shell=True,
-    ) as process:
-        def capturestderr():
-            while True:
-                line = process.stderr.readline()
-                if not line:
-                    break
-                line = line.decode("UTF-8", errors='replace')
-                line = line.replace('\r\n', '\n').rstrip(' \n\r')
-                stderr_lines.append(line)
-
-                if verbose:
-                    print(line, file=sys.stderr)
-
-        thread = threading.Thread(target=capturestderr, daemon=True)
-        thread.start()
+        creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0),
+    )
 
+    # Reading big chunks and splitting them is much faster than awaiting a readline() per line
+    async def drain(stream, name):
+        buffer = bytearray()
         while True:
-            line = process.stdout.readline()
-            if not line:
+            chunk = await stream.read(2**16)
+            if not chunk:
                 break
+            buffer += chunk
+            end = buffer.rfind(b'\n')
+            if end < 0:
+                continue
+            # Only each line terminator is stripped, keeping the blank lines at the chunk end
+            for line in buffer[:end].decode("UTF-8", errors='replace').split('\n'):
+                on_line(name, line.rstrip(' \r'))
+            del buffer[:end + 1]
+        if buffer:
+            on_line(name, decode_process_line(buffer))
+
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(drain(process.stdout, "stdout"), drain(process.stderr, "stderr"), process.wait()),
+            timeout)
+
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise subprocess.TimeoutExpired(command, timeout)
+
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+
+    return process
+
+
+def process_command(command_line):
+    if isinstance(command_line, str):
+        return shlex.split(command_line)
+    return [str(argument) for argument in command_line]
+
+
+def run_process(command_line, directory=None, verbose=False, timeout=None, callback=None, max_lines=10_000):
+    """ https://gist.github.com/evandrocoan/916976490aeecc7b93e658084bb2834d
+
+    Returns the finished process with its last `max_lines` lines of stdout and stderr. When given,
+    `callback(name, line)` is called for every line as soon as it is read.
+    """
+    stdout_lines = collections.deque(maxlen=max_lines)
+    stderr_lines = collections.deque(maxlen=max_lines)
+    lines = {"stdout": stdout_lines, "stderr": stderr_lines}
+    command = process_command(command_line)
+
+    if verbose:
+        print('run_process command', command, directory, file=sys.stderr)
+
+    def on_line(name, line):
+        lines[name].append(line)
 
-            line = line.decode("UTF-8", errors='replace')
-            line = line.replace('\r\n', '\n').rstrip(' \n\r')
-            stdout_lines.append(line)
+        if verbose:
+            print(line, file=sys.stderr)
 
-            if verbose:
-                print(line, file=sys.stderr)
+        if callback:
+            callback(name, line)
 
-        thread.join()
+    import asyncio
+    loop = asyncio.new_event_loop()
+    try:
+        process = loop.run_until_complete(run_process_async(command, directory, on_line, timeout))
+    finally:
+        loop.close()
 
-    return process, stdout_lines, stderr_lines
+    return process, list(stdout_lines), list(stderr_lines)
+
+
+def iterate_process(command_line, directory=None, timeout=None):
+    """ Generates the (name, line) tuples of the process output while it runs. The process only
+    runs while the generator is consumed, and it is killed when the generator is closed early. """
+    import asyncio
+    command = process_command(command_line)
+    loop = asyncio.new_event_loop()
+    pending = collections.deque()
+    wakeup = [None]
+
+    def on_line(name, line):
+        pending.append((name, line))
+        if not wakeup[0].done():
+            wakeup[0].set_result(None)
+
+    try:
+        wakeup[0] = loop.create_future()
+        task = loop.create_task(run_process_async(command, directory, on_line, timeout))
+        while True:
+            while pending:
+                yield pending.popleft()
+
+            if task.done():
+                task.result()
+                break
+
+            wakeup[0] = loop.create_future()
+            loop.run_until_complete(asyncio.wait([task, wakeup[0]], return_when=asyncio.FIRST_COMPLETED))
+
+    finally:
+        if not task.done():
+            task.cancel()
+            loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+        loop.close()
 
 
 def runpython(text):
-    with TemporaryFileContent(text) as filename:
-        process, stdout, stderr = run_process(f'python -u "{filename}"', verbose=g_run_tests[0])
+    with TemporaryFileContent(text) as filename, g_metrics.timed("runpython"):
+        process, stdout, stderr = run_process([sys.executable, "-u", filename], verbose=g_run_tests[0])
         stdout = "\n".join(stdout)
         stderr = "\n".join(stderr)
         assert process.returncode == 0, f"process.returncode {process.returncode}, {stdout}, {stderr}."
         return stdout
 
 
+class AudioWorker(AudioBackend):
+    """Runs an audio backend on a long lived child process, started on the first request.
+
+    Each `execute()` is one round trip: a json line with the requests list is written to the worker
+    stdin, and a json line with the results is read from its stdout. See `serveAudioBackend()`.
+    A worker which does not answer in `timeout` seconds, plus the requested sleeps, is killed, and
+    the next request starts another one. Its stderr goes to `TimeTray.audio.log`, next to the log.
+    """
+
+    def __init__(self, backend="pycaw", timeout=5):
+        self.backend = backend
+        self.timeout = timeout
+        self.command = [sys.executable, "-u", os.path.realpath(TimeTrayAudio.__file__), backend]
+        self.process = None
+        self.responses = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        instrumentCount("audioWorker", "processes")
+        with open(g_logFile[0].with_name("TimeTray.audio.log"), "a", encoding="UTF-8") as errors:
+            self.process = subprocess.Popen(
+                self.command,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=errors,
+                cwd=CURRENT_DIR,
+                encoding="UTF-8",
+                creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0),
+            )
+
+        # The Windows pipes have no read timeout, so a thread reads them for execute()
+        self.responses = queue.Queue()
+        startThread("audioWorker", self.readResponses, self.process.stdout, self.responses)
+
+    @staticmethod
+    def readResponses(stdout, responses):
+        try:
+            for line in stdout:
+                responses.put(line)
+        except (OSError, ValueError):
+            pass
+        responses.put("")
+
+    def execute(self, requests):
+        timeout = self.timeout + sum(args[0] for name, *args in requests
+                if name == "sleep" and args and isinstance(args[0], Number))
+        with self.lock:
+            if self.process is None or self.process.poll() is not None:
+                self.start()
+
+            try:
+                self.process.stdin.write(json.dumps(requests) + "\n")
+                self.process.stdin.flush()
+                line = self.responses.get(timeout=timeout)
+            except OSError:
+                line = ""
+            except queue.Empty:
+                self.process.kill()
+                self.process.wait()
+                self.process.stdin.close()
+                self.process = None
+                raise RuntimeError(f"The audio worker did not answer in {timeout} seconds, it was killed.")
+
+            if not line:
+                self.process.kill()
+                raise RuntimeError(f"The audio worker exited with {self.process.wait()}.")
+
+        response = json.loads(line)
+        if "error" in response:
+            raise RuntimeError(f"The audio worker failed with {response['error']}.")
+        return response["results"]
+
+    def getSystemVolume(self):
+        return self.execute([("getSystemVolume",)])[0]
+
+    def setSystemVolume(self, volume):
+        return self.execute([("setSystemVolume", volume)])[0]
+
+    def getApplicationVolume(self, processName):
+        return self.execute([("getApplicationVolume", processName)])[0]
+
+    def setApplicationVolume(self, volume, processName):
+        return self.execute([("setApplicationVolume", volume, processName)])[0]
+
+    def getApplicationVolumes(self, processNames):
+        return self.execute([("getApplicationVolumes", list(processNames))])[0]
+
+    def close(self):
+        with self.lock:
+            if self.process is None:
+                return
+            self.process.stdin.close()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+            self.process = None
+
+
+g_audioBackends = {
+    "worker": lambda: AudioWorker("pycaw"),
+    "pycaw": PycawAudioBackend,
+    "fake": FakeAudioBackend,
+}
+g_audioBackend = [None]
+
+
+def setAudioBackend(backend):
+    if g_audioBackend[0] is not None:
+        g_audioBackend[0].close()
+    g_audioBackend[0] = backend
+    return backend
+
+
+def getAudioBackend():
+    if g_audioBackend[0] is None:
+        setAudioBackend(g_audioBackends["worker" if sys.platform == "win32" else "fake"]())
+    return g_audioBackend[0]
+
+
+@atexit.register
+def closeAudioBackend():
+    if g_audioBackend[0] is not None:
+        g_audioBackend[0].close()
+
+
 def getSystemVolume():
-    result = runpython(f"""
-{g_setVolumeBase}
-volume = cast(interface, POINTER(IAudioEndpointVolume))
-print(volume.GetMasterVolumeLevelScalar())
-        """
-    )
-    return float(result)
+    return getAudioBackend().getSystemVolume()
 
 
-def test_get_system_volume():
-    assert type(getSystemVolume()) == float
+class VolumeState(object):
+    """ The system volume kept current in the background, so the GUI thread reads `systemVolume`
+    without waiting for the audio backend, which can be a process round trip. It is read once on the
+    io lane, then updated by the backend change notifications, or, when the backend has none, e.g.,
+    the `AudioWorker`, read again on each `refresh()`, instead of waking up to poll it. It is None
+    until the first read. """
 
+    def __init__(self, backend=None, executor=None):
+        self.backend = backend
+        self.executor = executor
+        self.systemVolume = None
+        self.notified = False
 
-def setSystemVolume(endVolume):
-    result = runpython(f"""
-{g_setVolumeBase}
-systemVolume = cast(interface, POINTER(IAudioEndpointVolume))
-startVolume = int(systemVolume.GetMasterVolumeLevelScalar() * 100)
-endVolume = int({endVolume} * 100)
-for volume in range(startVolume, endVolume, 5):
-    # print(f'volume {{volume}}.', file=sys.stderr)
-    systemVolume.SetMasterVolumeLevelScalar(volume/100, None)
-    time.sleep(0.1)
-systemVolume.SetMasterVolumeLevelScalar({endVolume}, None)
-print(systemVolume.GetMasterVolumeLevelScalar())
-        """
-    )
-    return float(result)
+    def start(self):
+        self.submit( self.connect )
 
+    def submit(self, function):
+        try:
+            ( self.executor or g_laneExecutor ).submit( "io", function )
+        except queue.Full:
+            log.exception( f'Skipped the volume state {function.__name__}' )
 
-def test_set_system_volume():
-    level = 0.20
-    defaultSystemVolume = getSystemVolume()
-    assert setSystemVolume(level) == approx(level)
-    assert setSystemVolume(defaultSystemVolume) == approx(defaultSystemVolume)
+    def connect(self):
+        backend = self.backend or getAudioBackend()
+        try:
+            self.notified = backend.subscribeSystemVolume( self.update )
+        except Exception:
+            log.exception( 'Failed to subscribe to the system volume changes' )
+        self.read()
 
+    def read(self):
+        try:
+            self.update( ( self.backend or getAudioBackend() ).getSystemVolume() )
+        except Exception:
+            log.exception( 'Failed to read the system volume' )
 
-def setApplicationVolume(endVolume, processName):
-    result = runpython(f"""
-{g_setVolumeBase}
-sessions = AudioUtilities.GetAllSessions()
-for session in sessions:
-    if session.Process and session.Process.name() == "{processName}":
-        volumeDevice = session.SimpleAudioVolume
-        # print(f"{{session.Process.name()}} volumeDevice.GetMute(): {{volumeDevice.GetMute()}}, volume {{volumeDevice.GetMasterVolume()}}.", file=sys.stderr)
-        startVolume = int(volumeDevice.GetMasterVolume() * 100)
-        endVolume = int({endVolume} * 100)
-        for volume in range(startVolume, endVolume, 10):
-            # print(f'volume {{volume}}.', file=sys.stderr)
-            volumeDevice.SetMasterVolume(volume/100, None)
-            time.sleep(0.1)
-        volumeDevice.SetMasterVolume({endVolume}, None)
-        print(volumeDevice.GetMasterVolume())
-        """
-    )
-    return float(result)
+    def refresh(self):
+        """ Reads the volume again, unless the notifications keep it current, i.e., when the eye rest
+        starts, a second before the volume is saved. """
+        if not self.notified:
+            self.submit( self.read )
 
+    def update(self, volume):
+        self.systemVolume = volume
+        g_metrics.count( "volumeState.updates" )
 
-def test_set_application_volume():
-    level = 0.2
-    assert setApplicationVolume(level, "AIMP.exe") == approx(level)
-    level = 1
-    assert setApplicationVolume(level, "AIMP.exe") == approx(level)
 
+g_volumeState = [None]
 
-def setSystemAndApplicationVolume(defaultSystemVolume, volumeIncrease, applicationName, reverse=False):
-    result = runpython(f"""
-{g_setVolumeBase}
-import math
-from itertools import zip_longest
 
-defaultSystemVolume = {defaultSystemVolume}
-volumeIncrease = {volumeIncrease}
-applicationName = "{applicationName}"
-reverse = {reverse}
+def getVolumeState():
+    if g_volumeState[0] is None:
+        g_volumeState[0] = VolumeState()
+        g_volumeState[0].start()
+    return g_volumeState[0]
+
+
+def setSystemVolume(endVolume):
+    backend = getAudioBackend()
+    startVolume = int(backend.getSystemVolume() * 100)
+    requests = []
+    for volume in range(startVolume, int(endVolume * 100), 5):
+        requests.append(("setSystemVolume", volume/100))
+        requests.append(("sleep", 0.1))
+    requests.append(("setSystemVolume", endVolume))
+    requests.append(("getSystemVolume",))
+    return backend.execute(requests)[-1]
+
+
+def setApplicationVolume(endVolume, processName):
+    backend = getAudioBackend()
+    startVolume = backend.getApplicationVolume(processName)
+    if startVolume is None:
+        return None
+    requests = []
+    for volume in range(int(startVolume * 100), int(endVolume * 100), 10):
+        requests.append(("setApplicationVolume", volume/100, processName))
+        requests.append(("sleep", 0.1))
+    requests.append(("setApplicationVolume", endVolume, processName))
+    requests.append(("getApplicationVolume", processName))
+    return backend.execute(requests)[-1]
+
+
+SYSTEM_VOLUME = ("system", None)
+VOLUME_RAMP_DURATION = 1.0
+
+
+def applicationVolume(processName):
+    """ The `VolumeRampEngine` target for the `processName` audio sessions. """
+    return ("application", processName)
+
+
+def setVolumeRequest(target, volume):
+    kind, processName = target
+    if kind == "system":
+        return ("setSystemVolume", volume)
+    return ("setApplicationVolume", volume, processName)
+
+
+class VolumeRamp(object):
+    """ Moves each target volume through its curve, a list of scalars, in `duration` seconds. """
+
+    def __init__(self, curves, duration, requireApplication=False):
+        self.curves = {target: list(curve) for target, curve in curves.items()}
+        self.duration = duration
+        self.requireApplication = requireApplication
+        self.start = None
+        self.end = None
+        self.preempted = False
+        self.skipped = False
+        self.finished = threading.Event()
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def volumeAt(self, target, elapsed):
+        curve = self.curves[target]
+        progress = min( elapsed / self.duration, 1 ) if self.duration > 0 else 1
+        position = progress * ( len( curve ) - 1 )
+        index = min( int( position ), len( curve ) - 2 )
+        if index < 0:
+            return curve[0]
+        return curve[index] + ( curve[index + 1] - curve[index] ) * ( position - index )
+
+    def onFinished(self, callback):
+        """ Calls `callback(ramp)` when the ramp ends, or right now if it already ended. """
+        with self.lock:
+            if not self.finished.is_set():
+                self.callbacks.append( callback )
+                return
+        callback( self )
+
+    def finish(self, end):
+        with self.lock:
+            self.end = end
+            self.finished.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback( self )
+
+    def wait(self, timeout=None):
+        return self.finished.wait( timeout )
+
+    def __repr__(self):
+        state = "preempted" if self.preempted else "skipped" if self.skipped else "finished" if self.finished.is_set() else "running"
+        return f"<VolumeRamp {state} {self.duration}s {list(self.curves)}>"
+
+
+class VolumeRampEngine(object):
+    """ Each audio target is owned by at most one running ramp, and one thread moves all of them,
+    sending a single batch of requests per tick. Starting a ramp on a target another ramp owns takes
+    it over from the volume it was last set to, and the older ramp finishes as preempted when it has
+    no targets left. The thread, a task on the audio lane, exits when there are no ramps running. """
+
+    def __init__(self, backend=None, clock=monotonicClock, tickInterval=0.05, executor=None):
+        self.backend = backend
+        self.clock = clock
+        self.tickInterval = tickInterval
+        self.executor = executor
+        self.owners = {}
+        self.volumes = {}
+        self.starting = []
+        self.task = None
+        self.condition = threading.Condition()
+
+    def start(self, curves, duration=VOLUME_RAMP_DURATION, requireApplication=False):
+        """ Starts and returns a `VolumeRamp`, which is skipped when `requireApplication` is set
+        and none of its application targets has an audio session. """
+        ramp = VolumeRamp( curves, duration, requireApplication )
+        preempted = []
+
+        with self.condition:
+            ramp.start = self.clock()
+            # Only registered once its thread runs, otherwise nothing would ever finish it
+            if self.task is None:
+                try:
+                    self.task = ( self.executor or g_laneExecutor ).submit( "audio", self.run )
+                except ( queue.Full, RuntimeError ):
+                    log.exception( f'Skipped {ramp}, the audio lane is not accepting tasks' )
+                    ramp.skipped = True
+
+            if not ramp.skipped:
+                for target, curve in ramp.curves.items():
+                    previous = self.owners.get( target )
+                    if previous is not None:
+                        # The previous ramp already moved the volume, so this one has to finish the move
+                        if previous not in self.starting:
+                            ramp.requireApplication = False
+                        curve[0] = self.volumes.get( target, curve[0] )
+                        del previous.curves[target]
+                        if not previous.curves:
+                            previous.preempted = True
+                            preempted.append( previous )
+                            if previous in self.starting:
+                                self.starting.remove( previous )
+                    self.owners[target] = ramp
+
+                self.starting.append( ramp )
+                self.condition.notify()
+
+        if ramp.skipped:
+            ramp.finish( ramp.start )
+            return ramp
+
+        for previous in preempted:
+            log( f'{previous} preempted by {ramp}' )
+            g_metrics.count( "volumeRamp.preempted" )
+            previous.finish( self.clock() )
+        return ramp
+
+    def checkApplications(self, backend, ramp):
+        processNames = [processName for kind, processName in list( ramp.curves ) if kind == "application"]
+        volumes = backend.getApplicationVolumes( processNames )
+        return any( volume is not None for volume in volumes.values() )
+
+    def run(self):
+        backend = self.backend or getAudioBackend()
+        while True:
+            with self.condition:
+                if not self.owners:
+                    self.task = None
+                    return
+                starting, self.starting = self.starting, []
+
+            with instrumentWakeup( "volumeRamps" ):
+                for ramp in starting:
+                    if ramp.requireApplication and not self.checkApplications( backend, ramp ):
+                        self.release( ramp, skipped=True )
+
+                finished = set()
+                requests = []
+                with self.condition:
+                    now = self.clock()
+                    for ramp in dict.fromkeys( self.owners.values() ):
+                        for target in ramp.curves:
+                            volume = ramp.volumeAt( target, now - ramp.start )
+                            self.volumes[target] = volume
+                            requests.append( setVolumeRequest( target, volume ) )
+                        if now - ramp.start >= ramp.duration:
+                            finished.add( ramp )
+
+                try:
+                    if requests:
+                        backend.execute( requests )
+                except Exception:
+                    log.exception( f'Failed to set the volumes {requests}' )
+
+                for ramp in finished:
+                    self.release( ramp )
+
+            with self.condition:
+                if self.owners and not self.starting:
+                    self.condition.wait( self.tickInterval )
+
+    def release(self, ramp, skipped=False):
+        with self.condition:
+            for target in ramp.curves:
+                if self.owners.get( target ) is ramp:
+                    del self.owners[target]
+        ramp.skipped = skipped
+        end = self.clock()
+        log( f'{ramp} took {end - ramp.start:.3f}s' )
+        if skipped:
+            g_metrics.count( "volumeRamp.skipped" )
+        else:
+            g_metrics.record( "volumeRamp.duration", end - ramp.start )
+        ramp.finish( end )
 
-{inspect.getsource(volumeConversion)}
 
-sessions = AudioUtilities.GetAllSessions()
-for session in sessions:
-    # print(f"{{{{session.Process.name() if session.Process else session.Process}}}} volumeDevice.GetMute(): {{{{volumeDevice.GetMute()}}}}, volume {{{{volumeDevice.GetMasterVolume()}}}}.", file=sys.stderr)
-    if session.Process and session.Process.name() == applicationName:
-        volumeDevice = session.SimpleAudioVolume
-        devices = AudioUtilities.GetSpeakers()
-        interface = devices.Activate(IAudioEndpointVolume._iid_, CLSCTX_ALL, None)
-        systemDevice = cast(interface, POINTER(IAudioEndpointVolume))
-        systemRangeFull = volumeConversion(defaultSystemVolume, volumeIncrease, 0.3)
+g_volumeRampEngine = VolumeRampEngine()
 
+
+def crossfade(defaultSystemVolume, volumeIncrease, applications, reverse=False, engine=None, requireApplication=True):
+    """ Starts the `VolumeRamp` which raises the system volume while lowering each of the
+    `applications`, a dictionary with the `volumeConversion()` factor of each process name, or the
+    other way around with `reverse`. Each engine tick sets the system and all the applications
+    sessions on a single backend batch. With `requireApplication`, it does nothing when none of
+    the applications is running. """
+    def curve(factor, index):
+        volumes = volumeConversion(defaultSystemVolume, volumeIncrease, factor)
         if reverse:
-            systemRangeFull = list(reversed(systemRangeFull))
+            volumes = reversed(volumes)
+        return [pair[index]/100 for pair in volumes]
 
-        for systemVolume, applicationVolume in systemRangeFull:
-            # print(f'systemVolume {{{{systemVolume:.2f}}}}, applicationVolume {{{{applicationVolume:.2f}}}}.', file=sys.stderr)
-            if reverse:
-                volumeDevice.SetMasterVolume(applicationVolume/100, None)
-                systemDevice.SetMasterVolumeLevelScalar(systemVolume/100, None)
-            else:
-                systemDevice.SetMasterVolumeLevelScalar(systemVolume/100, None)
-                volumeDevice.SetMasterVolume(applicationVolume/100, None)
-            time.sleep(0.1)
+    curves = {applicationVolume(processName): curve(factor, 1) for processName, factor in applications.items()}
 
-        print(volumeDevice.GetMasterVolume())
-        print(systemDevice.GetMasterVolumeLevelScalar())
-        break
-""".format())
-    return result
+    # When lowering the system volume, raise the applications first, so they do not get too quiet
+    systemCurve = curve(0, 0)
+    if reverse:
+        curves[SYSTEM_VOLUME] = systemCurve
+    else:
+        curves = {SYSTEM_VOLUME: systemCurve, **curves}
+    return (engine or g_volumeRampEngine).start(curves, requireApplication=requireApplication)
 
 
-def test_set_volume_evenly():
-    defaultSystemVolume = getSystemVolume()
-    setSystemAndApplicationVolume(defaultSystemVolume, 0.5, "AIMP.exe")
-    time.sleep(2)
-    setSystemAndApplicationVolume(defaultSystemVolume, 0.5, "AIMP.exe", reverse=True)
+def setSystemAndApplicationVolume(defaultSystemVolume, volumeIncrease, applicationName, reverse=False):
+    """ The `crossfade()` of a single application. """
+    return crossfade(defaultSystemVolume, volumeIncrease, {applicationName: 0.3}, reverse)
 
 
-def volumeConversion(defaultSystemVolume, volumeIncrease, factor):
-    # https://en.wikipedia.org/wiki/Sigmoid_function
-    # https://www.desmos.com/calculator/lew1cvqu91
-    def sigmoid(number):
-        number = number
-        reverse = abs(number - 100)
-        extra = math.sin( number / 100 + 1.5 ) - 0.6
-        # print("extra %s, reverse %s." % (extra, reverse), file=sys.stderr)
-        extra = extra if extra > 0 and factor else 0
-        number = number + reverse * factor - extra * 100
-        if number > 100: return 100
-        if number < 0: return 0
-        return int(number * 100) / 100
+Crossfade = collections.namedtuple("Crossfade", "increase applications")
 
-    def ceiling(number):
-        if number > 100: return 100
-        return int(number * 100) / 100
 
+def parseCrossfade(entry):
+    """ Returns the `Crossfade` of the configuration "crossfade" entry, e.g.,
+    `{"increase": 0.5, "applications": {"AIMP.exe": 0.3, "chrome.exe": 0}}`, where each application
+    has its `volumeConversion()` factor. """
+    increase = float(entry.get("increase", 0.5))
+    if not -1 <= increase <= 1:
+        raise ValueError(f"The crossfade increase {increase} is not between -1 and 1, on {entry}")
+
+    applications = {}
+    for processName, factor in entry.get("applications", {}).items():
+        if not 0 <= float(factor) <= 1:
+            raise ValueError(f"The crossfade factor of {processName!r} is not between 0 and 1, on {entry}")
+        applications[processName] = float(factor)
+    return Crossfade(increase, applications)
+
+
+g_defaultCrossfade = {"increase": 0.5, "applications": {"AIMP.exe": 0.3}}
+
+
+def getCrossfade():
+    entry = g_configuration[0].get("crossfade")
+    if entry is not None:
+        try:
+            return parseCrossfade(entry)
+        except (ValueError, TypeError, AttributeError):
+            log.exception('Using the default crossfade instead of the configured one')
+    return parseCrossfade(g_defaultCrossfade)
+
+
+def volumeSteps(defaultSystemVolume, volumeIncrease):
+    """ Returns the clamped default system volume and the system volume steps, in 1/10_000 units. """
     if defaultSystemVolume > 1: defaultSystemVolume = 1
     if defaultSystemVolume < 0: defaultSystemVolume = 0
 
@@ -345,301 +1342,1372 @@ def volumeConversion(defaultSystemVolume, volumeIncrease, factor):
     else:
         endSystemVolume += 1
 
+    return defaultSystemVolume, range(startSystemVolume, endSystemVolume, stepSystem)
+
+
+@functools.lru_cache(maxsize=1024)
+def volumeCurve(defaultSystemVolume, volumeIncrease, factor):
+    """ The `volumeConversion()` table, computed once per arguments. """
+    # https://en.wikipedia.org/wiki/Sigmoid_function
+    # https://www.desmos.com/calculator/lew1cvqu91
+    def sigmoid(number):
+        number = number
+        reverse = abs(number - 100)
+        extra = math.sin( number / 100 + 1.5 ) - 0.6
+        # print("extra %s, reverse %s." % (extra, reverse), file=sys.stderr)
+        extra = extra if extra > 0 and factor else 0
+        number = number + reverse * factor - extra * 100
+        if number > 100: return 100
+        if number < 0: return 0
+        return int(number * 100) / 100
+
+    def ceiling(number):
+        if number > 100: return 100
+        return int(number * 100) / 100
+
+    defaultSystemVolume, systemSteps = volumeSteps(defaultSystemVolume, volumeIncrease)
+
     systemRangeFull = []
-    for volume in range(startSystemVolume, endSystemVolume, stepSystem):
+    for volume in systemSteps:
         if volume > 0:
             systemRangeFull.append((ceiling(volume/100), sigmoid(defaultSystemVolume / volume * 1_000_000 )))
         else:
             systemRangeFull.append((0, 100))
-    return systemRangeFull
-
-
-def test_volume_convertion_from01to99():
-    assert volumeConversion(0.01, 0.99, 0) == [
-        (1.0, 100.0),
-        (6.0, 16.66),
-        (11.0, 9.09),
-        (16.0, 6.25),
-        (21.0, 4.76),
-        (26.0, 3.84),
-        (31.0, 3.22),
-        (36.0, 2.77),
-        (41.0, 2.43),
-        (46.0, 2.17),
-        (51.0, 1.96),
-        (56.0, 1.78),
-        (61.0, 1.63),
-        (66.0, 1.51),
-        (71.0, 1.4),
-        (76.0, 1.31),
-        (81.0, 1.23),
-        (86.0, 1.16),
-        (91.0, 1.09),
-        (96.0, 1.04),
-    ]
-
-
-def test_volume_convertion_from10to60_factor03():
-    assert volumeConversion(0.1, 0.5, 0.3) == [
-        (10.0, 100.0),
-        (15.0, 53.9),
-        (20.0, 34.07),
-        (25.0, 23.36),
-        (30.0, 16.75),
-        (35.0, 12.3),
-        (40.0, 9.1),
-        (45.0, 6.69),
-        (50.0, 4.83),
-        (55.0, 3.34),
-        (60.0, 2.12),
-    ]
-
-
-def test_volume_convertion_from01to99_factor03():
-    assert volumeConversion(0.01, 0.99, 0.3) == [
-        (1.0, 100.0),
-        (6.0, 2.12),
-        (11.0, 0),
-        (16.0, 0),
-        (21.0, 0),
-        (26.0, 0),
-        (31.0, 0),
-        (36.0, 0),
-        (41.0, 0),
-        (46.0, 0),
-        (51.0, 0),
-        (56.0, 0),
-        (61.0, 0),
-        (66.0, 0),
-        (71.0, 0),
-        (76.0, 0),
-        (81.0, 0),
-        (86.0, 0),
-        (91.0, 0),
-        (96.0, 0),
-    ]
-
-
-def test_volume_convertion_invalid_increase():
-    assert volumeConversion(0.2, 0.9, 0) == [
-        (20.0, 100.0),
-        (25.0, 80.0),
-        (30.0, 66.66),
-        (35.0, 57.14),
-        (40.0, 50.0),
-        (45.0, 44.44),
-        (50.0, 40.0),
-        (55.0, 36.36),
-        (60.0, 33.33),
-        (65.0, 30.76),
-        (70.0, 28.57),
-        (75.0, 26.66),
-        (80.0, 25.0),
-        (85.0, 23.52),
-        (90.0, 22.22),
-        (95.0, 21.05),
-        (100.0, 20.0),
-    ]
-
-
-def test_volume_convertion_invalid_decrease():
-    assert volumeConversion(0.8, -0.9, 0) == [
-        (80.0, 100.0),
-        (75.0, 100),
-        (70.0, 100),
-        (65.0, 100),
-        (60.0, 100),
-        (55.0, 100),
-        (50.0, 100),
-        (45.0, 100),
-        (40.0, 100),
-        (35.0, 100),
-        (30.0, 100),
-        (25.0, 100),
-        (20.0, 100),
-        (15.0, 100),
-        (10.0, 100),
-        (5.0, 100),
-        (0, 100)
-    ]
-
-
-def test_volume_convertion_from20_to80():
-    assert volumeConversion(0.2, 0.8, 0) == [
-        (20.0, 100.0),
-        (25.0, 80.0),
-        (30.0, 66.66),
-        (35.0, 57.14),
-        (40.0, 50.0),
-        (45.0, 44.44),
-        (50.0, 40.0),
-        (55.0, 36.36),
-        (60.0, 33.33),
-        (65.0, 30.76),
-        (70.0, 28.57),
-        (75.0, 26.66),
-        (80.0, 25.0),
-        (85.0, 23.52),
-        (90.0, 22.22),
-        (95.0, 21.05),
-        (100.0, 20.0),
-    ]
-
-
-def test_volume_convertion_from20_factor01():
-    assert volumeConversion(0.2, 0.8, 0.1) == [
-        (20.0, 100.0),
-        (25.0, 67.42),
-        (30.0, 47.23),
-        (35.0, 33.7),
-        (40.0, 24.07),
-        (45.0, 16.89),
-        (50.0, 11.36),
-        (55.0, 6.98),
-        (60.0, 3.42),
-        (65.0, 0.48),
-        (70.0, 0),
-        (75.0, 0),
-        (80.0, 0),
-        (85.0, 0),
-        (90.0, 0),
-        (95.0, 0),
-        (100.0, 0),
-    ]
-
-
-def test_volume_convertion_from20_factor02():
-    assert volumeConversion(0.2, 0.8, 0.2) == [
-        (20.0, 100.0),
-        (25.0, 69.42),
-        (30.0, 50.56),
-        (35.0, 37.98),
-        (40.0, 29.07),
-        (45.0, 22.45),
-        (50.0, 17.36),
-        (55.0, 13.34),
-        (60.0, 10.09),
-        (65.0, 7.4),
-        (70.0, 5.15),
-        (75.0, 3.24),
-        (80.0, 1.6),
-        (85.0, 0.17),
-        (90.0, 0),
-        (95.0, 0),
-        (100.0, 0),
-    ]
-
-
-
-def test_volume_convertion_from20_factor03():
-    assert volumeConversion(0.2, 0.8, 0.3) == [
-        (20.0, 100.0),
-        (25.0, 71.42),
-        (30.0, 53.9),
-        (35.0, 42.27),
-        (40.0, 34.07),
-        (45.0, 28.01),
-        (50.0, 23.36),
-        (55.0, 19.71),
-        (60.0, 16.75),
-        (65.0, 14.33),
-        (70.0, 12.3),
-        (75.0, 10.57),
-        (80.0, 9.1),
-        (85.0, 7.82),
-        (90.0, 6.69),
-        (95.0, 5.71),
-        (100.0, 4.83),
-    ]
-
-
-def test_volume_convertion_from50_factor03():
-    assert volumeConversion(0.5, 0.8, 0.3) == [
-        (50.0, 100.0),
-        (55.0, 86.76),
-        (60.0, 76.02),
-        (65.0, 67.26),
-        (70.0, 59.99),
-        (75.0, 53.9),
-        (80.0, 48.71),
-        (85.0, 44.26),
-        (90.0, 40.41),
-        (95.0, 37.03),
-        (100.0, 34.07),
-    ]
-
-
-def test_volume_convertion_from80_factor03():
-    assert volumeConversion(0.8, 0.8, 0.3) == [
-        (80.0, 100.0),
-        (85.0, 91.42),
-        (90.0, 83.86),
-        (95.0, 77.24),
-        (100.0, 71.42),
-    ]
-
-
-@pytest.mark.skip(reason="Comment this to plot the graphs")
-def test_volume_convertion_plot_graphs():
-    numbers = volumeConversion(0.2, 0.8, 0.1)
-    numbers2 = volumeConversion(0.2, 0.8, 0.2)
-    numbers3 = volumeConversion(0.2, 0.8, 0.0)
-
-    print(f'\n{numbers}\n{numbers2}\n{numbers3}')
-
-    #  Cannot mix incompatible Qt library (version 0x50907) with this library
-    result = runpython(f"""
-import matplotlib.pyplot as pyplot
-numbers = {numbers}
-numbers2 = {numbers2}
-numbers3 = {numbers3}
-x = [item[0] for item in numbers]
-y = [item[1] for item in numbers]
-x2 = [item[0] for item in numbers2]
-y2 = [item[1] for item in numbers2]
-x3 = [item[0] for item in numbers3]
-y3 = [item[1] for item in numbers3]
-pyplot.plot(x, y)
-pyplot.plot(x2, y2)
-pyplot.plot(x3, y3)
-pyplot.xlabel('x - axis')
-pyplot.ylabel('y - axis')
-pyplot.title('My first graph!')
-pyplot.show()
-""" )
+    return tuple(systemRangeFull)
 
 
-# Copied python implementation to Start it as a daemon to not block qt from exiting!
-class Timer(threading.Thread):
-    """Call a function after a specified number of seconds:
-            t = Timer(30.0, f, args=None, kwargs=None)
-            t.start()
-            t.cancel()     # stop the timer's action if it's still waiting
+def volumeConversion(defaultSystemVolume, volumeIncrease, factor):
+    """ Returns the list of (system volume, application volume) pairs, in percent, to increase the
+    system volume by `volumeIncrease` while keeping the application loudness about the same. """
+    return list(volumeCurve(defaultSystemVolume, volumeIncrease, factor))
+
+
+def volumeCurves(parameters):
+    """ Returns the `volumeCurve()` for each (defaultSystemVolume, volumeIncrease, factor) on
+    `parameters`. Each distinct curve is computed once, by the same `math` operations as
+    `volumeConversion()`, and the repeated ones are looked up on that table, even when there are
+    more of them than the `volumeCurve()` cache holds. """
+    parameters = [tuple(arguments) for arguments in parameters]
+    curves = {arguments: volumeCurve(*arguments) for arguments in dict.fromkeys(parameters)}
+    return [curves[arguments] for arguments in parameters]
+
+
+class TimerHandle(object):
+    """ A callback scheduled on a `TimerService`, which can be cancelled or rescheduled. """
+
+    def __init__(self, service, function, args, kwargs):
+        self.service = service
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.deadline = None
+        self.generation = 0
+
+    @property
+    def active(self):
+        return self.deadline is not None
+
+    def cancel(self):
+        self.service.cancel( self )
+
+    def reschedule(self, interval):
+        self.service.reschedule( self, interval )
+
+    def __repr__(self):
+        remaining = "inactive" if self.deadline is None else f"in {self.deadline - self.service.clock():.3f}s"
+        return f"<TimerHandle {getattr(self.function, '__name__', self.function)} {remaining}>"
+
+
+class TimerService(object):
+    """ Runs scheduled callbacks from a heap of monotonic deadlines.
+
+    `runDue()` must be called when the next deadline passes, i.e., by a `QtTimerServiceDriver`, so
+    all callbacks run on the same thread, instead of one thread per timer. Cancelling only marks the
+    heap entry as stale, it is dropped when it reaches the top of the heap.
     """
-    def __init__(self, interval, function, args=None, kwargs=None):
-        threading.Thread.__init__(self, daemon=True)
+
+    def __init__(self, clock=monotonicClock):
+        self.clock = clock
+        self.heap = []
+        self.stale = 0
+        self.sequence = 0
+        self.lock = threading.RLock()
+        self.wakeup = lambda: None
+
+    def schedule(self, interval, function, *args, **kwargs):
+        handle = TimerHandle( self, function, args, kwargs )
+        self.reschedule( handle, interval )
+        return handle
+
+    def reschedule(self, handle, interval):
+        with self.lock:
+            self.cancel( handle )
+            handle.deadline = self.clock() + interval
+            self.sequence += 1
+            heapq.heappush( self.heap, ( handle.deadline, self.sequence, handle.generation, handle ) )
+
+            if self.stale > 32 and self.stale > len( self.heap ) // 2:
+                self.heap = [entry for entry in self.heap if entry[2] == entry[3].generation and entry[3].active]
+                heapq.heapify( self.heap )
+                self.stale = 0
+        self.wakeup()
+
+    def cancel(self, handle):
+        with self.lock:
+            if handle.active:
+                self.stale += 1
+            handle.generation += 1
+            handle.deadline = None
+
+    def pending(self):
+        with self.lock:
+            return len( self.heap ) - self.stale
+
+    def nextDeadline(self):
+        with self.lock:
+            while self.heap:
+                deadline, sequence, generation, handle = self.heap[0]
+                if generation == handle.generation and handle.active:
+                    return deadline
+                heapq.heappop( self.heap )
+                self.stale -= 1
+        return None
+
+    def runDue(self):
+        """ Runs the callbacks whose deadline passed, returning the next deadline or None. """
+        while True:
+            with self.lock:
+                deadline = self.nextDeadline()
+                if deadline is None or deadline > self.clock():
+                    return deadline
+                handle = heapq.heappop( self.heap )[3]
+                lateness = self.clock() - handle.deadline
+                handle.deadline = None
+
+            name = getattr( handle.function, "__name__", "timer" )
+            instrumentCount( name, "timerFires" )
+            g_metrics.record( f"timer.{name}.lateness", lateness )
+            try:
+                with profileCallback( f"timer.{getattr( handle.function, '__qualname__', name )}" ):
+                    handle.function( *handle.args, **handle.kwargs )
+            except Exception:
+                log.exception( f'{handle} failed' )
+
+
+class Profiler(object):
+    """ Measures the calls, wall and CPU time of each callback, i.e., the Qt events and slots, the
+    timer service and the GUI dispatcher callbacks. The nested callbacks are also counted on their
+    callers. The GUI thread stacks are sampled every `interval` seconds for the flamegraph, or with
+    `deterministic`, all of its calls are profiled by cProfile, which is slower. """
+
+    def __init__(self, prefix, interval=0.005, deterministic=False, thread=None):
+        self.prefix = pathlib.Path( prefix )
         self.interval = interval
+        self.deterministic = deterministic
+        self.threadId = ( thread or threading.current_thread() ).ident
+        self.lock = threading.Lock()
+        self.callbacks = collections.defaultdict( lambda: [0, 0.0, 0.0, 0.0] )
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.profile = None
+        self.started = time.perf_counter()
+
+    def start(self):
+        if self.deterministic:
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            startThread( "profiler", self.sample )
+
+    def stop(self):
+        self.stopped.set()
+        if self.profile is not None:
+            self.profile.disable()
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.thread_time() - cpu
+            with self.lock:
+                stats = self.callbacks[name]
+                stats[0] += 1
+                stats[1] += wall
+                stats[2] += cpu
+                stats[3] = max( stats[3], wall )
+
+    def sample(self):
+        while not self.stopped.wait( self.interval ):
+            frame = sys._current_frames().get( self.threadId )
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append( f"{pathlib.Path( code.co_filename ).name}:{code.co_name}" )
+                frame = frame.f_back
+            if names:
+                with self.lock:
+                    self.stacks[";".join( reversed( names ) )] += 1
+
+    def foldedStacks(self):
+        """ The `stack count` lines read by flamegraph.pl and speedscope. """
+        if self.profile is not None:
+            return self.profileStacks()
+        with self.lock:
+            return [f"{stack} {count}" for stack, count in sorted( self.stacks.items() )]
+
+    def profileStacks(self):
+        import pstats
+        stats = pstats.Stats( self.profile ).stats
+
+        def name(function):
+            filename, line, function = function
+            return f"{pathlib.Path( filename ).name}:{function}"
+
+        # cProfile only keeps the callers, so each stack is a caller and callee pair, in microseconds
+        lines = []
+        for function, ( calls, primitive, ownTime, totalTime, callers ) in sorted( stats.items() ):
+            lines.append( f"{name( function )} {max( int( ownTime * 1e6 ), 1 )}" )
+            for caller, callerStats in callers.items():
+                lines.append( f"{name( caller )};{name( function )} {max( int( callerStats[2] * 1e6 ), 1 )}" )
+        return lines
+
+    def report(self):
+        with self.lock:
+            callbacks = sorted( self.callbacks.items(), key=lambda item: item[1][1], reverse=True )
+        lines = [f"{time.perf_counter() - self.started:.1f}s profiled, the callers include their nested callbacks",
+                f"{'calls':>8} {'wall ms':>10} {'mean ms':>9} {'max ms':>9} {'cpu ms':>10}  callback"]
+        for name, ( calls, wall, cpu, maximum ) in callbacks:
+            lines.append( f"{calls:>8} {wall * 1000:>10.1f} {wall * 1000 / calls:>9.3f} "
+                    f"{maximum * 1000:>9.1f} {cpu * 1000:>10.1f}  {name}" )
+        return lines
+
+    def write(self):
+        """ Writes the `prefix.txt` report and the `prefix.folded` stacks, returning their paths. """
+        report = self.prefix.with_name( self.prefix.name + ".txt" )
+        folded = self.prefix.with_name( self.prefix.name + ".folded" )
+        report.write_text( "\n".join( self.report() ) + "\n" )
+        folded.write_text( "\n".join( self.foldedStacks() ) + "\n" )
+        log( f'Wrote the profile {report} and {folded}' )
+        return report, folded
+
+
+g_profiler = [None]
+
+
+def profileCallback(name):
+    """ Measures the callback `name` when running with --profile, i.e., `with profileCallback("tray"):` """
+    profiler = g_profiler[0]
+    return contextlib.nullcontext() if profiler is None else profiler.measure( name )
+
+
+def profiled(function):
+    """ Decorates the slots, so their calls are measured by `profileCallback()`. """
+    name = function.__qualname__
+
+    @functools.wraps( function )
+    def wrapper(*args, **kwargs):
+        if g_profiler[0] is None:
+            return function( *args, **kwargs )
+        with profileCallback( name ):
+            return function( *args, **kwargs )
+    return wrapper
+
+
+def startProfiler(prefix, interval=0.005, deterministic=False):
+    """ Starts the profiler, which writes its report on exit and on SIGUSR1, or SIGBREAK on Windows. """
+    import signal
+    profiler = g_profiler[0] = Profiler( prefix, interval, deterministic )
+    profiler.start()
+
+    def stop():
+        profiler.stop()
+        profiler.write()
+
+    atexit.register( stop )
+    dumpSignal = getattr( signal, "SIGUSR1", None ) or getattr( signal, "SIGBREAK", None )
+    if dumpSignal is not None:
+        signal.signal( dumpSignal, lambda number, frame: profiler.write() )
+        wakeOnSignals()
+    return profiler
+
+
+g_signalWakeup = [None]
+
+
+def wakeOnSignals():
+    """ Python only runs the signal handlers on its next bytecode, which never comes while the Qt
+    event loop waits idle, so the signals are also written to a socket the loop watches, and reading
+    it runs them. Requires the QApplication. """
+    import signal
+    import socket
+    if g_signalWakeup[0] is None:
+        reader, writer = socket.socketpair()
+        reader.setblocking( False )
+        writer.setblocking( False )
+        signal.set_wakeup_fd( writer.fileno() )
+        notifier = QtCore.QSocketNotifier( reader.fileno(), QtCore.QSocketNotifier.Read )
+        notifier.activated.connect( lambda *arguments: reader.recv( 1024 ) )
+        g_signalWakeup[0] = ( reader, writer, notifier )
+    return g_signalWakeup[0][2]
+
+
+class ProfilingApplication(QApplication):
+    """ Measures each Qt event delivery, by receiver class and event type, when running with --profile. """
+    eventNames = {value: name for name, value in vars( QtCore.QEvent ).items() if isinstance( value, QtCore.QEvent.Type )}
+
+    def notify(self, receiver, event):
+        name = f"{type( receiver ).__name__}.{self.eventNames.get( event.type(), event.type() )}"
+        with profileCallback( name ):
+            return super( ProfilingApplication, self ).notify( receiver, event )
+
+
+class GuiDispatcher(QtCore.QObject):
+    """ Runs the functions posted from any thread on the thread which created it, i.e., the GUI one.
+
+    Only the latest pending post of each `key` runs, so when the GUI thread stalls, it finds one
+    request per key, instead of replaying the burst of them. All the pending posts are run by a
+    single queued signal, which is only emitted when there was nothing pending.
+    """
+    drainRequested = pyqtSignal( [] )
+
+    def __init__(self, metrics=None, parent=None):
+        super(GuiDispatcher, self).__init__( parent )
+        self.metrics = metrics or g_metrics
+        self.lock = threading.Lock()
+        self.pending = collections.OrderedDict()
+        self.requested = False
+        self.drainRequested.connect( self.drain, Qt.QueuedConnection )
+
+    def post(self, key, function, *args):
+        """ Runs `function(*args)` on the GUI thread, replacing the pending post with the same
+        `key`, unless it is None. """
+        with self.lock:
+            if key is None:
+                key = object()
+            elif self.pending.pop( key, None ) is not None:
+                self.metrics.count( "gui.coalesced" )
+            self.pending[key] = ( function, args, time.perf_counter() )
+            self.metrics.gauge( "gui.queueDepth", len( self.pending ) )
+
+            request = not self.requested
+            self.requested = True
+
+        if request:
+            self.drainRequested.emit()
+
+    @profiled
+    def drain(self):
+        with self.lock:
+            pending, self.pending = self.pending, collections.OrderedDict()
+            self.requested = False
+            self.metrics.gauge( "gui.queueDepth", 0 )
+
+        for function, args, posted in pending.values():
+            self.metrics.record( "gui.dispatchLatency", time.perf_counter() - posted )
+            try:
+                with profileCallback( f"gui.{getattr( function, '__qualname__', function )}" ):
+                    function( *args )
+            except Exception:
+                log.exception( f'{function} failed' )
+
+
+class QtTimerServiceDriver(QtCore.QObject):
+    """ Calls `TimerService.runDue()` on the Qt event loop thread, using a single QTimer. """
+
+    # Bounds how late a deadline can be noticed when the Qt timer does not count a system suspend
+    maximumInterval = 60
+
+    def __init__(self, service, dispatcher=None, parent=None):
+        super(QtTimerServiceDriver, self).__init__( parent )
+        self.service = service
+        self.dispatcher = dispatcher or GuiDispatcher( parent=self )
+        self.ownerThread = threading.current_thread()
+        self.timer = QTimer( self )
+        self.timer.setSingleShot( True )
+        self.timer.setTimerType( Qt.PreciseTimer )
+        self.timer.timeout.connect( self.runDue )
+        service.wakeup = self.wakeup
+        self.rearm()
+
+    def wakeup(self):
+        # The other threads scheduling callbacks only need one rearm, after the last of them
+        if threading.current_thread() is self.ownerThread:
+            self.rearm()
+        else:
+            self.dispatcher.post( "timerService.rearm", self.rearm )
+
+    @profiled
+    def runDue(self):
+        with instrumentWakeup( "timerService" ):
+            self.service.runDue()
+            self.rearm()
+
+    def rearm(self):
+        deadline = self.service.nextDeadline()
+        if deadline is None:
+            self.timer.stop()
+            return
+        interval = min( max( deadline - self.service.clock(), 0 ), self.maximumInterval )
+        self.timer.start( math.ceil( interval * 1000 ) )
+
+
+class Histogram(object):
+    """ Counts the values, i.e., latencies in seconds, on exponential buckets from 0.1 ms to 14
+    minutes, so the percentiles are estimated without keeping the values. """
+    bounds = tuple( 0.0001 * 2 ** index for index in range( 24 ) )
+
+    def __init__(self):
+        self.buckets = [0] * ( len( self.bounds ) + 1 )
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        self.buckets[bisect.bisect_left( self.bounds, value )] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min( self.min, value )
+        self.max = value if self.max is None else max( self.max, value )
+
+    def percentile(self, fraction):
+        """ The upper bound of the bucket holding the `fraction` percentile, limited by the maximum. """
+        rank = math.ceil( fraction * self.count )
+        seen = 0
+        for index, count in enumerate( self.buckets ):
+            seen += count
+            if count and seen >= rank:
+                return min( self.bounds[index], self.max ) if index < len( self.bounds ) else self.max
+        return None
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.percentile( 0.5 ),
+            "p95": self.percentile( 0.95 ),
+            "p99": self.percentile( 0.99 ),
+        }
+
+
+class Metrics(object):
+    """ The counters and latency histograms of the running application, see --stats. While not
+    `enabled`, i.e., nothing serves them, recording them costs only a call. """
+    untimed = contextlib.nullcontext()
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.gauges = {}
+        self.histograms = collections.defaultdict( Histogram )
+
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] += amount
+
+    def gauge(self, name, value):
+        """ Sets the current `value` of `name`, keeping its maximum as `name.max`. """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges[name] = value
+            self.gauges[f"{name}.max"] = max( value, self.gauges.get( f"{name}.max", value ) )
+
+    def record(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.histograms[name].record( seconds )
+
+    def timed(self, name):
+        if not self.enabled:
+            return self.untimed
+        return self.timing( name )
+
+    @contextlib.contextmanager
+    def timing(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record( name, time.perf_counter() - start )
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": dict( sorted( self.counters.items() ) ),
+                "gauges": dict( sorted( self.gauges.items() ) ),
+                "histograms": {name: histogram.snapshot() for name, histogram in sorted( self.histograms.items() )},
+            }
+
+
+g_metrics = Metrics( enabled=False )
+
+
+def serveMetrics(port, metrics=None):
+    """ Serves the `Metrics.snapshot()` as json on http://127.0.0.1:port/metrics, from a thread. """
+    import http.server
+    metrics = metrics or g_metrics
+    metrics.enabled = True
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip( "/" ) not in ( "", "/metrics" ):
+                self.send_error( 404 )
+                return
+            body = json.dumps( metrics.snapshot(), indent=4 ).encode( "UTF-8" )
+            self.send_response( 200 )
+            self.send_header( "Content-Type", "application/json" )
+            self.send_header( "Content-Length", str( len( body ) ) )
+            self.end_headers()
+            self.wfile.write( body )
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer( ( "127.0.0.1", port ), MetricsHandler )
+    startThread( "metrics", server.serve_forever )
+    return server
+
+
+def fetchMetrics(port, timeout=5):
+    import urllib.request
+    with urllib.request.urlopen( f"http://127.0.0.1:{port}/metrics", timeout=timeout ) as response:
+        return json.load( response )
+
+
+class Instrumentation(object):
+    """ Counts, per component, the wakeups, i.e., its Qt timer or thread loop running, the timer
+    service callbacks, the threads and the processes it started, and the CPU time its wakeups used.
+    The Qt internal and the operating system wakeups are not seen, only the ones running Python. """
+    # The eye rest and the volume ramps are not idle, so their intervals are not checked for the budget
+    busyComponents = {"eyeRest", "volumeRamps", "speech"}
+
+    def __init__(self, idleWakeupBudget=5, clock=monotonicClock, cpuClock=time.thread_time):
+        self.idleWakeupBudget = idleWakeupBudget
+        self.clock = clock
+        self.cpuClock = cpuClock
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict( collections.Counter )
+        self.started = clock()
+
+    def count(self, component, event, amount=1):
+        with self.lock:
+            self.counters[component][event] += amount
+
+    @contextlib.contextmanager
+    def wakeup(self, component):
+        start = self.cpuClock()
+        try:
+            yield
+        finally:
+            cpuTime = self.cpuClock() - start
+            with self.lock:
+                counters = self.counters[component]
+                counters["wakeups"] += 1
+                counters["cpuTime"] += cpuTime
+
+    def summary(self, reset=True):
+        """ Returns the counters since the last reset, with the wakeups per minute of all components. """
+        with self.lock:
+            now = self.clock()
+            seconds = max( now - self.started, 1e-9 )
+            components = {name: dict( counters ) for name, counters in sorted( self.counters.items() )}
+            if reset:
+                self.counters.clear()
+                self.started = now
+
+        wakeups = sum( counters.get( "wakeups", 0 ) for counters in components.values() )
+        idle = not self.busyComponents.intersection( components )
+        return {"seconds": seconds, "wakeupsPerMinute": wakeups * 60 / seconds, "idle": idle, "components": components}
+
+    def report(self):
+        summary = self.summary()
+        components = ", ".join( f"{name} " + " ".join(
+                f"{event} {value * 1000:.1f}ms" if event == "cpuTime" else f"{event} {value}"
+                for event, value in counters.items() ) for name, counters in summary["components"].items() )
+        log( f'{summary["wakeupsPerMinute"]:.1f} wakeups per minute in {summary["seconds"]:.0f}s: {components}' )
+
+        if summary["idle"] and summary["wakeupsPerMinute"] > self.idleWakeupBudget:
+            log.warning( f'The idle wakeups, {summary["wakeupsPerMinute"]:.1f} per minute, '
+                    f'are over the budget of {self.idleWakeupBudget} per minute' )
+        return summary
+
+
+g_instrumentation = [None]
+
+
+def instrumentWakeup(component):
+    """ Measures the wakeup of `component` when running with --instrument, i.e., `with instrumentWakeup("tray"):` """
+    instrumentation = g_instrumentation[0]
+    return contextlib.nullcontext() if instrumentation is None else instrumentation.wakeup( component )
+
+
+def instrumentCount(component, event):
+    instrumentation = g_instrumentation[0]
+    if instrumentation is not None:
+        instrumentation.count( component, event )
+
+
+def startInstrumentation(interval, idleWakeupBudget, timerService=None):
+    """ Starts counting and logs a summary every `interval` seconds. """
+    timerService = timerService or g_timerService
+    g_instrumentation[0] = Instrumentation( idleWakeupBudget )
+
+    def report():
+        g_instrumentation[0].report()
+        handle.reschedule( interval )
+
+    handle = timerService.schedule( interval, report )
+    return handle
+
+
+def startThread(component, target, *args):
+    """ Starts a daemon thread named after `component`, counting it on the instrumentation. """
+    instrumentCount( component, "threads" )
+    thread = threading.Thread( target=target, args=args, name=component, daemon=True )
+    thread.start()
+    return thread
+
+
+class LaneTask(object):
+    """ A function submitted to a `LaneExecutor` lane, which is also its cancellation token. """
+
+    def __init__(self, lane, function, args):
+        self.lane = lane
         self.function = function
-        self.args = args if args is not None else []
-        self.kwargs = kwargs if kwargs is not None else {}
+        self.args = args
+        self.result = None
+        self.exception = None
+        self.cancelled = threading.Event()
         self.finished = threading.Event()
 
     def cancel(self):
-        """Stop the timer if it hasn't finished yet."""
-        self.finished.set()
+        """ Skips the task when it did not start yet. Running functions can check `cancelled`. """
+        self.cancelled.set()
 
-    def run(self):
-        self.finished.wait(self.interval)
-        if not self.finished.is_set():
-            self.function(*self.args, **self.kwargs)
+    def wait(self, timeout=None):
+        return self.finished.wait( timeout )
+
+    def run(self, metrics):
+        if self.cancelled.is_set():
+            metrics.count( f"executor.{self.lane}.cancelled" )
+        else:
+            start = time.perf_counter()
+            try:
+                self.result = self.function( *self.args )
+            except Exception as error:
+                self.exception = error
+                log.exception( f'{self} failed' )
+            metrics.record( f"executor.{self.lane}.duration", time.perf_counter() - start )
         self.finished.set()
 
+    def __repr__(self):
+        return f"<LaneTask {self.lane} {getattr( self.function, '__qualname__', self.function )}>"
+
+
+class LaneExecutor(object):
+    """ Runs the submitted functions on named lanes, as audio, speech and io, each one with at most
+    `limits[lane]` threads and `maxQueued` waiting tasks. The lower `priority` tasks run first. The
+    threads exit when their lane has nothing queued, and `shutdown()` waits for all of them, so the
+    volume restores are not killed with the application. """
+
+    def __init__(self, limits, maxQueued=100, metrics=None):
+        self.limits = dict( limits )
+        self.maxQueued = maxQueued
+        self.metrics = metrics or g_metrics
+        self.queues = {lane: [] for lane in self.limits}
+        self.workers = dict.fromkeys( self.limits, 0 )
+        self.sequence = itertools.count()
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def submit(self, lane, function, *args, priority=0):
+        """ Returns the `LaneTask` running `function(*args)`, or raises `queue.Full` when the
+        lane has too many tasks waiting, so the callers can drop them instead of piling up. """
+        task = LaneTask( lane, function, args )
+
+        with self.condition:
+            if self.closed:
+                raise RuntimeError( f'Submitting {task} after the shutdown' )
+
+            waiting = self.queues[lane]
+            if len( waiting ) >= self.maxQueued:
+                self.metrics.count( f"executor.{lane}.rejected" )
+                raise queue.Full( f'The {lane} lane has {len( waiting )} tasks waiting' )
+
+            heapq.heappush( waiting, ( priority, next( self.sequence ), task ) )
+            self.metrics.gauge( f"executor.{lane}.queued", len( waiting ) )
+            if self.workers[lane] < self.limits[lane]:
+                self.workers[lane] += 1
+                startThread( lane, self.work, lane )
+        return task
+
+    def work(self, lane):
+        waiting = self.queues[lane]
+        while True:
+            with self.condition:
+                if not waiting:
+                    self.workers[lane] -= 1
+                    self.condition.notify_all()
+                    return
+                priority, sequence, task = heapq.heappop( waiting )
+                self.metrics.gauge( f"executor.{lane}.queued", len( waiting ) )
+            task.run( self.metrics )
+
+    def drain(self, timeout=None):
+        """ Waits for the queued and running tasks, returning False on `timeout`. """
+        with self.condition:
+            return self.condition.wait_for( lambda: not any( self.workers.values() ), timeout )
+
+    def shutdown(self, timeout=None):
+        """ Refuses the new tasks and drains the submitted ones. """
+        with self.condition:
+            self.closed = True
+        drained = self.drain( timeout )
+        if not drained:
+            log( f'The executor did not drain in {timeout} seconds, {self.workers}' )
+        return drained
+
+
+g_laneExecutor = LaneExecutor( {"audio": 1, "speech": 1, "io": 2} )
+g_timerService = TimerService()
+
+
+class SingleInstanceServer(QtCore.QObject):
+    """ Runs the commands sent by the next launches, see sendInstanceCommand(), one per line. """
+
+    def __init__(self, handlers, address=None, parent=None):
+        super(SingleInstanceServer, self).__init__( parent )
+        from PyQt5.QtNetwork import QLocalServer
+        self.handlers = handlers
+        self.address = address or instanceAddress()
+        self.server = QLocalServer( self )
+        self.server.setSocketOptions( QLocalServer.UserAccessOption )
+        self.server.newConnection.connect( self.acceptConnections )
+
+    def listen(self):
+        # Some Qt versions replace the socket file of the running instance, so first check for it
+        if sendInstanceCommand( "", self.address ):
+            log( f'Another instance is listening on {self.address}' )
+            return False
+
+        if self.server.listen( self.address ):
+            return True
+
+        # The socket file of a crashed instance is left behind, and nobody answers on it
+        self.server.removeServer( self.address )
+        return self.server.listen( self.address )
+
+    def acceptConnections(self):
+        while self.server.hasPendingConnections():
+            connection = self.server.nextPendingConnection()
+            connection.readyRead.connect( lambda connection=connection: self.readCommands( connection ) )
+            connection.disconnected.connect( connection.deleteLater )
+            self.readCommands( connection )
+
+    @profiled
+    def readCommands(self, connection):
+        while connection.canReadLine():
+            command = bytes( connection.readLine() ).decode( "UTF-8", errors="replace" ).strip()
+            if command in self.handlers:
+                log( f'Running the instance command {command}' )
+                self.handlers[command]()
+            elif command:
+                log( f'Ignoring the unknown instance command {command!r}' )
+
+    def close(self):
+        self.server.close()
+
+
+class EyeRestCycle(object):
+    """ The eye rest loop. Once started, it runs the cues of its routine, by default, saving the
+    volume, speaking the seconds, playing the alarm and restoring the volume on the first minute,
+    then it shows the window after SHOW_WINDOW_INTERVAL, and again every AUTORESTARTINTERVAL until
+    the window is closed to start the next eye rest.
+
+    It has no Qt, `window` is the `MainWindow`, or anything with the same methods, and all the
+    waiting is done by `timerService`, so a full day runs in a moment with a `VirtualClock`.
+    Only the next cue is scheduled, so the routine size does not matter, and the counter only
+    ticks while it is visible.
+    """
+    defaultRoutine = (
+        {"at": 1, "do": "saveVolume"},
+        {"at": 10, "do": "speak", "text": "10 seconds"},
+        {"at": 20, "do": "speak", "text": "20 seconds"},
+        {"at": 30, "do": "speak", "text": "30 seconds"},
+        {"at": ALARM_TIMEOUT * 10, "do": "playCue", "name": "alarm"},
+        {"at": 46, "do": "restoreVolume"},
+        {"at": 56, "do": "nextLoop"},
+    )
+
+    # The routine actions, with the name of their argument
+    actions = {
+        "saveVolume": None,
+        "restoreVolume": None,
+        "speak": "text",
+        "playCue": "name",
+        "nextLoop": None,
+    }
+
+    def __init__(self, window, timerService=None, routine=None, history=None):
+        self.window = window
+        self.timerService = timerService or g_timerService
+        self.routine = getRoutine() if routine is None else routine
+        self.history = history
+        self.shownSinceReset = False
+        self.nextCue = 0
+        self.elapsedBefore = 0.0
+        self.runningSince = None
+        self.cueTimer = None
+        self.tickTimer = None
+        self.eyeRestTimer = None
+        self.reinforcementTimer = None
+
+    @property
+    def counting(self):
+        return self.runningSince is not None
+
+    def record(self, kind):
+        if self.history is not None:
+            self.history.append( kind, self.elapsed() )
+
+    @property
+    def counterValue(self):
+        return int(self.elapsed())
+
+    def elapsed(self):
+        if self.runningSince is None:
+            return self.elapsedBefore
+        return self.elapsedBefore + self.timerService.clock() - self.runningSince
+
+    def runCues(self):
+        with instrumentWakeup("eyeRest"):
+            # Tolerates the rounding of the deadline, which could wake up a moment early
+            elapsed = self.elapsed() + 1e-6
+            try:
+                while self.counting and self.nextCue < len(self.routine) and self.routine[self.nextCue].offset <= elapsed:
+                    cue = self.routine[self.nextCue]
+                    self.nextCue += 1
+                    self.runCue(cue)
+            finally:
+                self.scheduleCue()
+
+    def runCue(self, cue):
+        # A failing cue, e.g., a missing sound, must not drop the next ones, as the volume restore
+        try:
+            if cue.action == "nextLoop":
+                self.record("completion")
+                self.nextLoop()
+            elif cue.argument is None:
+                getattr(self.window, cue.action)()
+            else:
+                getattr(self.window, cue.action)(cue.argument)
+        except Exception:
+            log.exception(f'The eye rest cue {cue} failed')
+
+    def scheduleCue(self):
+        if self.counting and self.nextCue < len(self.routine):
+            interval = max(self.routine[self.nextCue].offset - self.elapsed(), 0)
+            if self.cueTimer is None:
+                self.cueTimer = self.timerService.schedule(interval, self.runCues)
+            else:
+                self.cueTimer.reschedule(interval)
+
+        elif self.cueTimer is not None:
+            self.cueTimer.cancel()
+
+    def tick(self):
+        with instrumentWakeup("eyeRest"):
+            self.window.setEyeRestCounter(self.counterValue)
+            self.updateTicking()
+
+    def updateTicking(self):
+        """ Updates the counter on each whole second, while it is counting and visible. """
+        if self.counting and self.window.isVisible():
+            interval = 1 - self.elapsed() % 1
+            if interval < 0.001:
+                interval += 1
+            if self.tickTimer is None:
+                self.tickTimer = self.timerService.schedule(interval, self.tick)
+            elif not self.tickTimer.active:
+                self.tickTimer.reschedule(interval)
+
+        elif self.tickTimer is not None:
+            self.tickTimer.cancel()
+
+    def start(self):
+        if not self.counting:
+            self.runningSince = self.timerService.clock()
+            self.record("start")
+        self.scheduleCue()
+        self.updateTicking()
+
+    def pause(self):
+        if self.counting:
+            self.record("pause")
+        self.elapsedBefore = self.elapsed()
+        self.runningSince = None
+        self.window.setEyeRestCounter(self.counterValue)
+        self.scheduleCue()
+        self.updateTicking()
+
+    def reset(self):
+        self.record("reset")
+        self.shownSinceReset = False
+        self.nextCue = 0
+        self.elapsedBefore = 0.0
+        if self.counting:
+            self.runningSince = self.timerService.clock()
+        self.window.setEyeRestCounter(self.counterValue)
+        self.scheduleCue()
+        self.updateTicking()
+
+    def windowShown(self):
+        self.window.setEyeRestCounter(self.counterValue)
+        self.updateTicking()
+
+    def windowClosed(self):
+        if self.shownSinceReset:
+            self.record("dismissal")
+            self.shownSinceReset = False
+
+        if self.eyeRestTimer is None and self.counting:
+            self.nextLoop()
+
+    def nextLoop(self):
+        log(f'eyeRestTimer {self.eyeRestTimer}, counting {self.counting}')
+
+        if self.eyeRestTimer is not None:
+            self.eyeRestTimer.cancel()
+            self.eyeRestTimer = None
+
+        if self.counting:
+            self.eyeRestTimer = self.timerService.schedule( SHOW_WINDOW_INTERVAL, self.showWindow )
+
+    def showWindow(self):
+        log(f'eyeRestTimer {self.eyeRestTimer}, counting {self.counting}')
+
+        self.window.showUp()
+        self.eyeRestTimer = None
+        self.shownSinceReset = True
+
+        if self.reinforcementTimer is None:
+            self.reinforcementTimer = self.timerService.schedule( AUTORESTARTINTERVAL, self.reinforce )
+        else:
+            self.reinforcementTimer.reschedule( AUTORESTARTINTERVAL )
+
+    def reinforce(self):
+        log(f'eyeRestTimer {self.eyeRestTimer}, counting {self.counting}')
+
+        if self.eyeRestTimer is None and self.counting:
+            self.showWindow()
+
+
+Cue = collections.namedtuple( "Cue", "offset action argument" )
+
+
+def parseRoutine(entries):
+    """ Returns the `Cue`s of a routine, i.e., the configuration "routine" entry, sorted by their
+    offset in seconds, which can be fractional. """
+    cues = []
+    for entry in entries:
+        action = entry.get( "do" )
+        if action not in EyeRestCycle.actions:
+            raise ValueError( f"Unknown routine action {action!r} on {entry}, use one of {sorted(EyeRestCycle.actions)}" )
+
+        argument = EyeRestCycle.actions[action]
+        if argument is not None and argument not in entry:
+            raise ValueError( f"The routine action {action!r} needs a {argument!r}, on {entry}" )
+        cues.append( Cue( float( entry["at"] ), action, argument and entry[argument] ) )
+    return tuple( sorted( cues, key=lambda cue: cue.offset ) )
+
+
+def getRoutine():
+    entries = g_configuration[0].get( "routine" )
+    if entries is not None:
+        try:
+            return parseRoutine( entries )
+        except ( ValueError, TypeError, KeyError ):
+            log.exception( 'Using the default routine instead of the configured one' )
+    return parseRoutine( EyeRestCycle.defaultRoutine )
+
+
+class EyeRestHistory(object):
+    """ The eye rest events, appended to `filename` as 16 bytes records of the time, the kind and
+    the counted seconds, which are read by memory mapping the file.
+
+    The per day counters, the rollups, are saved to `filename.rollup.json` with how many records
+    they include, so opening months of history only reads the records after the last save. They are
+    saved on each new day, after `saveInterval` records and on close, so a killed application, e.g.,
+    on a logoff, only leaves a few records to read again. The file is opened on the first use, so
+    creating this costs nothing on the startup.
+    """
+    kinds = ( "start", "pause", "reset", "completion", "dismissal" )
+
+    def __init__(self, filename, clock=time.time, saveInterval=20):
+        import struct
+        self.record = struct.Struct( "<dB3xf" )
+        self.filename = pathlib.Path( filename )
+        self.rollupFilename = self.filename.with_name( f"{self.filename.name}.rollup.json" )
+        self.clock = clock
+        self.saveInterval = saveInterval
+        self.file = None
+        self.records = None
+        self.savedRecords = None
+        self.days = None
+
+    def load(self):
+        if self.records is not None:
+            return
+        try:
+            rollup = json.loads( self.rollupFilename.read_text( encoding="UTF-8" ) )
+            records, days = rollup["records"], rollup["days"]
+        except ( OSError, ValueError, KeyError ):
+            records, days = 0, {}
+
+        # A partial record is left by a crash while writing it
+        size = self.filename.stat().st_size if self.filename.exists() else 0
+        if size % self.record.size:
+            size -= size % self.record.size
+            os.truncate( self.filename, size )
+
+        count = size // self.record.size
+        if records > count:
+            records, days = 0, {}
+
+        self.records, self.savedRecords, self.days = records, records, days
+        for timestamp, kind, value in self.read( records, count ):
+            self.rollup( timestamp, kind, value )
+        self.records = count
+
+    def read(self, first=0, last=None):
+        """ Returns the ( timestamp, kind index, seconds ) records from `first` to `last`. """
+        if last is None:
+            self.load()
+            last = self.records
+        if last <= first:
+            return []
+
+        import mmap
+        with open( self.filename, "rb" ) as file, mmap.mmap( file.fileno(), 0, access=mmap.ACCESS_READ ) as memory:
+            return list( self.record.iter_unpack( memory[first * self.record.size:last * self.record.size] ) )
+
+    def rollup(self, timestamp, kind, value):
+        counters = self.days.setdefault( datetime.date.fromtimestamp( timestamp ).isoformat(), {} )
+        name = self.kinds[kind]
+        counters[name] = counters.get( name, 0 ) + 1
+        if name == "completion":
+            counters["restSeconds"] = counters.get( "restSeconds", 0 ) + value
+
+    def append(self, kind, seconds=0.0):
+        self.load()
+        if self.file is None:
+            self.file = open( self.filename, "ab", buffering=0 )
+
+        timestamp = self.clock()
+        self.file.write( self.record.pack( timestamp, self.kinds.index( kind ), seconds ) )
+        self.records += 1
+        newDay = datetime.date.fromtimestamp( timestamp ).isoformat() not in self.days
+        self.rollup( timestamp, self.kinds.index( kind ), seconds )
+        if newDay or self.records - self.savedRecords >= self.saveInterval:
+            self.save()
+
+    def daily(self):
+        self.load()
+        return dict( sorted( self.days.items() ) )
+
+    def lastDays(self, days):
+        """ Returns the `daily()` counters of the last `days` calendar days, today included. """
+        today = datetime.date.fromtimestamp( self.clock() )
+        first = ( today - datetime.timedelta( days=days - 1 ) ).isoformat()
+        return {day: counters for day, counters in self.daily().items() if day >= first}
+
+    def weekly(self):
+        weeks = {}
+        for day, counters in self.daily().items():
+            year, week, weekday = datetime.date.fromisoformat( day ).isocalendar()
+            total = weeks.setdefault( f"{year}-W{week:02}", {} )
+            for name, value in counters.items():
+                total[name] = total.get( name, 0 ) + value
+        return weeks
+
+    def save(self):
+        partial = self.rollupFilename.with_suffix( ".partial" )
+        partial.write_text( json.dumps( {"records": self.records, "days": self.days} ), encoding="UTF-8" )
+        os.replace( partial, self.rollupFilename )
+        self.savedRecords = self.records
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.records is not None and self.records != self.savedRecords:
+            self.save()
+
+
+g_history = [None]
+
+
+def getHistory():
+    if g_history[0] is None:
+        g_history[0] = EyeRestHistory( os.path.join( CURRENT_DIR, "TimeTray.history" ) )
+        atexit.register( lambda: g_history[0] and g_history[0].close() )
+    return g_history[0]
+
+
+def formatHistory(rollups):
+    lines = []
+    for period, counters in rollups.items():
+        events = "  ".join( f"{kind} {counters.get( kind, 0 )}" for kind in EyeRestHistory.kinds )
+        lines.append( f"{period}  {events}  rested {counters.get( 'restSeconds', 0 ):.0f}s" )
+    return "\n".join( lines )
+
+
+class VirtualClock(object):
+    """ A clock which only moves by `advance()`, running the due callbacks of a `TimerService`
+    on their deadlines on the way. """
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds, timerService):
+        end = self.now + seconds
+        while True:
+            deadline = timerService.nextDeadline()
+            if deadline is None or deadline > end:
+                break
+            self.now = max( self.now, deadline )
+            timerService.runDue()
+        self.now = end
+
+
+class SimulatedEyeRestWindow(object):
+    """ Stands for the `MainWindow` and its user on an `EyeRestCycle` run by a `VirtualClock`,
+    recording what the cycle asked for. The user presses Enter `responseDelay` seconds after the
+    window shows up, or never, when it is None. """
+
+    def __init__(self, timerService, responseDelay=5, history=None):
+        self.timerService = timerService
+        self.responseDelay = responseDelay
+        self.cycle = EyeRestCycle( self, timerService, history=history )
+        self.visible = False
+        self.counterValue = 0
+        self.events = []
+        self.response = None
+
+    def record(self, event):
+        self.events.append( ( self.timerService.clock(), event ) )
+
+    def isVisible(self):
+        return self.visible
+
+    def showUp(self):
+        self.record( "show" )
+        self.visible = True
+        self.cycle.windowShown()
+        if self.responseDelay is not None and self.response is None:
+            self.response = self.timerService.schedule( self.responseDelay, self.pressEnter )
+
+    def pressEnter(self):
+        self.response = None
+        self.cycle.reset()
+        self.speak( "beep" )
+        self.close()
+
+    def close(self):
+        self.record( "close" )
+        self.visible = False
+        self.cycle.windowClosed()
+
+    def setEyeRestCounter(self, value):
+        self.counterValue = value
+
+    def playCue(self, name):
+        self.record( f"playCue {name}" )
+
+    def speak(self, text):
+        self.record( f"speak {text}" )
+
+    def saveVolume(self):
+        self.record( "saveVolume" )
+
+    def restoreVolume(self):
+        self.record( "restoreVolume" )
+
+
+def simulateEyeRest(seconds, responseDelay=5, history=None):
+    """ Runs the eye rest cycle for `seconds` on a `VirtualClock`, as started and closed by its
+    user at 0 seconds, returning the recorded ( seconds, event ) list. """
+    clock = VirtualClock()
+    timerService = TimerService( clock )
+    window = SimulatedEyeRestWindow( timerService, responseDelay, history )
+    window.cycle.start()
+    window.close()
+    clock.advance( seconds, timerService )
+    return window.events
+
+
+SoakSample = collections.namedtuple( "SoakSample", "seconds rss tracedMemory objects threads fileDescriptors tempFiles" )
+
+
+def residentMemory():
+    """ The process resident memory in bytes, or None where /proc is not available. """
+    try:
+        with open( "/proc/self/statm" ) as statm:
+            return int( statm.read().split()[1] ) * os.sysconf( "SC_PAGE_SIZE" )
+    except ( OSError, ValueError, AttributeError ):
+        return None
+
+
+def openFileDescriptors():
+    try:
+        return len( os.listdir( "/proc/self/fd" ) )
+    except OSError:
+        return None
+
+
+class SoakTest(object):
+    """ Runs the `MainWindow` and the tray through days of eye rest cycles on a `VirtualClock`, on
+    the running QApplication, with the fake audio backend, the silent speech and sound effects, and a
+    user who presses Enter `responseDelay` seconds after the window shows up. Each simulated
+    `sampleInterval` it samples the process resources, see `SoakSample`. The temporary files go to
+    a new directory, which is only counted and removed at the end. """
+
+    # How much each resource can grow from the middle to the last third of the samples, as an
+    # absolute amount plus a fraction of the middle third maximum. The samples themselves are a
+    # few objects per simulated hour
+    tolerances = {
+        "rss": ( 8 * 2**20, 0.05 ),
+        "tracedMemory": ( 2**20, 0.05 ),
+        "objects": ( 2000, 0.02 ),
+        "threads": ( 2, 0 ),
+        "fileDescriptors": ( 2, 0 ),
+        "tempFiles": ( 2, 0 ),
+    }
+
+    def __init__(self, responseDelay=5, step=60, sampleInterval=3600):
+        self.responseDelay = responseDelay
+        self.step = step
+        self.sampleInterval = sampleInterval
+        self.samples = []
+        self.started = None
+        self.directory = None
+
+    def run(self, days):
+        import tracemalloc
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+
+        saved = ( tempfile.tempdir, g_audioBackend[0], g_audioCues[0], g_speechEngine[0], g_history[0], g_volumeState[0] )
+        with tempfile.TemporaryDirectory( prefix="TimeTraySoak" ) as directory:
+            self.directory = pathlib.Path( directory )
+            tempfile.tempdir = directory
+            try:
+                self.simulate( days )
+            finally:
+                tempfile.tempdir, g_audioBackend[0], g_audioCues[0], g_speechEngine[0], g_history[0], g_volumeState[0] = saved
+                if not tracing:
+                    tracemalloc.stop()
+        return self.samples
+
+    def simulate(self, days):
+        clock = VirtualClock( time.time() )
+        timerService = TimerService( clock )
+
+        backend = g_audioBackend[0] = FakeAudioBackend( applications={"AIMP.exe": 1.0} )
+        g_volumeState[0] = VolumeState( backend )
+        g_volumeState[0].start()
+        g_audioCues[0] = AudioCues( createEffect=SilentSoundEffect )
+        g_audioCues[0].configure( {} )
+        g_speechEngine[0] = SpeechEngine( SilentSpeechSynthesizer(), self.directory / "speech", timerService=timerService )
+        g_speechEngine[0].prerender( [cue.argument for cue in getRoutine() if cue.action == "speak"] + ["beep"] )
+        history = g_history[0] = EyeRestHistory( self.directory / "TimeTray.history", clock )
+
+        window, tray = createMainWindowAndTray( 60, timerService )
+        response = None
+        try:
+            window.startEyeRest()
+            self.started = clock()
+            end = self.started + days * 86400
+            nextSample = self.started
+
+            while clock() < end:
+                clock.advance( self.step, timerService )
+                tray.setTrayText( datetime.datetime.fromtimestamp( clock() ) )
+                QApplication.processEvents()
+
+                if response is not None and not response.active:
+                    response = None
+                if window.isVisible() and response is None:
+                    response = timerService.schedule( self.responseDelay, self.pressEnter, window )
+
+                if clock() >= nextSample:
+                    self.sample( clock() - self.started )
+                    nextSample += self.sampleInterval
+        finally:
+            window.cycle.pause()
+            tray.hide()
+            window.deleteLater()
+            tray.deleteLater()
+            QApplication.processEvents()
+            g_laneExecutor.drain( timeout=5 )
+            history.close()
+
+    def pressEnter(self, window):
+        QApplication.sendEvent( window, QtGui.QKeyEvent( QtCore.QEvent.KeyPress, Qt.Key_Return, Qt.NoModifier ) )
+
+    def sample(self, seconds):
+        import gc
+        import tracemalloc
+        gc.collect()
+        tempFiles = sum( len( files ) for path, directories, files in os.walk( self.directory ) )
+        self.samples.append( SoakSample( seconds, residentMemory(), tracemalloc.get_traced_memory()[0],
+                len( gc.get_objects() ), threading.active_count(), openFileDescriptors(), tempFiles ) )
+
+    def leaks(self):
+        """ Returns the resources whose maximum on the last third of the samples grew more than
+        their tolerance from the maximum on the middle third, i.e., after the warm up, as a
+        dictionary with their before and after maximums. """
+        third = len( self.samples ) // 3
+        leaks = {}
+        if third < 1:
+            return leaks
+
+        for name, ( absolute, fraction ) in self.tolerances.items():
+            if getattr( self.samples[0], name ) is None:
+                continue
+            before = max( getattr( sample, name ) for sample in self.samples[third:2 * third] )
+            after = max( getattr( sample, name ) for sample in self.samples[2 * third:] )
+            if after - before > absolute + fraction * before:
+                leaks[name] = ( before, after )
+        return leaks
+
+    def formatSample(self, sample):
+        values = ( f"{name} {value}" for name, value in sample._asdict().items() if name != "seconds" and value is not None )
+        return f"{datetime.timedelta( seconds=round( sample.seconds ) )} " + ", ".join( values )
+
 
 class MainWindow(QMainWindow):
-    runEyeRestLoop = pyqtSignal( [] )
 
-    def __init__(self):
+    def __init__(self, timerService=None):
         QMainWindow.__init__(self)
+        self.timerService = timerService
         name = "Eye resting stopwatch"
         author = "Eye strain user"
         self.setWindowTitle(name)
@@ -660,14 +2728,14 @@ class MainWindow(QMainWindow):
 
     def eyeRestCounterSetup(self):
         # https://www.geeksforgeeks.org/pyqt5-digital-stopwatch/
-        self.eyeRestCounterValue = 0
-        self.incrementEyeRestCounter = False
+        self.cycle = EyeRestCycle(self, self.timerService, history=getHistory())
         self.defaultSystemVolume = None
+        self.volumeRamp = None
 
         self.eyeRestCounterLabel = QLabel(self)
         self.eyeRestCounterLabel.setGeometry(75, 100, 250, 70)
         self.eyeRestCounterLabel.setStyleSheet("border : 4px solid black;")
-        self.eyeRestCounterLabel.setText(str(self.eyeRestCounterValue))
+        self.eyeRestCounterLabel.setText(str(self.cycle.counterValue))
         self.eyeRestCounterLabel.setFont(QFont('Arial', 25))
         self.eyeRestCounterLabel.setAlignment(Qt.AlignCenter)
 
@@ -683,28 +2751,21 @@ class MainWindow(QMainWindow):
         resetEyeRestButton.setGeometry(125, 350, 150, 40)
         resetEyeRestButton.pressed.connect(self.resetEyeRest)
 
-        timerEyeRest = QTimer(self)
-        timerEyeRest.timeout.connect(self.updateTime)
-        timerEyeRest.start(1000)
-        self.isEyeRestPlaying = False
-
-    def connectTray(self):
-        self.runEyeRestLoop.connect( mainTray.nextEyeRestLoop )
 
     def clickMethod(self):
         QMessageBox.about(self, "Title", "Message")
 
     def closeEvent(self, event):
-        if mainTray.eyeRestTimer is None and self.incrementEyeRestCounter:
-            self.runEyeRestLoop.emit()
+        self.cycle.windowClosed()
         event.accept()
 
+    @profiled
     def keyPressEvent(self, event):
         if event.key() == QtCore.Qt.Key_Escape:
             self.showMinimized()
         if event.key() in ( QtCore.Qt.Key_Return, QtCore.Qt.Key_Enter):
             self.resetEyeRest()
-            threading.Thread(target=speak, args=(f"beep",), daemon=True).start()
+            speak("beep")
             self.close()
 
     def showUp(self):
@@ -716,15 +2777,24 @@ class MainWindow(QMainWindow):
     def exitApplication(self):
         self.settings.setValue("size", self.size())
         self.settings.setValue("pos", self.pos())
+
+        # Lets the volume ramps and the other pending tasks finish, instead of killing them
+        self.restoreVolume()
+        g_laneExecutor.shutdown( timeout=5 )
         exit()
 
     def saveVolume(self):
         if self.defaultSystemVolume is not None:
             return
 
-        self.defaultSystemVolume = getSystemVolume()
-        threading.Thread(target=setSystemAndApplicationVolume,
-            args=(self.defaultSystemVolume, 0.5, "AIMP.exe"), daemon=True).start()
+        # The GUI thread only reads the cached volume, see VolumeState
+        self.defaultSystemVolume = getVolumeState().systemVolume
+        if self.defaultSystemVolume is None:
+            log( 'The system volume was not read yet, so it is not raised' )
+            return
+
+        increase, applications = getCrossfade()
+        self.volumeRamp = crossfade(self.defaultSystemVolume, increase, applications)
         # a = subprocess.Popen(r'''"D:\\User\Documents\\NirSoft\SoundVolumeView.exe" /ChangeVolume "AIMP3" -75''')
         # b = subprocess.Popen(r'''"D:\\User\Documents\\NirSoft\SoundVolumeView.exe" /ChangeVolume "Speakers" "+50"''')
         # ar = a.communicate()
@@ -732,8 +2802,14 @@ class MainWindow(QMainWindow):
         # # print(f"ar {ar}, br {br}.")
 
     def restoreVolume(self):
-        threading.Thread(target=setSystemAndApplicationVolume,
-            args=(self.defaultSystemVolume, 0.5, "AIMP.exe", True), daemon=True).start()
+        if self.defaultSystemVolume is None:
+            return
+
+        increase, applications = getCrossfade()
+        # Once the save moved the volume, it is restored even when the applications closed meanwhile
+        saved = self.volumeRamp is not None and not self.volumeRamp.skipped
+        crossfade(self.defaultSystemVolume, increase, applications, reverse=True, requireApplication=not saved)
+        self.volumeRamp = None
         self.defaultSystemVolume = None
         # a = subprocess.Popen(r'''"D:\\User\Documents\\NirSoft\SoundVolumeView.exe" /ChangeVolume "Speakers" "-50"''')
         # b = subprocess.Popen(r'''"D:\User\Documents\NirSoft\SoundVolumeView.exe" /ChangeVolume "AIMP3" "+75"''')
@@ -741,114 +2817,134 @@ class MainWindow(QMainWindow):
         # br = b.communicate()
         # # print(f"ar {ar}, br {br}.")
 
-    def updateTime(self):
-        testtime = 10
-        # testtime = 1
-        seconds = self.eyeRestCounterValue
-        if self.incrementEyeRestCounter:
-            self.eyeRestCounterValue+= 1
-            if seconds > int(ALARM_TIMEOUT * testtime) and not self.isEyeRestPlaying:
-                self.isEyeRestPlaying = True
-                filename = os.path.join(CURRENT_DIR, "Alarm06.wav")
-                QtMultimedia.QSound.play(filename)
-            if seconds == int(0.1 * testtime):
-                self.saveVolume()
-            if seconds == int(1.0 * testtime):
-                threading.Thread(target=speak, args=(f"{seconds} seconds",), daemon=True).start()
-            if seconds == int(2.0 * testtime):
-                threading.Thread(target=speak, args=(f"{seconds} seconds",), daemon=True).start()
-            if seconds == int(3.0 * testtime):
-                threading.Thread(target=speak, args=(f"{seconds} seconds",), daemon=True).start()
-            if seconds == int(4.6 * testtime):
-                self.restoreVolume()
-            if seconds == int(5.6 * testtime):
-                self.runEyeRestLoop.emit()
-            self.eyeRestCounterLabel.setText(str(seconds))
+    def setEyeRestCounter(self, value):
+        self.eyeRestCounterLabel.setText(str(value))
+
+    def playCue(self, name):
+        getAudioCues().play(name, replace=True)
+
+    def speak(self, text):
+        speak(text)
 
+    def showEvent(self, event):
+        self.cycle.windowShown()
+        super(MainWindow, self).showEvent(event)
+
+    @profiled
     def startEyeRest(self):
-        self.incrementEyeRestCounter = True
+        # The routine saves the volume 1 second later
+        getVolumeState().refresh()
+        self.cycle.start()
         self.eyeRestCounterLabel.setStyleSheet("background-color:lightgreen")
 
+    @profiled
     def pauseEyeRest(self):
-        self.incrementEyeRestCounter = False
+        self.cycle.pause()
         self.eyeRestCounterLabel.setStyleSheet("background-color:lightblue")
 
+    @profiled
     def resetEyeRest(self):
-        self.isEyeRestPlaying = False
-        self.eyeRestCounterValue = 0
-        self.eyeRestCounterLabel.setText(str(self.eyeRestCounterValue))
+        self.cycle.reset()
 
-        if self.incrementEyeRestCounter:
+        if self.cycle.counting:
+            getVolumeState().refresh()
             self.eyeRestCounterLabel.setStyleSheet("background-color:lightgreen")
         else:
             self.eyeRestCounterLabel.setStyleSheet("background-color:")
 
 
-class QSystemTrayIconListener(QSystemTrayIcon):
-    updateTrayIconText = pyqtSignal( [] )
-    showMainWindow = pyqtSignal( [] )
-
-    def __init__(self, *args, **kwargs):
-        self.trayIconPixmap = None
-        self.trayIconFont = None
-        self.trayIconPainter = None
-        self.trayIcon = None
-        super(QSystemTrayIconListener, self).__init__( *args, **kwargs )
-
-        self.eyeRestTimer = None
-        self.reinforcementTimer = None
-
-        self.createTrayMenu()
-        self.setTrayText()
-
-        self.updateTrayIconText.connect( self.setTrayText )
-        self.showMainWindow.connect( mainWin.showUp )
-
-        threading.Thread( target=self.continuallyUpdateTrayIcon, daemon=True ).start()
-
-    def showMainWindowCallback(self):
-        log(f'eyeRestTimer {self.eyeRestTimer}, incrementEyeRestCounter {mainWin.incrementEyeRestCounter}')
-
-        self.showMainWindow.emit()
-        self.eyeRestTimer = None
-
-        if self.reinforcementTimer is not None:
-            self.reinforcementTimer.cancel()
+def nextTrayBoundary(timestamp, tooltipResolution):
+    """ Returns when the tray needs to be updated after `timestamp`, i.e., the next local time
+    multiple of `tooltipResolution` seconds, the next local midnight or the next daylight saving
+    time change, whichever comes first. """
+    now = datetime.datetime.fromtimestamp( timestamp )
+    today = datetime.datetime.combine( now.date(), datetime.time() )
+    seconds = ( now - today ).total_seconds()
+
+    nextToolTip = today + datetime.timedelta( seconds=( seconds // tooltipResolution + 1 ) * tooltipResolution )
+    nextMidnight = today + datetime.timedelta( days=1 )
+    boundary = max( min( nextToolTip, nextMidnight ).timestamp(), timestamp + 0.001 )
+
+    utcOffset = time.localtime( timestamp ).tm_gmtoff
+    if time.localtime( boundary ).tm_gmtoff != utcOffset:
+        low, high = math.floor( timestamp ), math.ceil( boundary )
+        while high - low > 1:
+            middle = ( low + high ) // 2
+            if time.localtime( middle ).tm_gmtoff == utcOffset:
+                low = middle
+            else:
+                high = middle
+        boundary = high
+    return boundary
 
-        self.reinforcementTimer = Timer( AUTORESTARTINTERVAL, self.showMainWindowReinforcementCallback )
-        self.reinforcementTimer.start()
 
-    def showMainWindowReinforcementCallback(self):
-        log(f'eyeRestTimer {self.eyeRestTimer}, incrementEyeRestCounter {mainWin.incrementEyeRestCounter}')
+def formatTrayToolTip(timenow, tooltipResolution):
+    if tooltipResolution % 60:
+        return timenow.strftime( "%Y-%m-%d %H:%M:%S" )
+    return timenow.strftime( "%Y-%m-%d %H:%M" )
 
-        if self.eyeRestTimer is None and mainWin.incrementEyeRestCounter:
-            self.showMainWindowCallback()
 
-    def nextEyeRestLoop(self):
-        log(f'eyeRestTimer {self.eyeRestTimer}, incrementEyeRestCounter {mainWin.incrementEyeRestCounter}')
+class QSystemTrayIconListener(QSystemTrayIcon):
 
-        if self.eyeRestTimer is not None:
-            self.eyeRestTimer.cancel()
-            self.eyeRestTimer = None
+    def __init__(self, *args, tooltipResolution=60, **kwargs):
+        self.tooltipResolution = tooltipResolution
+        self.trayIcon = None
+        self.trayIconKey = None
+        self.trayIconRenders = 0
+        self.trayIconUpdates = 0
+        self.trayIconReportHour = None
+        super(QSystemTrayIconListener, self).__init__( *args, **kwargs )
 
-        if mainWin.incrementEyeRestCounter:
-            self.eyeRestTimer = Timer( SHOW_WINDOW_INTERVAL, self.showMainWindowCallback )
-            self.eyeRestTimer.start()
-        # last_show_up = datetime.datetime.now().date()
-        # while True:
-        #     now = datetime.datetime.now().date()
-        #     if now - last_show_up > datetime.timedelta(minutes=30):
-        #         last_show_up = now
-        #         self.showMainWindow.emit()
-
-    def continuallyUpdateTrayIcon(self):
-        while True:
-            self.updateTrayIconText.emit()
-            time.sleep(1)
+        self.createTrayMenu()
 
-    def setTrayText(self):
-        timenow = datetime.datetime.now()
-        trayIconPixmap = QPixmap(100,100)
+        # Wakes up only when the tray has something new to show, see nextTrayBoundary()
+        self.trayUpdateTimer = QTimer( self )
+        self.trayUpdateTimer.setSingleShot( True )
+        self.trayUpdateTimer.setTimerType( Qt.PreciseTimer )
+        self.trayUpdateTimer.timeout.connect( self.updateTray )
+        self.updateTray()
+
+    @profiled
+    def updateTray(self):
+        with instrumentWakeup( "tray" ):
+            timestamp = time.time()
+            self.setTrayText( datetime.datetime.fromtimestamp( timestamp ) )
+
+            # Bound the wait, so a wall clock change is noticed within an hour
+            interval = min( nextTrayBoundary( timestamp, self.tooltipResolution ) - timestamp, 3600 )
+            self.trayUpdateTimer.start( max( 1, math.ceil( interval * 1000 ) ) )
+
+    @profiled
+    def setTrayText(self, timenow=None):
+        with g_metrics.timed( "tray.setTrayText" ):
+            self.updateTrayText( timenow or datetime.datetime.now() )
+
+    def updateTrayText(self, timenow):
+        self.setToolTip( formatTrayToolTip( timenow, self.tooltipResolution ) )
+
+        # The icon only shows the day of the month, so it is only drawn again when the day changes
+        trayIconText = "%02d" % timenow.date().day
+        devicePixelRatio = QApplication.instance().devicePixelRatio()
+        trayIconKey = ( trayIconText, devicePixelRatio )
+
+        if trayIconKey != self.trayIconKey:
+            self.trayIcon = self.renderTrayIcon( trayIconText, devicePixelRatio )
+            self.trayIconKey = trayIconKey
+            self.setIcon( self.trayIcon )
+            self.setVisible( True )
+            self.trayIconUpdates += 1
+
+        if timenow.hour != self.trayIconReportHour:
+            if self.trayIconReportHour is not None:
+                log(f'trayIconRenders {self.trayIconRenders}, trayIconUpdates {self.trayIconUpdates} in the last hour')
+            self.trayIconReportHour = timenow.hour
+            self.trayIconRenders = 0
+            self.trayIconUpdates = 0
+
+    def renderTrayIcon(self, trayIconText, devicePixelRatio):
+        self.trayIconRenders += 1
+        trayIconPixmap = QPixmap( int( 100 * devicePixelRatio ), int( 100 * devicePixelRatio ) )
+        trayIconPixmap.setDevicePixelRatio( devicePixelRatio )
         trayIconPixmap.fill( Qt.GlobalColor.transparent )
 
         # QFont::Thin
@@ -868,39 +2964,34 @@ class QSystemTrayIconListener(QSystemTrayIcon):
         trayIconPainter = QPainter( trayIconPixmap )
         trayIconPainter.setPen( Qt.white )
         trayIconPainter.setFont( trayIconFont )
-        trayIconPainter.drawText( QPoint( -5, 79 ), "%02d" % timenow.date().day )
+        trayIconPainter.drawText( QPoint( -5, 79 ), trayIconText )
+        trayIconPainter.end()
 
         # file = QFile( "yourFile.png" )
         # file.open( QIODevice.WriteOnly )
         # trayIconPixmap.save( file, "PNG" )
-
-        trayIcon = QIcon( trayIconPixmap )
-        self.setIcon( trayIcon )
-        self.setToolTip( str( timenow )[:-7] )
-        self.setVisible( True )
-
-        if self.trayIconPainter:
-            self.trayIconPainter.end()
-
-        self.trayIconPixmap = trayIconPixmap
-        self.trayIconFont = trayIconFont
-        self.trayIconPainter = trayIconPainter
-        self.trayIcon = trayIcon
+        return QIcon( trayIconPixmap )
 
     def createTrayMenu(self):
         self.exitAction = QAction( "&Exit" )
         self.mainWindowAction = QAction( "&Main Window" )
+        self.verboseLogAction = QAction( "&Verbose Log" )
+        self.verboseLogAction.setCheckable( True )
+        self.verboseLogAction.setChecked( g_logLevel[0] <= g_logLevels["debug"] )
 
         self.trayMenu = QMenu()
         self.trayMenu.addAction( self.mainWindowAction )
+        self.trayMenu.addAction( self.verboseLogAction )
         self.trayMenu.addAction( self.exitAction )
 
         self.mainWindowAction.triggered.connect( mainWin.showUp )
+        self.verboseLogAction.toggled.connect( lambda checked: setLogLevel( "debug" if checked else "warning" ) )
         self.exitAction.triggered.connect( mainWin.exitApplication )
         self.setContextMenu( self.trayMenu )
 
         self.activated.connect(self.systemIconClick)
 
+    @profiled
     def systemIconClick(self, reason):
         if reason == QSystemTrayIcon.Trigger:
             if mainWin.isVisible():
@@ -909,6 +3000,13 @@ class QSystemTrayIconListener(QSystemTrayIcon):
                 mainWin.showUp()
 
 
+def positiveInteger(text):
+    value = int( text )
+    if value < 1:
+        raise argparse.ArgumentTypeError( f"{value} is not 1 or more" )
+    return value
+
+
 g_argumentParser = argparse.ArgumentParser(
         description = \
 """
@@ -917,12 +3015,168 @@ Show the time as a tray icon.
         formatter_class=argparse.RawTextHelpFormatter,
     )
 
+g_argumentParser.add_argument( "command", action="store", nargs='?', choices=INSTANCE_COMMANDS, default=None,
+        help=
+"""
+What to do on the running TimeTray, which is started when there is none. The default shows its
+window. Only one TimeTray runs at a time, the next launches send it their command and exit.
+""" )
+
 g_argumentParser.add_argument( "-t", "--run-tests", action="store", nargs='*', default=None,
         help=
 """
 Run tests instead of the main application. Accepts a pytest test filter to pass to -k pytest option.
 """ )
 
+g_argumentParser.add_argument( "--benchmark", action="store", nargs='*', default=None,
+        help=
+"""
+Run the benchmarks from test_TimeTray.py instead of the main application, or only the given ones.
+""" )
+
+g_argumentParser.add_argument( "--benchmark-output", action="store",
+        default=os.path.join( CURRENT_DIR, "TimeTray.benchmark.json" ),
+        help=
+"""
+Where to write the benchmark results.
+""" )
+
+g_argumentParser.add_argument( "--benchmark-baseline", action="store",
+        default=os.path.join( CURRENT_DIR, "benchmark_baseline.json" ),
+        help=
+"""
+The benchmark results to compare with, saved before on the same machine, as the times are only
+comparable there. A benchmark median more than 50%% slower is a regression, and makes the
+benchmark run exit with 1.
+""" )
+
+g_argumentParser.add_argument( "--benchmark-save-baseline", action="store_true",
+        help=
+"""
+Save the benchmark results as the new baseline.
+""" )
+
+g_argumentParser.add_argument( "--audio-backend", action="store", choices=sorted(g_audioBackends), default=None,
+        help=
+"""
+Which mixer to use for the volume changes. The default is `worker` on Windows and `fake` elsewhere.
+""" )
+
+g_argumentParser.add_argument( "--speech-backend", action="store", choices=sorted(g_speechSynthesizers), default=None,
+        help=
+"""
+Which voice renders the spoken phrases. The default is `sapi` on Windows and `silent` elsewhere.
+""" )
+
+g_argumentParser.add_argument( "--tooltip-resolution", action="store", type=positiveInteger, default=60,
+        help=
+"""
+How many seconds the tray tooltip clock waits between updates. Use 1 to show the seconds.
+""" )
+
+g_argumentParser.add_argument( "--quit-after-startup", action="store_true",
+        help=
+"""
+Exit as soon as the main window and the tray icon are created, for measuring the startup time.
+It does not check for, or become, the single running instance.
+""" )
+
+g_argumentParser.add_argument( "--config", action="store",
+        default=os.path.join( CURRENT_DIR, "TimeTray.json" ),
+        help=
+"""
+The json settings file, see README.md. It is fine if it does not exist.
+""" )
+
+g_argumentParser.add_argument( "--log-level", action="store", choices=tuple(g_logLevels), default="debug",
+        help=
+"""
+Which records are written to TimeTray.log. It can be changed while running by the tray menu
+Verbose Log option.
+""" )
+
+g_argumentParser.add_argument( "--log-file", action="store", default=None,
+        help=
+"""
+Where to write the log instead of TimeTray.log next to TimeTray.py. It is rotated to gzip files
+alongside it, and the audio worker errors go to TimeTray.audio.log on the same directory.
+""" )
+
+g_argumentParser.add_argument( "--instrument", action="store", nargs='?', type=float, const=60, default=None,
+        help=
+"""
+Count the wakeups, timer callbacks, threads, processes and CPU time of each component, and log
+a summary every given seconds, by default, 60.
+""" )
+
+g_argumentParser.add_argument( "--idle-wakeup-budget", action="store", type=float, default=5,
+        help=
+"""
+With --instrument, how many wakeups per minute the idle application can have before a warning
+is logged.
+""" )
+
+g_argumentParser.add_argument( "--stats-port", action="store", type=int, default=0,
+        help=
+"""
+Serve the latency histograms and counters as json on http://127.0.0.1:PORT/metrics.
+""" )
+
+g_argumentParser.add_argument( "--stats", action="store_true",
+        help=
+"""
+Print the metrics of the TimeTray running with the same --stats-port, and exit.
+""" )
+
+g_argumentParser.add_argument( "--simulate", action="store", type=float, default=None,
+        help=
+"""
+Print what the eye rest cycle does in the given hours, run on a simulated clock, without any
+window or sound, and exit.
+""" )
+
+g_argumentParser.add_argument( "--simulate-response", action="store", type=float, default=5,
+        help=
+"""
+With --simulate, how many seconds the user takes to press Enter after the window shows up.
+A negative value never presses it.
+""" )
+
+g_argumentParser.add_argument( "--soak", action="store", type=float, default=None,
+        help=
+"""
+Run the window and the tray headless, with the fake audio, through the given days of eye rest
+cycles on a simulated clock, printing the memory, objects, threads, open files and temporary files
+of each day, and exit with 1 when some of them keeps growing.
+""" )
+
+g_argumentParser.add_argument( "--history", action="store", type=positiveInteger, nargs='?', const=31, default=None,
+        help=
+"""
+Print the eye rests of the last given days, by default 31, and of every week, and exit.
+""" )
+
+g_argumentParser.add_argument( "--profile", action="store", nargs='?', const=os.path.join( CURRENT_DIR, "TimeTray.profile" ), default=None,
+        help=
+"""
+Measure the calls, wall and CPU time of the Qt events, slots and timer callbacks, and sample the GUI
+thread stacks. On exit, and on SIGUSR1, or SIGBREAK on Windows, write the report to the given prefix
+plus `.txt` and the flamegraph stacks to the prefix plus `.folded`, by default `TimeTray.profile`.
+""" )
+
+g_argumentParser.add_argument( "--profile-interval", action="store", type=float, default=0.005,
+        help=
+"""
+With --profile, the seconds between the GUI thread stack samples, by default 0.005.
+""" )
+
+g_argumentParser.add_argument( "--profile-deterministic", action="store_true",
+        help=
+"""
+With --profile, profile every GUI thread call with cProfile, instead of sampling the stacks, which is
+exact but slower.
+""" )
+
 if __name__ == "__main__":
     main()
 
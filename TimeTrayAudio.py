@@ -0,0 +1,275 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+""" The audio backends of TimeTray, and the `AudioWorker` child process serving one of them.
+
+It only imports the standard library, so the worker starts without loading Qt, i.e.,
+`python TimeTrayAudio.py pycaw` serves the pycaw backend requests from stdin.
+"""
+import sys
+import time
+import json
+import threading
+import collections
+
+
+# Where the backends log, TimeTray replaces it by its log, and the worker writes to its stderr
+g_log = [lambda message: sys.stderr and sys.stderr.write(f"{message}\n")]
+
+
+def log(message):
+    g_log[0](message)
+
+
+class AudioBackend(object):
+    """Access to the system and applications volumes, as scalars between 0 and 1.
+
+    Applications are found by their process name, e.g. "AIMP.exe". Several requests can be sent at
+    once with `execute()`, e.g. `[("setSystemVolume", 0.2), ("sleep", 0.1), ("getSystemVolume",)]`,
+    which returns the list with each request result.
+    """
+    requests = (
+        "getSystemVolume",
+        "setSystemVolume",
+        "getApplicationVolume",
+        "setApplicationVolume",
+        "getApplicationVolumes",
+        "sleep",
+    )
+
+    def getSystemVolume(self):
+        raise NotImplementedError
+
+    def setSystemVolume(self, volume):
+        raise NotImplementedError
+
+    def getApplicationVolume(self, processName):
+        """Returns None when `processName` has no audio session."""
+        raise NotImplementedError
+
+    def setApplicationVolume(self, volume, processName):
+        raise NotImplementedError
+
+    def getApplicationVolumes(self, processNames):
+        """ Returns a dictionary with `getApplicationVolume()` of each of the `processNames`. """
+        return {processName: self.getApplicationVolume(processName) for processName in processNames}
+
+    def subscribeSystemVolume(self, callback):
+        """ Calls `callback(volume)` when the system volume changes, returning False when this
+        backend has no change notifications. """
+        return False
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def execute(self, requests):
+        results = []
+        for name, *args in requests:
+            if name not in self.requests:
+                raise ValueError(f"Invalid audio request {name}.")
+            results.append(getattr(self, name)(*args))
+        return results
+
+    def close(self):
+        pass
+
+
+class FakeAudioBackend(AudioBackend):
+    """In memory mixer for running without the Windows audio devices, i.e., on Linux and tests."""
+
+    def __init__(self, systemVolume=0.5, applications=None, notifications=True):
+        self.systemVolume = systemVolume
+        self.applications = dict(applications or {})
+        self.notifications = notifications
+        self.volumeCallbacks = []
+
+    def getSystemVolume(self):
+        return self.systemVolume
+
+    def setSystemVolume(self, volume):
+        changed = volume != self.systemVolume
+        self.systemVolume = volume
+        if changed:
+            for callback in self.volumeCallbacks:
+                callback(volume)
+
+    def subscribeSystemVolume(self, callback):
+        if self.notifications:
+            self.volumeCallbacks.append(callback)
+        return self.notifications
+
+    def getApplicationVolume(self, processName):
+        return self.applications.get(processName)
+
+    def setApplicationVolume(self, volume, processName):
+        if processName in self.applications:
+            self.applications[processName] = volume
+
+
+AudioSession = collections.namedtuple("AudioSession", "processName pid volumeDevice")
+
+
+class AudioSessionIndex(object):
+    """ The audio sessions by process name and pid, as enumerated by `provider()`.
+
+    The sessions are only enumerated again after `ttl` seconds, or after `invalidate()` is called,
+    i.e., when a session is created or a stale session fails.
+    """
+
+    def __init__(self, provider, ttl=5.0, clock=time.monotonic):
+        self.provider = provider
+        self.ttl = ttl
+        self.clock = clock
+        self.byName = {}
+        self.byPid = {}
+        self.built = None
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        with self.lock:
+            self.built = None
+
+    def refresh(self):
+        byName = collections.defaultdict(list)
+        byPid = {}
+        for session in self.provider():
+            byName[session.processName].append(session)
+            byPid[session.pid] = session
+        self.byName = dict(byName)
+        self.byPid = byPid
+        self.built = self.clock()
+
+    def lookup(self, processNames):
+        """ Returns the sessions list for each of the `processNames`. """
+        with self.lock:
+            if self.built is None or self.clock() - self.built > self.ttl:
+                self.refresh()
+            return {processName: self.byName.get(processName, []) for processName in processNames}
+
+    def sessions(self, processName):
+        return self.lookup((processName,))[processName]
+
+    def session(self, pid):
+        with self.lock:
+            if self.built is None or self.clock() - self.built > self.ttl:
+                self.refresh()
+            return self.byPid.get(pid)
+
+
+class PycawAudioBackend(AudioBackend):
+    """Windows mixer, the speakers endpoint is opened once and reused by all requests, and the
+    audio sessions are kept on an `AudioSessionIndex`. With `notifications`, the index is also
+    invalidated when a session is created, which requires COM on the multi threaded apartment."""
+
+    def __init__(self, notifications=False):
+        from ctypes import cast, POINTER
+        from comtypes import CLSCTX_ALL
+        from pycaw.pycaw import AudioUtilities, IAudioEndpointVolume
+
+        self.audioUtilities = AudioUtilities
+        devices = AudioUtilities.GetSpeakers()
+        interface = devices.Activate(IAudioEndpointVolume._iid_, CLSCTX_ALL, None)
+        self.systemDevice = cast(interface, POINTER(IAudioEndpointVolume))
+        self.sessions = AudioSessionIndex(self.enumerateSessions)
+
+        if notifications:
+            self.registerSessionNotification()
+
+    def registerSessionNotification(self):
+        try:
+            from pycaw.callbacks import AudioSessionNotification
+        except ImportError:
+            log('This pycaw version has no session notifications, only the index ttl is used')
+            return
+
+        sessions = self.sessions
+
+        class SessionCreatedNotification(AudioSessionNotification):
+            def on_session_created(self, new_session):
+                sessions.invalidate()
+
+        self.sessionNotification = SessionCreatedNotification()
+        self.sessionManager = self.audioUtilities.GetAudioSessionManager()
+        self.sessionManager.RegisterSessionNotification(self.sessionNotification)
+        self.sessionManager.GetSessionEnumerator()
+
+    def subscribeSystemVolume(self, callback):
+        try:
+            from pycaw.callbacks import AudioEndpointVolumeCallback
+        except ImportError:
+            log('This pycaw version has no endpoint volume notifications, the volume is read again when the eye rest starts')
+            return False
+
+        class VolumeChangedNotification(AudioEndpointVolumeCallback):
+            def on_notify(self, new_volume, new_mute, event_context, channels, channel_volumes):
+                callback(new_volume)
+
+        self.volumeNotification = VolumeChangedNotification()
+        self.systemDevice.RegisterControlChangeNotify(self.volumeNotification)
+        return True
+
+    def enumerateSessions(self):
+        for session in self.audioUtilities.GetAllSessions():
+            if session.Process:
+                yield AudioSession(session.Process.name(), session.ProcessId, session.SimpleAudioVolume)
+
+    def applicationDevices(self, processName, action):
+        """ Calls `action(volumeDevice)` for each `processName` session, enumerating the sessions
+        again when one of them fails, e.g., because its application was closed. """
+        try:
+            return [action(session.volumeDevice) for session in self.sessions.sessions(processName)]
+        except Exception:
+            self.sessions.invalidate()
+            return [action(session.volumeDevice) for session in self.sessions.sessions(processName)]
+
+    def getSystemVolume(self):
+        return self.systemDevice.GetMasterVolumeLevelScalar()
+
+    def setSystemVolume(self, volume):
+        self.systemDevice.SetMasterVolumeLevelScalar(volume, None)
+
+    def getApplicationVolume(self, processName):
+        for volume in self.applicationDevices(processName, lambda volumeDevice: volumeDevice.GetMasterVolume()):
+            return volume
+        return None
+
+    def getApplicationVolumes(self, processNames):
+        sessions = self.sessions.lookup(processNames)
+        return {processName: self.getApplicationVolume(processName) if sessions[processName] else None
+                for processName in processNames}
+
+    def setApplicationVolume(self, volume, processName):
+        self.applicationDevices(processName, lambda volumeDevice: volumeDevice.SetMasterVolume(volume, None))
+
+
+def serveAudioBackend(backend, input=sys.stdin, output=sys.stdout):
+    """ The `AudioWorker` child process loop, until its stdin is closed. """
+    for line in input:
+        try:
+            response = {"results": backend.execute(json.loads(line))}
+        except Exception as error:
+            response = {"error": f"{type(error).__name__}: {error}"}
+        output.write(json.dumps(response) + "\n")
+        output.flush()
+
+
+g_workerBackends = {
+    "pycaw": lambda: PycawAudioBackend(notifications=True),
+    "fake": FakeAudioBackend,
+}
+
+
+def main():
+    import argparse
+    argumentParser = argparse.ArgumentParser(description="Serve the audio backend requests from stdin, one json list per line. See `AudioWorker`.")
+    argumentParser.add_argument("backend", choices=sorted(g_workerBackends))
+    backend = argumentParser.parse_args().backend
+
+    if backend == "pycaw":
+        # The worker has no windows, so COM can use the multi threaded apartment the pycaw
+        # session notifications require, see PycawAudioBackend
+        sys.coinit_flags = 0
+    serveAudioBackend(g_workerBackends[backend]())
+
+
+if __name__ == "__main__":
+    main()
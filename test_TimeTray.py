@@ -0,0 +1,1863 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests and benchmarks of TimeTray.py, which are run by `python TimeTray.py --run-tests` and
+`python TimeTray.py --benchmark`.
+"""
+import io
+import os
+import sys
+import time
+import json
+import gzip
+import queue
+import wave
+import logging
+import pathlib
+import tempfile
+import datetime
+import collections
+import threading
+import signal
+import subprocess
+
+import pytest
+from pytest import approx
+
+import TimeTray
+from TimeTray import *
+from TimeTrayAudio import AudioSession, AudioSessionIndex, serveAudioBackend
+
+
+@pytest.fixture(scope="session", autouse=True)
+def enable_verbose(request):
+    g_run_tests[0] = request.config.getoption("--verbose")
+
+
+@pytest.fixture(scope="session", autouse=True)
+def log_file(tmp_path_factory):
+    """ Keeps the records logged by the tests, and their rotations, out of the real TimeTray.log. """
+    g_logFile[0] = tmp_path_factory.mktemp( "log" ) / "TimeTray.log"
+    yield g_logFile[0]
+    if g_logWriter[0] is not None:
+        g_logWriter[0].close()
+
+
+class CountingSpeechSynthesizer(SilentSpeechSynthesizer):
+    def __init__(self):
+        self.rendered = []
+
+    def render(self, text, filename):
+        self.rendered.append(text)
+        super(CountingSpeechSynthesizer, self).render(text, filename)
+
+
+def test_speech_engine_renders_each_phrase_once(tmp_path):
+    synthesizer = CountingSpeechSynthesizer()
+    played = []
+    engine = SpeechEngine(synthesizer, tmp_path, played.append)
+    engine.prerender(["10 seconds", "beep"])
+    engine.speak("beep")
+    engine.speak("10 seconds")
+    engine.speak("beep")
+
+    assert synthesizer.rendered == ["10 seconds", "beep"]
+    assert played == [engine.filename("beep"), engine.filename("10 seconds"), engine.filename("beep")]
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted(path.name for path in set(played))
+
+    with wave.open(str(played[0]), "rb") as input:
+        assert input.getnframes() == 800
+
+    # Other runs reuse the files on the disk cache
+    engine = SpeechEngine(synthesizer, tmp_path, played.append)
+    engine.prerender(["10 seconds", "beep"])
+    assert synthesizer.rendered == ["10 seconds", "beep"]
+
+
+def test_sapi_script_quotes_the_phrase():
+    assert quoteVbscript('say "hi"\nthen') == '"say ""hi"" then"'
+
+    script = SapiSpeechSynthesizer().script('" : CreateObject("WScript.Shell").Run "calc', r'C:\a "b".wav')
+    assert 'speech.Speak """ : CreateObject(""WScript.Shell"").Run ""calc"\n' in script
+    assert 'stream.Open "C:\\a ""b"".wav", 3\n' in script
+
+
+def test_speech_engine_plays_phrases_rendered_on_background_on_the_timer_service(tmp_path):
+    timerService = TimerService()
+    played = []
+    engine = SpeechEngine(CountingSpeechSynthesizer(), tmp_path, played.append, timerService)
+    engine.speak("20 seconds")
+
+    deadline = time.monotonic() + 5
+    while not played and time.monotonic() < deadline:
+        timerService.runDue()
+        time.sleep(0.01)
+    assert played == [engine.filename("20 seconds")]
+
+
+class FakeSoundEffect(object):
+    def __init__(self):
+        self.source = None
+        self.volume = None
+        self.playing = False
+        self.plays = 0
+
+    def setSource(self, url):
+        self.source = pathlib.Path(url.toLocalFile())
+
+    def setVolume(self, volume):
+        self.volume = volume
+
+    def isPlaying(self):
+        return self.playing
+
+    def play(self):
+        self.playing = True
+        self.plays += 1
+
+    def stop(self):
+        self.playing = False
+
+
+@pytest.fixture(autouse=True)
+def fake_audio_cues():
+    cues = AudioCues(createEffect=FakeSoundEffect)
+    cues.configure({})
+    g_audioCues[0] = cues
+    yield cues
+    g_audioCues[0] = None
+
+
+def test_audio_cues_are_loaded_once_with_their_gains(tmp_path):
+    (tmp_path / "chime.wav").write_bytes(b"")
+    cues = AudioCues(createEffect=FakeSoundEffect)
+    cues.configure({"chime": {"file": str(tmp_path / "chime.wav"), "gain": 0.5}, "alarm": {"file": "Alarm06.wav", "gain": 2}})
+    assert cues.effects["alarm"].source == pathlib.Path(CURRENT_DIR) / "Alarm06.wav"
+    assert cues.effects["chime"].source == tmp_path / "chime.wav"
+
+    cues.play("chime")
+    cues.play("alarm")
+    assert cues.effects["chime"].volume == 0.5
+    assert cues.effects["alarm"].volume == 1.0
+    assert cues.effects["chime"].playing
+
+    cues.play("alarm", gain=0.25, replace=True)
+    assert not cues.effects["chime"].playing
+    assert cues.effects["alarm"].volume == 0.25
+    assert cues.effects["alarm"].plays == 2
+
+    cues.stop("alarm")
+    assert not cues.effects["alarm"].playing
+
+
+def test_audio_cues_reject_invalid_cues_before_loading_them(tmp_path):
+    (tmp_path / "chime.wav").write_bytes(b"")
+    cues = AudioCues(createEffect=FakeSoundEffect, directory=tmp_path)
+    for entry in ({"chime": {"file": "chime.wav"}, "bell": {"file": "missing.wav"}},
+            {"chime": {"file": "chime.wav"}, " ": {"file": "chime.wav"}},
+            {"chime": {"gain": 0.5}}):
+        with pytest.raises(ValueError):
+            cues.configure(entry)
+        assert cues.effects == {}
+
+    cues.configure({"chime": {"file": str(tmp_path / "chime.wav"), "gain": "0.5"}})
+    assert sorted(cues.effects) == ["alarm", "chime"]
+    assert cues.gains["chime"] == 0.5
+
+
+def test_audio_cues_play_files_from_memory(tmp_path):
+    cues = AudioCues(createEffect=FakeSoundEffect)
+    filename = tmp_path / "phrase.wav"
+    cues.playFile(filename)
+    effect = cues.effects[str(filename)]
+    cues.playFile(filename)
+    assert cues.effects[str(filename)] is effect
+    assert effect.plays == 2
+
+
+def test_load_configuration(tmp_path):
+    assert loadConfiguration(tmp_path / "missing.json") == {}
+    (tmp_path / "TimeTray.json").write_text('{"cues": {"chime": {"file": "chime.wav"}}}')
+    assert loadConfiguration(tmp_path / "TimeTray.json") == {"cues": {"chime": {"file": "chime.wav"}}}
+
+
+def test_run_process_drains_both_streams():
+    process, stdout, stderr = run_process([sys.executable, "-c",
+            "import sys\nfor index in range(3000): print(index); print(-index, file=sys.stderr)"], max_lines=100)
+    assert process.returncode == 0
+    assert stdout == [str(index) for index in range(2900, 3000)]
+    assert stderr == [str(-index) for index in range(2900, 3000)]
+
+
+def test_run_process_keeps_the_blank_lines():
+    process, stdout, stderr = run_process([sys.executable, "-c", r"import sys; sys.stdout.write('a\n\n\nb\n\n')"])
+    assert stdout == ['a', '', '', 'b', '']
+
+
+def test_run_process_callback_and_timeout():
+    lines = []
+    with pytest.raises(subprocess.TimeoutExpired):
+        run_process([sys.executable, "-u", "-c", "import time\nprint('started')\ntime.sleep(30)"],
+                timeout=2, callback=lambda name, line: lines.append((name, line)))
+    assert lines == [("stdout", "started")]
+
+
+def test_iterate_process_can_be_cancelled():
+    start = time.monotonic()
+    lines = iterate_process([sys.executable, "-u", "-c", "import itertools\nfor index in itertools.count(): print(index)"])
+    for name, line in lines:
+        if line == "1000":
+            break
+    lines.close()
+    assert time.monotonic() - start < 10
+
+
+def logRecord(message, created=None):
+    return logging.makeLogRecord( {"msg": message, "created": time.time() if created is None else created} )
+
+
+def test_log_writer_rotates_and_compresses_the_full_files(tmp_path):
+    writer = LogWriter( tmp_path / "TimeTray.log", maxBytes=100, backupCount=2, flushInterval=0 )
+    writer.start()
+    for index in range( 30 ):
+        writer.handler.handle( logRecord( f"line {index:02}" ) )
+    writer.close()
+
+    assert sorted( path.name for path in tmp_path.iterdir() ) == ["TimeTray.log", "TimeTray.log.1.gz", "TimeTray.log.2.gz"]
+    older = gzip.decompress( (tmp_path / "TimeTray.log.2.gz").read_bytes() ).decode()
+    newer = gzip.decompress( (tmp_path / "TimeTray.log.1.gz").read_bytes() ).decode()
+    lines = ( older + newer + (tmp_path / "TimeTray.log").read_text() ).splitlines()
+    assert lines == [f"line {index:02}" for index in range( 30 - len( lines ), 30 )]
+
+
+def test_log_writer_rotates_on_a_new_day(tmp_path):
+    writer = LogWriter( tmp_path / "TimeTray.log", flushInterval=0 )
+    writer.start()
+    writer.handler.handle( logRecord( "today" ) )
+    writer.handler.handle( logRecord( "tomorrow", time.time() + 86400 ) )
+    writer.close()
+
+    assert gzip.decompress( (tmp_path / "TimeTray.log.1.gz").read_bytes() ) == b"today\n"
+    assert (tmp_path / "TimeTray.log").read_text() == "tomorrow\n"
+
+
+def test_log_writer_drops_records_instead_of_blocking(tmp_path):
+    writer = LogWriter( tmp_path / "TimeTray.log", maxQueued=2 )
+    start = time.perf_counter()
+    for index in range( 5 ):
+        writer.handler.handle( logRecord( f"line {index}" ) )
+    assert time.perf_counter() - start < 0.1
+    assert writer.handler.dropped == 3
+
+    writer.start()
+    writer.close()
+    assert (tmp_path / "TimeTray.log").read_text().splitlines() == [
+            "line 0", "line 1", "3 log records were dropped because the writer was behind"]
+
+
+def test_set_log_level():
+    try:
+        setLogLevel( "warning" )
+        assert g_logLevel[0] == logging.WARNING
+        assert TimeTray.log.level == logging.WARNING
+    finally:
+        setLogLevel( "debug" )
+    assert TimeTray.log.level == logging.DEBUG
+
+
+def test_log_is_written_to_the_log_file(log_file):
+    TimeTray.log( "written to the test log" )
+    assert getLogWriter().filename == log_file
+    assert getLogWriter().handler in TimeTray.log.handlers
+
+
+class FakeAudioSessions(object):
+    """ Session provider for the `AudioSessionIndex` tests. """
+
+    def __init__(self, *sessions):
+        self.sessions = list(sessions)
+        self.enumerations = 0
+
+    def __call__(self):
+        self.enumerations += 1
+        return list(self.sessions)
+
+
+def test_audio_session_index_reuses_the_sessions_until_invalidated():
+    clock = ManualClock()
+    provider = FakeAudioSessions(AudioSession("AIMP.exe", 10, "aimp"), AudioSession("chrome.exe", 20, "chrome"))
+    index = AudioSessionIndex(provider, ttl=5, clock=clock)
+
+    for repeat in range(100):
+        assert index.lookup(("AIMP.exe", "chrome.exe", "vlc.exe")) == {
+            "AIMP.exe": [provider.sessions[0]], "chrome.exe": [provider.sessions[1]], "vlc.exe": []}
+    assert index.session(20) == provider.sessions[1]
+    assert provider.enumerations == 1
+
+    provider.sessions.append(AudioSession("vlc.exe", 30, "vlc"))
+    assert index.sessions("vlc.exe") == []
+    index.invalidate()
+    assert index.sessions("vlc.exe") == [provider.sessions[2]]
+    assert provider.enumerations == 2
+
+    provider.sessions.append(AudioSession("AIMP.exe", 40, "aimp2"))
+    clock.now += 6
+    assert [session.pid for session in index.sessions("AIMP.exe")] == [10, 40]
+    assert provider.enumerations == 3
+
+
+@pytest.fixture(autouse=True)
+def fake_audio_backend_off_windows():
+    if sys.platform == "win32":
+        yield
+        return
+    backend = g_audioBackend[0]
+    g_audioBackend[0] = FakeAudioBackend(applications={"AIMP.exe": 1.0})
+    yield
+    g_audioBackend[0] = backend
+
+
+def test_fake_audio_backend_execute():
+    backend = FakeAudioBackend(0.3, {"AIMP.exe": 1.0})
+    assert backend.execute([
+        ("setSystemVolume", 0.6),
+        ("setApplicationVolume", 0.4, "AIMP.exe"),
+        ("setApplicationVolume", 0.4, "missing.exe"),
+        ("getSystemVolume",),
+        ("getApplicationVolume", "AIMP.exe"),
+        ("getApplicationVolume", "missing.exe"),
+        ("getApplicationVolumes", ["AIMP.exe", "missing.exe"]),
+    ]) == [None, None, None, 0.6, 0.4, None, {"AIMP.exe": 0.4, "missing.exe": None}]
+
+    with pytest.raises(ValueError):
+        backend.execute([("close",)])
+
+
+def test_serve_audio_backend():
+    output = io.StringIO()
+    backend = FakeAudioBackend(0.3)
+    serveAudioBackend(backend, io.StringIO('[["setSystemVolume", 0.7], ["getSystemVolume"]]\n[["exit"]]\n'), output)
+    responses = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert responses[0] == {"results": [None, 0.7]}
+    assert responses[1] == {"error": "ValueError: Invalid audio request exit."}
+
+
+def test_audio_worker_latency():
+    """ Compares one `AudioWorker` request against starting a new python per request. """
+    worker = AudioWorker("fake")
+    try:
+        assert worker.execute([("setSystemVolume", 0.25), ("getSystemVolume",)]) == [None, 0.25]
+
+        start = time.perf_counter()
+        for index in range(100):
+            assert worker.getSystemVolume() == 0.25
+        workerLatency = (time.perf_counter() - start) / 100
+    finally:
+        worker.close()
+
+    start = time.perf_counter()
+    for index in range(3):
+        subprocess.run([sys.executable, "-u", "-c", "print(0.25)"], stdout=subprocess.PIPE, check=True)
+    spawnLatency = (time.perf_counter() - start) / 3
+
+    assert workerLatency < spawnLatency, f"AudioWorker request {workerLatency:.6f}s, python per request {spawnLatency:.6f}s"
+
+
+def test_audio_worker_is_replaced_when_it_hangs():
+    worker = AudioWorker("fake", timeout=0.5)
+    command = worker.command
+    worker.command = [sys.executable, "-c", "import time\ntime.sleep(60)"]
+    try:
+        start = time.perf_counter()
+        with pytest.raises(RuntimeError, match="did not answer in 0.5 seconds"):
+            worker.getSystemVolume()
+        assert time.perf_counter() - start < 5
+        assert worker.process is None
+
+        # The requested sleeps are waited for, and the next request starts a new worker
+        worker.command = command
+        assert worker.execute([("sleep", 0.75), ("setSystemVolume", 0.25), ("getSystemVolume",)]) == [None, None, 0.25]
+    finally:
+        worker.close()
+
+
+def test_audio_worker_does_not_import_qt():
+    process = subprocess.run([sys.executable, "-c", "import sys, TimeTrayAudio\nprint('PyQt5' in sys.modules)"],
+            cwd=CURRENT_DIR, stdout=subprocess.PIPE, encoding="UTF-8", check=True)
+    assert process.stdout.strip() == "False"
+
+
+def test_get_system_volume():
+    assert type(getSystemVolume()) == float
+
+
+def test_set_system_volume():
+    level = 0.20
+    defaultSystemVolume = getSystemVolume()
+    assert setSystemVolume(level) == approx(level)
+    assert setSystemVolume(defaultSystemVolume) == approx(defaultSystemVolume)
+
+
+def test_set_application_volume():
+    level = 0.2
+    assert setApplicationVolume(level, "AIMP.exe") == approx(level)
+    level = 1
+    assert setApplicationVolume(level, "AIMP.exe") == approx(level)
+
+
+def test_set_volume_evenly():
+    defaultSystemVolume = getSystemVolume()
+    assert setSystemAndApplicationVolume(defaultSystemVolume, 0.5, "AIMP.exe").wait(5)
+    time.sleep(2)
+    assert setSystemAndApplicationVolume(defaultSystemVolume, 0.5, "AIMP.exe", reverse=True).wait(5)
+    assert getSystemVolume() == approx(defaultSystemVolume, abs=0.01)
+
+
+class RecordingAudioBackend(FakeAudioBackend):
+    def __init__(self, *args, **kwargs):
+        super(RecordingAudioBackend, self).__init__(*args, **kwargs)
+        self.batches = []
+
+    def execute(self, requests):
+        self.batches.append(list(requests))
+        return super(RecordingAudioBackend, self).execute(requests)
+
+
+def test_volume_ramp_duration_does_not_depend_on_the_steps():
+    backend = RecordingAudioBackend(0.1, {"AIMP.exe": 1.0})
+    engine = VolumeRampEngine(backend, tickInterval=0.01)
+
+    for steps in (2, 50):
+        curve = [0.1 + 0.8 * step / (steps - 1) for step in range(steps)]
+        ramp = engine.start({SYSTEM_VOLUME: curve}, duration=0.3)
+        assert ramp.wait(5)
+        assert ramp.end - ramp.start == approx(0.3, abs=0.15)
+        assert backend.systemVolume == approx(0.9)
+
+    # The thread exits when there are no ramps left
+    task = engine.task
+    if task is not None:
+        task.wait(1)
+    assert engine.task is None
+
+
+def test_volume_ramp_is_preempted_and_continues_from_the_current_volume():
+    backend = RecordingAudioBackend(0.2, {"AIMP.exe": 1.0})
+    engine = VolumeRampEngine(backend, tickInterval=0.01)
+    finished = []
+
+    rising = engine.start({SYSTEM_VOLUME: [0.2, 1.0], applicationVolume("AIMP.exe"): [1.0, 0.5]}, duration=10)
+    rising.onFinished(finished.append)
+    time.sleep(0.2)
+    falling = engine.start({applicationVolume("AIMP.exe"): [0.5, 1.0], SYSTEM_VOLUME: [1.0, 0.2]}, duration=0.2)
+    assert falling.wait(5)
+
+    assert finished == [rising]
+    assert rising.preempted and not falling.preempted
+    assert (backend.systemVolume, backend.applications["AIMP.exe"]) == approx((0.2, 1.0))
+
+    # The falling ramp starts from where the rising ramp stopped, not from 1.0
+    firstFalling = next(batch for batch in backend.batches if batch[0][0] == "setApplicationVolume")
+    assert firstFalling[1][1] < 0.5
+
+
+def test_volume_ramp_requiring_a_missing_application_is_skipped():
+    backend = RecordingAudioBackend(0.2)
+    engine = VolumeRampEngine(backend, tickInterval=0.01)
+    ramp = engine.start({SYSTEM_VOLUME: [0.2, 1.0], applicationVolume("AIMP.exe"): [1.0, 0.5]}, requireApplication=True)
+    assert ramp.wait(5)
+    assert ramp.skipped
+    assert backend.batches == [] and backend.systemVolume == 0.2
+
+
+def test_volume_ramp_is_skipped_when_the_audio_lane_refuses_it():
+    executor = LaneExecutor({"audio": 1}, metrics=Metrics())
+    assert executor.shutdown(5)
+    engine = VolumeRampEngine(RecordingAudioBackend(0.2), tickInterval=0.01, executor=executor)
+    ramp = engine.start({SYSTEM_VOLUME: [0.2, 1.0]})
+    assert ramp.wait(0) and ramp.skipped
+    assert engine.owners == {} and engine.starting == [] and engine.task is None
+
+
+def test_volume_ramp_taking_over_a_moved_volume_is_not_skipped():
+    backend = RecordingAudioBackend(0.2, {"AIMP.exe": 1.0})
+    engine = VolumeRampEngine(backend, tickInterval=0.01)
+    curves = {SYSTEM_VOLUME: [0.2, 1.0], applicationVolume("AIMP.exe"): [1.0, 0.5]}
+    rising = engine.start(curves, duration=10, requireApplication=True)
+    time.sleep(0.2)
+
+    # The application was closed, but the volume it raised still has to come back
+    backend.applications.clear()
+    falling = engine.start({target: curve[::-1] for target, curve in curves.items()}, duration=0.2, requireApplication=True)
+    assert falling.wait(5)
+    assert rising.preempted and not falling.skipped
+    assert backend.systemVolume == approx(0.2)
+
+
+def test_crossfade_moves_all_the_applications_on_each_batch():
+    backend = RecordingAudioBackend(0.2, {"AIMP.exe": 1.0, "chrome.exe": 0.8})
+    engine = VolumeRampEngine(backend, tickInterval=0.01)
+    applications = {"AIMP.exe": 0.3, "chrome.exe": 0, "missing.exe": 0.3}
+
+    assert crossfade(0.2, 0.5, applications, engine=engine).wait(5)
+    assert backend.systemVolume == approx(0.7)
+    assert backend.applications == approx({
+            "AIMP.exe": volumeConversion(0.2, 0.5, 0.3)[-1][1] / 100, "chrome.exe": volumeConversion(0.2, 0.5, 0)[-1][1] / 100})
+    assert all(len(batch) == 4 and batch[0][0] == "setSystemVolume" for batch in backend.batches)
+
+    # Restoring raises the applications before lowering the system volume
+    del backend.batches[:]
+    assert crossfade(0.2, 0.5, applications, reverse=True, engine=engine).wait(5)
+    assert backend.systemVolume == approx(0.2)
+    assert backend.applications == approx({"AIMP.exe": 1.0, "chrome.exe": 1.0})
+    assert all(batch[-1][0] == "setSystemVolume" for batch in backend.batches)
+
+    del backend.batches[:]
+    ramp = crossfade(0.2, 0.5, {"missing.exe": 0.3}, engine=engine)
+    assert ramp.wait(5) and ramp.skipped
+    assert backend.batches == []
+
+    # A saved volume is restored even when its applications were closed meanwhile
+    assert crossfade(0.2, 0.5, applications, engine=engine).wait(5)
+    backend.applications.clear()
+    ramp = crossfade(0.2, 0.5, applications, reverse=True, engine=engine, requireApplication=False)
+    assert ramp.wait(5) and not ramp.skipped
+    assert backend.systemVolume == approx(0.2)
+
+
+def test_get_crossfade():
+    assert getCrossfade() == Crossfade(0.5, {"AIMP.exe": 0.3})
+    try:
+        g_configuration[0] = {"crossfade": {"increase": 0.25, "applications": {"AIMP.exe": 0.3, "chrome.exe": 0}}}
+        assert getCrossfade() == Crossfade(0.25, {"AIMP.exe": 0.3, "chrome.exe": 0})
+        g_configuration[0] = {"crossfade": {"applications": {"chrome.exe": 2}}}
+        assert getCrossfade() == Crossfade(0.5, {"AIMP.exe": 0.3})
+    finally:
+        g_configuration[0] = {}
+
+
+def test_lane_executor_limits_each_lane():
+    metrics = Metrics()
+    executor = LaneExecutor({"audio": 1, "io": 2}, maxQueued=3, metrics=metrics)
+    release = threading.Event()
+    running = collections.Counter()
+    peaks = collections.Counter()
+    lock = threading.Lock()
+
+    def work(lane, name):
+        with lock:
+            running[lane] += 1
+            peaks[lane] = max(peaks[lane], running[lane])
+        release.wait(5)
+        with lock:
+            running[lane] -= 1
+        return name
+
+    tasks = [executor.submit("audio", work, "audio", 0)]
+    while not running["audio"]:
+        time.sleep(0.01)
+    tasks += [executor.submit("audio", work, "audio", index) for index in range(1, 4)]
+    tasks += [executor.submit("io", work, "io", index) for index in range(2)]
+    while running["io"] < 2:
+        time.sleep(0.01)
+    tasks += [executor.submit("io", work, "io", index) for index in range(2, 4)]
+    # The first audio task is running, so 3 are waiting and the next one is refused
+    with pytest.raises(queue.Full):
+        executor.submit("audio", work, "audio", 4)
+
+    tasks[3].cancel()
+    release.set()
+    assert executor.drain(5)
+    assert peaks == {"audio": 1, "io": 2}
+    assert [task.result for task in tasks] == [0, 1, 2, None, 0, 1, 2, 3]
+
+    snapshot = metrics.snapshot()
+    assert snapshot["counters"] == {"executor.audio.rejected": 1, "executor.audio.cancelled": 1}
+    assert snapshot["gauges"]["executor.audio.queued.max"] == 3
+    assert snapshot["histograms"]["executor.io.duration"]["count"] == 4
+
+
+def test_lane_executor_shutdown_finishes_the_pending_tasks():
+    executor = LaneExecutor({"audio": 1}, metrics=Metrics())
+    started = threading.Event()
+    finished = []
+    executor.submit("audio", lambda: (started.set(), time.sleep(0.05), finished.append(0)))
+    started.wait(5)
+    for index in range(1, 3):
+        executor.submit("audio", lambda index: (time.sleep(0.05), finished.append(index)), index)
+    executor.submit("audio", finished.append, "restore", priority=-1)
+
+    assert executor.shutdown(5)
+    assert finished == [0, "restore", 1, 2]
+    with pytest.raises(RuntimeError):
+        executor.submit("audio", finished.append, 3)
+
+
+class CountingAudioBackend(FakeAudioBackend):
+    def __init__(self, *args, **kwargs):
+        super(CountingAudioBackend, self).__init__(*args, **kwargs)
+        self.reads = 0
+
+    def getSystemVolume(self):
+        self.reads += 1
+        return super(CountingAudioBackend, self).getSystemVolume()
+
+
+def test_volume_state_follows_the_change_notifications():
+    backend = CountingAudioBackend(0.3)
+    executor = LaneExecutor({"io": 1}, metrics=Metrics())
+    state = VolumeState(backend, executor)
+    assert state.systemVolume is None
+
+    state.start()
+    assert executor.drain(5)
+    assert state.systemVolume == 0.3 and state.notified
+
+    backend.setSystemVolume(0.7)
+    assert state.systemVolume == 0.7
+    state.refresh()
+    assert executor.drain(5)
+    assert backend.reads == 1
+
+
+def test_volume_state_refreshes_without_notifications():
+    backend = CountingAudioBackend(0.3, notifications=False)
+    executor = LaneExecutor({"io": 1}, metrics=Metrics())
+    state = VolumeState(backend, executor)
+
+    state.start()
+    assert executor.drain(5)
+    assert state.systemVolume == 0.3 and not state.notified
+
+    # Nothing polls it, it is only read again before the volume is saved
+    backend.setSystemVolume(0.7)
+    assert state.systemVolume == 0.3 and backend.reads == 1
+    state.refresh()
+    assert executor.drain(5)
+    assert state.systemVolume == 0.7 and backend.reads == 2
+
+
+def test_volume_curves_match_volume_conversion():
+    parameters = [(0.01, 0.99, 0), (0.1, 0.5, 0.3), (0.8, -0.9, 0), (0.2, 0.8, 0.1), (0.5, 0.8, 0.3), (0.3, 0, 0.2)]
+    assert volumeCurves(parameters) == [tuple(volumeConversion(*arguments)) for arguments in parameters]
+
+    # The whole 0-100 range, more curves than the cache holds, each computed without it
+    parameters = [(default / 100, increase / 100, factor / 10)
+            for default in range(0, 101) for increase in range(-100, 101, 20) for factor in range(4)]
+    curves = volumeCurves(parameters + parameters[:10])
+    assert curves[:len(parameters)] == [volumeCurve.__wrapped__(*arguments) for arguments in parameters]
+    assert all(curves[len(parameters) + index] is curves[index] for index in range(10))
+
+
+def test_volume_conversion_benchmark():
+    parameters = [(default / 100, increase / 100, factor / 10)
+            for default in range(0, 101, 5) for increase in range(-50, 51, 25) for factor in range(4)]
+
+    start = time.perf_counter()
+    for arguments in parameters:
+        volumeCurve.__wrapped__(*arguments)
+    loop = time.perf_counter() - start
+
+    [volumeConversion(*arguments) for arguments in parameters]
+    start = time.perf_counter()
+    for arguments in parameters:
+        volumeConversion(*arguments)
+    cached = time.perf_counter() - start
+
+    assert cached < loop, f"{len(parameters)} curves, loop {loop:.6f}s, cached {cached:.6f}s"
+
+
+def test_volume_convertion_from01to99():
+    assert volumeConversion(0.01, 0.99, 0) == [
+        (1.0, 100.0),
+        (6.0, 16.66),
+        (11.0, 9.09),
+        (16.0, 6.25),
+        (21.0, 4.76),
+        (26.0, 3.84),
+        (31.0, 3.22),
+        (36.0, 2.77),
+        (41.0, 2.43),
+        (46.0, 2.17),
+        (51.0, 1.96),
+        (56.0, 1.78),
+        (61.0, 1.63),
+        (66.0, 1.51),
+        (71.0, 1.4),
+        (76.0, 1.31),
+        (81.0, 1.23),
+        (86.0, 1.16),
+        (91.0, 1.09),
+        (96.0, 1.04),
+    ]
+
+
+def test_volume_convertion_from10to60_factor03():
+    assert volumeConversion(0.1, 0.5, 0.3) == [
+        (10.0, 100.0),
+        (15.0, 53.9),
+        (20.0, 34.07),
+        (25.0, 23.36),
+        (30.0, 16.75),
+        (35.0, 12.3),
+        (40.0, 9.1),
+        (45.0, 6.69),
+        (50.0, 4.83),
+        (55.0, 3.34),
+        (60.0, 2.12),
+    ]
+
+
+def test_volume_convertion_from01to99_factor03():
+    assert volumeConversion(0.01, 0.99, 0.3) == [
+        (1.0, 100.0),
+        (6.0, 2.12),
+        (11.0, 0),
+        (16.0, 0),
+        (21.0, 0),
+        (26.0, 0),
+        (31.0, 0),
+        (36.0, 0),
+        (41.0, 0),
+        (46.0, 0),
+        (51.0, 0),
+        (56.0, 0),
+        (61.0, 0),
+        (66.0, 0),
+        (71.0, 0),
+        (76.0, 0),
+        (81.0, 0),
+        (86.0, 0),
+        (91.0, 0),
+        (96.0, 0),
+    ]
+
+
+def test_volume_convertion_invalid_increase():
+    assert volumeConversion(0.2, 0.9, 0) == [
+        (20.0, 100.0),
+        (25.0, 80.0),
+        (30.0, 66.66),
+        (35.0, 57.14),
+        (40.0, 50.0),
+        (45.0, 44.44),
+        (50.0, 40.0),
+        (55.0, 36.36),
+        (60.0, 33.33),
+        (65.0, 30.76),
+        (70.0, 28.57),
+        (75.0, 26.66),
+        (80.0, 25.0),
+        (85.0, 23.52),
+        (90.0, 22.22),
+        (95.0, 21.05),
+        (100.0, 20.0),
+    ]
+
+
+def test_volume_convertion_invalid_decrease():
+    assert volumeConversion(0.8, -0.9, 0) == [
+        (80.0, 100.0),
+        (75.0, 100),
+        (70.0, 100),
+        (65.0, 100),
+        (60.0, 100),
+        (55.0, 100),
+        (50.0, 100),
+        (45.0, 100),
+        (40.0, 100),
+        (35.0, 100),
+        (30.0, 100),
+        (25.0, 100),
+        (20.0, 100),
+        (15.0, 100),
+        (10.0, 100),
+        (5.0, 100),
+        (0, 100)
+    ]
+
+
+def test_volume_convertion_from20_to80():
+    assert volumeConversion(0.2, 0.8, 0) == [
+        (20.0, 100.0),
+        (25.0, 80.0),
+        (30.0, 66.66),
+        (35.0, 57.14),
+        (40.0, 50.0),
+        (45.0, 44.44),
+        (50.0, 40.0),
+        (55.0, 36.36),
+        (60.0, 33.33),
+        (65.0, 30.76),
+        (70.0, 28.57),
+        (75.0, 26.66),
+        (80.0, 25.0),
+        (85.0, 23.52),
+        (90.0, 22.22),
+        (95.0, 21.05),
+        (100.0, 20.0),
+    ]
+
+
+def test_volume_convertion_from20_factor01():
+    assert volumeConversion(0.2, 0.8, 0.1) == [
+        (20.0, 100.0),
+        (25.0, 67.42),
+        (30.0, 47.23),
+        (35.0, 33.7),
+        (40.0, 24.07),
+        (45.0, 16.89),
+        (50.0, 11.36),
+        (55.0, 6.98),
+        (60.0, 3.42),
+        (65.0, 0.48),
+        (70.0, 0),
+        (75.0, 0),
+        (80.0, 0),
+        (85.0, 0),
+        (90.0, 0),
+        (95.0, 0),
+        (100.0, 0),
+    ]
+
+
+def test_volume_convertion_from20_factor02():
+    assert volumeConversion(0.2, 0.8, 0.2) == [
+        (20.0, 100.0),
+        (25.0, 69.42),
+        (30.0, 50.56),
+        (35.0, 37.98),
+        (40.0, 29.07),
+        (45.0, 22.45),
+        (50.0, 17.36),
+        (55.0, 13.34),
+        (60.0, 10.09),
+        (65.0, 7.4),
+        (70.0, 5.15),
+        (75.0, 3.24),
+        (80.0, 1.6),
+        (85.0, 0.17),
+        (90.0, 0),
+        (95.0, 0),
+        (100.0, 0),
+    ]
+
+
+def test_volume_convertion_from20_factor03():
+    assert volumeConversion(0.2, 0.8, 0.3) == [
+        (20.0, 100.0),
+        (25.0, 71.42),
+        (30.0, 53.9),
+        (35.0, 42.27),
+        (40.0, 34.07),
+        (45.0, 28.01),
+        (50.0, 23.36),
+        (55.0, 19.71),
+        (60.0, 16.75),
+        (65.0, 14.33),
+        (70.0, 12.3),
+        (75.0, 10.57),
+        (80.0, 9.1),
+        (85.0, 7.82),
+        (90.0, 6.69),
+        (95.0, 5.71),
+        (100.0, 4.83),
+    ]
+
+
+def test_volume_convertion_from50_factor03():
+    assert volumeConversion(0.5, 0.8, 0.3) == [
+        (50.0, 100.0),
+        (55.0, 86.76),
+        (60.0, 76.02),
+        (65.0, 67.26),
+        (70.0, 59.99),
+        (75.0, 53.9),
+        (80.0, 48.71),
+        (85.0, 44.26),
+        (90.0, 40.41),
+        (95.0, 37.03),
+        (100.0, 34.07),
+    ]
+
+
+def test_volume_convertion_from80_factor03():
+    assert volumeConversion(0.8, 0.8, 0.3) == [
+        (80.0, 100.0),
+        (85.0, 91.42),
+        (90.0, 83.86),
+        (95.0, 77.24),
+        (100.0, 71.42),
+    ]
+
+
+@pytest.mark.skip(reason="Comment this to plot the graphs")
+def test_volume_convertion_plot_graphs():
+    numbers = volumeConversion(0.2, 0.8, 0.1)
+    numbers2 = volumeConversion(0.2, 0.8, 0.2)
+    numbers3 = volumeConversion(0.2, 0.8, 0.0)
+
+    print(f'\n{numbers}\n{numbers2}\n{numbers3}')
+
+    #  Cannot mix incompatible Qt library (version 0x50907) with this library
+    runpython(f"""
+import matplotlib.pyplot as pyplot
+numbers = {numbers}
+numbers2 = {numbers2}
+numbers3 = {numbers3}
+x = [item[0] for item in numbers]
+y = [item[1] for item in numbers]
+x2 = [item[0] for item in numbers2]
+y2 = [item[1] for item in numbers2]
+x3 = [item[0] for item in numbers3]
+y3 = [item[1] for item in numbers3]
+pyplot.plot(x, y)
+pyplot.plot(x2, y2)
+pyplot.plot(x3, y3)
+pyplot.xlabel('x - axis')
+pyplot.ylabel('y - axis')
+pyplot.title('My first graph!')
+pyplot.show()
+""" )
+
+
+@pytest.fixture
+def qapplication():
+    os.environ.setdefault( "QT_QPA_PLATFORM", "offscreen" )
+    return QApplication.instance() or QApplication( [] )
+
+
+class ManualClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_timer_service_runs_due_callbacks_in_order():
+    clock = ManualClock()
+    service = TimerService( clock )
+    calls = []
+    service.schedule( 3, calls.append, "third" )
+    service.schedule( 1, calls.append, "first" )
+    second = service.schedule( 2, calls.append, "second" )
+    cancelled = service.schedule( 1.5, calls.append, "cancelled" )
+    cancelled.cancel()
+
+    assert service.runDue() == 1001
+    clock.now += 2
+    assert service.runDue() == 1003
+    assert calls == ["first", "second"]
+    assert not second.active
+
+    second.reschedule( 5 )
+    clock.now += 10
+    assert service.runDue() is None
+    assert calls == ["first", "second", "third", "second"]
+
+
+def test_timer_service_reschedule_moves_the_deadline():
+    clock = ManualClock()
+    service = TimerService( clock )
+    calls = []
+    handle = service.schedule( 10, calls.append, "fired" )
+    for index in range(1000):
+        clock.now += 1
+        handle.reschedule( 10 )
+
+    assert service.pending() == 1
+    assert len( service.heap ) < 1000
+    clock.now += 9
+    service.runDue()
+    assert calls == []
+    clock.now += 1
+    service.runDue()
+    assert calls == ["fired"]
+
+
+def test_qt_timer_service_driver_runs_callbacks_on_the_gui_thread(qapplication):
+    service = TimerService()
+    driver = QtTimerServiceDriver( service )
+    loop = QtCore.QEventLoop()
+    threads = []
+
+    def callback():
+        threads.append( threading.current_thread() )
+        loop.quit()
+
+    thread = threading.Thread( target=service.schedule, args=(0.01, callback) )
+    thread.start()
+    QTimer.singleShot( 5000, loop.quit )
+    loop.exec_()
+    driver.deleteLater()
+    assert threads == [threading.main_thread()]
+
+
+def test_gui_dispatcher_coalesces_the_pending_posts(qapplication):
+    metrics = Metrics()
+    dispatcher = GuiDispatcher( metrics )
+    calls = []
+
+    def post(index):
+        dispatcher.post( "tray", lambda: calls.append( ( "tray", index, threading.current_thread() ) ) )
+        dispatcher.post( None, lambda: calls.append( ( "log", index, threading.current_thread() ) ) )
+
+    # The GUI thread is stalled while the other threads post
+    threads = [threading.Thread( target=post, args=(index,) ) for index in range( 10 )]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert metrics.snapshot()["gauges"] == {"gui.queueDepth": 11, "gui.queueDepth.max": 11}
+    assert metrics.snapshot()["counters"] == {"gui.coalesced": 9}
+
+    loop = QtCore.QEventLoop()
+    dispatcher.post( "quit", loop.quit )
+    QTimer.singleShot( 5000, loop.quit )
+    loop.exec_()
+
+    assert [call[0] for call in calls].count( "tray" ) == 1
+    assert [call[0] for call in calls].count( "log" ) == 10
+    assert {call[2] for call in calls} == {threading.main_thread()}
+    assert metrics.snapshot()["gauges"]["gui.queueDepth"] == 0
+    assert metrics.snapshot()["histograms"]["gui.dispatchLatency"]["count"] == 12
+
+
+def test_timer_service_callbacks_can_schedule():
+    clock = ManualClock()
+    service = TimerService( clock )
+    calls = []
+
+    def callback(count):
+        calls.append( count )
+        if count < 3:
+            service.schedule( 0, callback, count + 1 )
+
+    service.schedule( 1, callback, 1 )
+    clock.now += 1
+    assert service.runDue() is None
+    assert calls == [1, 2, 3]
+
+
+def test_next_tray_boundary_every_minute():
+    timestamp = datetime.datetime(2020, 5, 7, 8, 30, 15, 500).timestamp()
+    assert nextTrayBoundary( timestamp, 60 ) == datetime.datetime(2020, 5, 7, 8, 31).timestamp()
+    assert nextTrayBoundary( timestamp, 1 ) == datetime.datetime(2020, 5, 7, 8, 30, 16).timestamp()
+
+
+def test_next_tray_boundary_is_midnight():
+    timestamp = datetime.datetime(2020, 5, 7, 23, 59, 0).timestamp()
+    assert nextTrayBoundary( timestamp, 3600 ) == datetime.datetime(2020, 5, 8).timestamp()
+
+
+def test_tooltip_resolution_is_at_least_one_second():
+    assert g_argumentParser.parse_args( ["--tooltip-resolution", "1"] ).tooltip_resolution == 1
+    for value in ( "0", "-60" ):
+        with pytest.raises(SystemExit):
+            g_argumentParser.parse_args( ["--tooltip-resolution", value] )
+
+
+@pytest.mark.skipif(not hasattr(time, "tzset"), reason="Requires time.tzset()")
+def test_next_tray_boundary_daylight_saving_time_change():
+    timezone = os.environ.get( "TZ" )
+    os.environ["TZ"] = "Europe/Berlin"
+    time.tzset()
+    try:
+        # 2020-03-29 02:00 CET becomes 03:00 CEST
+        timestamp = datetime.datetime(2020, 3, 29, 1, 30).timestamp()
+        assert nextTrayBoundary( timestamp, 86400 ) == datetime.datetime(2020, 3, 29, 3, 0).timestamp()
+    finally:
+        if timezone is None:
+            del os.environ["TZ"]
+        else:
+            os.environ["TZ"] = timezone
+        time.tzset()
+
+
+@pytest.fixture
+def main_window_and_tray(qapplication):
+    mainWin, mainTray = createMainWindowAndTray( tooltipResolution=1 )
+    yield mainWin, mainTray
+    mainTray.hide()
+
+
+def test_tray_icon_is_only_rendered_when_the_day_changes(main_window_and_tray):
+    mainWin, mainTray = main_window_and_tray
+    morning = datetime.datetime(2020, 5, 7, 8, 0, 0)
+    mainTray.setTrayText( morning )
+    renders = mainTray.trayIconRenders
+    updates = mainTray.trayIconUpdates
+
+    for second in range(3600):
+        mainTray.setTrayText( morning + datetime.timedelta(seconds=second) )
+        assert mainTray.toolTip() == str( morning + datetime.timedelta(seconds=second) )
+
+    assert (mainTray.trayIconRenders, mainTray.trayIconUpdates) == (renders, updates)
+    mainTray.tooltipResolution = 60
+    mainTray.setTrayText( morning + datetime.timedelta(seconds=59) )
+    assert mainTray.toolTip() == "2020-05-07 08:00"
+
+    assert (mainTray.trayIconRenders, mainTray.trayIconUpdates) == (renders, updates)
+
+    mainTray.setTrayText( datetime.datetime(2020, 5, 8, 8, 59, 0) )
+    assert (mainTray.trayIconRenders, mainTray.trayIconUpdates) == (renders + 1, updates + 1)
+    assert mainTray.trayIconKey[0] == "08"
+
+
+def test_histogram_percentiles():
+    histogram = Histogram()
+    for milliseconds in range( 1, 101 ):
+        histogram.record( milliseconds / 1000 )
+
+    snapshot = histogram.snapshot()
+    assert snapshot["count"] == 100
+    assert snapshot["mean"] == approx( 0.0505 )
+    assert ( snapshot["min"], snapshot["max"] ) == ( 0.001, 0.1 )
+    assert 0.05 <= snapshot["p50"] <= 0.1
+    assert snapshot["p99"] == 0.1
+    assert Histogram().snapshot()["p50"] is None
+
+
+def test_timer_service_records_the_lateness():
+    clock = ManualClock()
+    service = TimerService( clock )
+
+    def eyeRestCallback():
+        pass
+
+    # Nothing is recorded until something serves them
+    service.schedule( 10, eyeRestCallback )
+    clock.now += 10.25
+    service.runDue()
+    assert "timer.eyeRestCallback.lateness" not in g_metrics.snapshot()["histograms"]
+
+    g_metrics.enabled = True
+    try:
+        service.schedule( 10, eyeRestCallback )
+        clock.now += 10.25
+        service.runDue()
+    finally:
+        g_metrics.enabled = False
+    histogram = g_metrics.snapshot()["histograms"]["timer.eyeRestCallback.lateness"]
+    assert histogram["max"] == approx( 0.25 )
+
+
+def test_metrics_endpoint():
+    metrics = Metrics()
+    metrics.count( "speech.cacheMisses" )
+    with metrics.timed( "runpython" ):
+        pass
+
+    server = serveMetrics( 0, metrics )
+    try:
+        snapshot = fetchMetrics( server.server_address[1] )
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert snapshot["counters"] == {"speech.cacheMisses": 1}
+    assert snapshot["histograms"]["runpython"]["count"] == 1
+
+
+def test_instrumentation_summary_and_idle_budget():
+    clock = ManualClock()
+    cpuClock = ManualClock()
+    instrumentation = Instrumentation( idleWakeupBudget=2, clock=clock, cpuClock=cpuClock )
+
+    for index in range( 3 ):
+        with instrumentation.wakeup( "tray" ):
+            cpuClock.now += 0.001
+    instrumentation.count( "speech", "threads" )
+    clock.now += 60
+
+    summary = instrumentation.report()
+    assert summary["components"]["tray"] == {"wakeups": 3, "cpuTime": approx( 0.003 )}
+    assert summary["components"]["speech"] == {"threads": 1}
+    assert summary["wakeupsPerMinute"] == approx( 3 )
+    assert not summary["idle"]
+
+    with instrumentation.wakeup( "tray" ):
+        pass
+    clock.now += 30
+    summary = instrumentation.summary()
+    assert summary["idle"]
+    assert summary["wakeupsPerMinute"] == approx( 2 )
+    assert instrumentation.summary()["components"] == {}
+
+
+def busyLoop(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+def test_profiler_measures_the_callbacks_and_samples_the_stacks(tmp_path):
+    profiler = Profiler( tmp_path / "TimeTray.profile", interval=0.001 )
+    timerService = TimerService()
+    profiler.start()
+    g_profiler[0] = profiler
+    try:
+        for index in range( 3 ):
+            timerService.schedule( 0, busyLoop, 0.02 )
+        timerService.runDue()
+        profiled( busyLoop )( 0.01 )
+    finally:
+        g_profiler[0] = None
+        profiler.stop()
+
+    calls, wall, cpu, maximum = profiler.callbacks["timer.busyLoop"]
+    assert calls == 3 and wall >= 0.06 and maximum >= 0.02
+    assert profiler.callbacks["busyLoop"][0] == 1
+
+    report, folded = profiler.write()
+    assert report.read_text().splitlines()[2].endswith( "  timer.busyLoop" )
+    assert any( line.rsplit( " ", 1 )[0].endswith( "test_TimeTray.py:busyLoop" ) for line in folded.read_text().splitlines() )
+
+
+def test_deterministic_profiler_stacks(tmp_path):
+    profiler = Profiler( tmp_path / "TimeTray.profile", deterministic=True )
+    profiler.start()
+    busyLoop( 0.01 )
+    profiler.stop()
+
+    stacks = profiler.foldedStacks()
+    assert any( line.startswith( "test_TimeTray.py:busyLoop " ) for line in stacks )
+    assert any( line.startswith( "test_TimeTray.py:busyLoop;~:<built-in method time.perf_counter> " ) for line in stacks )
+
+
+@pytest.mark.skipif(not hasattr( signal, "SIGUSR1" ), reason="requires SIGUSR1")
+def test_signals_run_while_the_event_loop_waits(qapplication):
+    loop = QtCore.QEventLoop()
+    received = []
+
+    def handler(number, frame):
+        received.append( number )
+        loop.quit()
+
+    previous = signal.signal( signal.SIGUSR1, handler )
+    wakeOnSignals()
+    try:
+        threading.Timer( 0.1, os.kill, (os.getpid(), signal.SIGUSR1) ).start()
+        QTimer.singleShot( 5000, loop.quit )
+        start = time.perf_counter()
+        loop.exec_()
+        assert received == [signal.SIGUSR1]
+        assert time.perf_counter() - start < 2
+    finally:
+        signal.signal( signal.SIGUSR1, previous )
+        signal.set_wakeup_fd( -1 )
+        reader, writer, notifier = TimeTray.g_signalWakeup[0]
+        TimeTray.g_signalWakeup[0] = None
+        notifier.setEnabled( False )
+        reader.close()
+        writer.close()
+
+
+def test_profiling_application_event_names():
+    assert ProfilingApplication.eventNames[QtCore.QEvent.Timer] == "Timer"
+    assert ProfilingApplication.eventNames[QtCore.QEvent.KeyPress] == "KeyPress"
+
+
+def test_soak_runs_the_window_for_days_without_growing(qapplication):
+    appends = collections.Counter()
+
+    class CountingHistory(EyeRestHistory):
+        def append(self, kind, seconds=0.0):
+            appends[kind] += 1
+            return super(CountingHistory, self).append( kind, seconds )
+
+    soak = SoakTest()
+    original = TimeTray.EyeRestHistory
+    TimeTray.EyeRestHistory = CountingHistory
+    try:
+        samples = soak.run( 2 )
+    finally:
+        TimeTray.EyeRestHistory = original
+
+    assert len( samples ) == 2 * 24 + 1
+    assert not soak.directory.exists()
+    assert appends["start"] == 1 and appends["reset"] > 90
+    assert soak.leaks() == {}
+
+
+def test_soak_leaks():
+    soak = SoakTest()
+    soak.samples = [SoakSample( hour * 3600, None, 1000, 100 + hour % 2, 3, 7 + hour, 5 ) for hour in range( 12 )]
+    assert soak.leaks() == {"fileDescriptors": ( 14, 18 )}
+
+
+def simulatedEyeRest(responseDelay=5):
+    clock = VirtualClock()
+    timerService = TimerService( clock )
+    return clock, timerService, SimulatedEyeRestWindow( timerService, responseDelay )
+
+
+def test_eye_rest_counter_only_ticks_while_counting_and_visible():
+    clock, timerService, window = simulatedEyeRest( responseDelay=None )
+    cycle = window.cycle
+    assert timerService.pending() == 0
+
+    cycle.start()
+    assert cycle.tickTimer is None
+
+    window.showUp()
+    clock.advance( 2.5, timerService )
+    assert cycle.tickTimer.active
+    assert window.counterValue == 2
+
+    window.visible = False
+    clock.advance( 30, timerService )
+    assert not cycle.tickTimer.active
+    assert window.counterValue == 3
+
+    cycle.pause()
+    assert window.counterValue == 32
+    window.visible = True
+    cycle.windowShown()
+    assert not cycle.tickTimer.active
+
+    cycle.start()
+    cycle.reset()
+    assert cycle.tickTimer.active
+    cycle.pause()
+    assert not cycle.tickTimer.active
+
+
+def test_eye_rest_cycle_steps():
+    events = simulateEyeRest( 120 )
+    assert events == [
+        (0, "close"),
+        (1, "saveVolume"),
+        (10, "speak 10 seconds"),
+        (20, "speak 20 seconds"),
+        (30, "speak 30 seconds"),
+        (40, "playCue alarm"),
+        (46, "restoreVolume"),
+    ]
+
+
+def test_eye_rest_cycle_runs_the_next_cues_after_a_failing_one():
+    clock, timerService, window = simulatedEyeRest()
+
+    def playCue(name):
+        raise KeyError( name )
+
+    window.playCue = playCue
+    window.cycle.start()
+    window.close()
+    clock.advance( 4 * 3600, timerService )
+
+    restores = [seconds for seconds, event in window.events if event == "restoreVolume"]
+    shows = [seconds for seconds, event in window.events if event == "show"]
+    assert restores[0] == 46
+    assert len( shows ) > 5 and len( restores ) == len( shows ) + 1
+
+
+def test_eye_rest_cycle_runs_a_configured_routine():
+    routine = parseRoutine( [
+        {"at": 2.25, "do": "speak", "text": "look away"},
+        {"at": 0.5, "do": "playCue", "name": "chime"},
+        {"at": 3, "do": "nextLoop"},
+    ] )
+    assert [cue.offset for cue in routine] == [0.5, 2.25, 3]
+
+    clock, timerService, window = simulatedEyeRest()
+    window.cycle.routine = routine
+    window.cycle.start()
+    clock.advance( 3, timerService )
+    assert window.events == [(0.5, "playCue chime"), (2.25, "speak look away")]
+    assert window.cycle.eyeRestTimer.deadline == 3 + SHOW_WINDOW_INTERVAL
+
+    # Pausing holds the next cue until the cycle starts again
+    window.cycle.reset()
+    clock.advance( 1, timerService )
+    window.cycle.pause()
+    clock.advance( 10, timerService )
+    window.cycle.start()
+    clock.advance( 1.25, timerService )
+    assert window.events[2:] == [(3.5, "playCue chime"), (15.25, "speak look away")]
+
+    with pytest.raises( ValueError ):
+        parseRoutine( [{"at": 1, "do": "shutdown"}] )
+    with pytest.raises( ValueError ):
+        parseRoutine( [{"at": 1, "do": "speak"}] )
+
+
+def test_get_routine_from_the_configuration():
+    try:
+        g_configuration[0] = {"routine": [{"at": 5, "do": "restoreVolume"}]}
+        assert getRoutine() == ( Cue( 5.0, "restoreVolume", None ), )
+
+        g_configuration[0] = {"routine": [{"at": 5, "do": "unknown"}]}
+        assert getRoutine() == parseRoutine( EyeRestCycle.defaultRoutine )
+    finally:
+        g_configuration[0] = {}
+
+
+def test_eye_rest_cycle_simulates_a_day():
+    start = time.perf_counter()
+    events = simulateEyeRest( 86400 )
+    assert time.perf_counter() - start < 1
+
+    shows = [seconds for seconds, event in events if event == "show"]
+    alarms = [seconds for seconds, event in events if event == "playCue alarm"]
+    assert 45 <= len( shows ) <= 50
+    assert len( alarms ) == len( shows ) + 1
+
+    # The window comes back SHOW_WINDOW_INTERVAL after each last eye rest step
+    first = 56 + SHOW_WINDOW_INTERVAL
+    assert shows[0] == first
+    assert shows[1] - shows[0] == 5 + first
+
+
+@pytest.fixture(autouse=True)
+def history_in_tmp_path(tmp_path):
+    g_history[0] = EyeRestHistory( tmp_path / "TimeTray.history" )
+    yield g_history[0]
+    g_history[0].close()
+    g_history[0] = None
+
+
+def test_eye_rest_history_rollups(tmp_path):
+    clock = ManualClock()
+    clock.now = datetime.datetime( 2020, 5, 10, 12 ).timestamp()
+    history = EyeRestHistory( tmp_path / "history", clock )
+    history.append( "start" )
+    history.append( "completion", 56 )
+    clock.now += 86400
+    history.append( "completion", 50 )
+    history.append( "dismissal", 1800 )
+    assert history.daily() == {
+        "2020-05-10": {"start": 1, "completion": 1, "restSeconds": 56},
+        "2020-05-11": {"completion": 1, "restSeconds": 50, "dismissal": 1},
+    }
+    assert history.weekly() == {
+        "2020-W19": {"start": 1, "completion": 1, "restSeconds": 56},
+        "2020-W20": {"completion": 1, "restSeconds": 50, "dismissal": 1},
+    }
+    assert list( history.lastDays( 1 ) ) == ["2020-05-11"]
+    assert list( history.lastDays( 2 ) ) == ["2020-05-10", "2020-05-11"]
+    clock.now += 86400
+    assert list( history.lastDays( 2 ) ) == ["2020-05-11"]
+    clock.now -= 86400
+    assert (tmp_path / "history").stat().st_size == 4 * history.record.size
+    assert history.read( 1, 2 ) == [(datetime.datetime( 2020, 5, 10, 12 ).timestamp(), 3, 56.0)]
+    history.close()
+
+    # Only the records after the saved rollups are read, and a partial record is dropped
+    with open( tmp_path / "history", "ab" ) as file:
+        file.write( history.record.pack( clock.now, 2, 5 ) + b"\0\0" )
+    reopened = EyeRestHistory( tmp_path / "history" )
+    assert reopened.daily()["2020-05-11"]["reset"] == 1
+    assert reopened.daily()["2020-05-10"] == history.days["2020-05-10"]
+    assert (tmp_path / "history").stat().st_size == 5 * history.record.size
+
+    # Without the rollups, they are computed from all the records
+    reopened.close()
+    (tmp_path / "history.rollup.json").unlink()
+    assert EyeRestHistory( tmp_path / "history" ).daily() == reopened.daily()
+
+
+def test_eye_rest_history_saves_the_rollups_without_closing(tmp_path):
+    clock = ManualClock()
+    clock.now = datetime.datetime( 2020, 5, 10, 12 ).timestamp()
+    history = EyeRestHistory( tmp_path / "history", clock, saveInterval=3 )
+
+    def savedRecords():
+        return json.loads( (tmp_path / "history.rollup.json").read_text() )["records"]
+
+    # The first record of each day, and every 3 records, save them
+    history.append( "start" )
+    assert savedRecords() == 1
+    history.append( "completion", 56 )
+    history.append( "start" )
+    assert savedRecords() == 1
+    history.append( "completion", 50 )
+    assert savedRecords() == 4
+    clock.now += 86400
+    history.append( "start" )
+    assert savedRecords() == 5
+
+    # Killed without closing, the next run reads no record again
+    reopened = EyeRestHistory( tmp_path / "history" )
+    reopened.load()
+    assert reopened.savedRecords == reopened.records == 5
+    assert reopened.daily() == history.daily()
+    history.close()
+
+
+def test_eye_rest_cycle_history(tmp_path):
+    history = EyeRestHistory( tmp_path / "history" )
+    simulateEyeRest( 3 * 3600, history=history )
+    counters = history.daily()
+    kinds = collections.Counter()
+    for day in counters.values():
+        kinds.update( day )
+    assert kinds["start"] == 1
+    assert kinds["completion"] == kinds["reset"] + 1 == 6
+    assert kinds["restSeconds"] == 6 * 56
+
+    history = EyeRestHistory( tmp_path / "ignored" )
+    clock, timerService, window = simulatedEyeRest( responseDelay=None )
+    window.cycle.history = history
+    window.cycle.start()
+    window.close()
+    clock.advance( 2000, timerService )
+    window.close()
+    assert [history.kinds[kind] for timestamp, kind, value in history.read()][-3:] == ["start", "completion", "dismissal"]
+
+
+def test_eye_rest_cycle_reinforces_an_ignored_window():
+    events = simulateEyeRest( 3600, responseDelay=None )
+    shows = [seconds for seconds, event in events if event == "show"]
+    assert shows[0] == 56 + SHOW_WINDOW_INTERVAL
+    assert [later - earlier for earlier, later in zip( shows, shows[1:] )] == [AUTORESTARTINTERVAL] * ( len( shows ) - 1 )
+    assert len( shows ) == 1 + ( 3600 - shows[0] ) // AUTORESTARTINTERVAL
+
+
+def test_eye_rest_cycle_pause_stops_the_reinforcement():
+    clock, timerService, window = simulatedEyeRest( responseDelay=None )
+    window.cycle.start()
+    window.close()
+    clock.advance( 2000, timerService )
+    assert window.visible
+
+    window.cycle.pause()
+    window.events.clear()
+    clock.advance( 86400, timerService )
+    assert window.events == []
+    assert timerService.pending() == 0
+
+    # Resetting while paused does not start counting, the next start and close schedule the window
+    window.cycle.reset()
+    window.cycle.start()
+    window.close()
+    clock.advance( 1800, timerService )
+    assert [event for seconds, event in window.events].count( "show" ) == 1
+
+
+def test_idle_wakeups(qapplication):
+    mainWin, mainTray = createMainWindowAndTray( 60 )
+    driver = QtTimerServiceDriver( TimerService() )
+    g_instrumentation[0] = Instrumentation()
+    try:
+        loop = QtCore.QEventLoop()
+        QTimer.singleShot( 1500, loop.quit )
+        loop.exec_()
+        summary = g_instrumentation[0].summary()
+    finally:
+        g_instrumentation[0] = None
+        driver.deleteLater()
+        mainTray.hide()
+
+    # Only the tray can wake up, at most once, if a minute started. The log writer only wakes up
+    # for the records, which here are from the previous tests
+    summary["components"].pop( "logWriter", None )
+    assert summary["idle"]
+    assert sum( counters.get( "wakeups", 0 ) for counters in summary["components"].values() ) <= 1
+
+
+def measure(function, repeat, setup=None):
+    """ Returns the seconds each of the `repeat` calls to `function()` took. """
+    durations = []
+    for index in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        function()
+        durations.append( time.perf_counter() - start )
+    return durations
+
+
+def benchmark_volume_conversion():
+    return measure( lambda: volumeCurve.__wrapped__( 0.2, 0.8, 0.3 ), 2000 )
+
+
+def benchmark_volume_conversion_cached():
+    return measure( lambda: volumeConversion( 0.2, 0.8, 0.3 ), 2000 )
+
+
+def benchmark_tray_render_icon():
+    mainWin, mainTray = createMainWindowAndTray( 60 )
+    try:
+        return measure( lambda: mainTray.renderTrayIcon( "07", 1.0 ), 200 )
+    finally:
+        mainTray.hide()
+
+
+def benchmark_tray_set_text():
+    mainWin, mainTray = createMainWindowAndTray( 60 )
+    try:
+        return measure( mainTray.setTrayText, 2000 )
+    finally:
+        mainTray.hide()
+
+
+def benchmark_run_process_spawn():
+    return measure( lambda: run_process( [sys.executable, "-c", "pass"] ), 10 )
+
+
+def benchmark_runpython_spawn():
+    return measure( lambda: runpython( "print(1)" ), 10 )
+
+
+def benchmark_audio_worker_request():
+    worker = AudioWorker( "fake" )
+    try:
+        worker.getSystemVolume()
+        return measure( worker.getSystemVolume, 500 )
+    finally:
+        worker.close()
+
+
+def benchmark_timer_service_jitter():
+    """ How late the `TimerService` callbacks run on the Qt event loop, instead of how long. """
+    service = TimerService()
+    driver = QtTimerServiceDriver( service )
+    loop = QtCore.QEventLoop()
+    lateness = []
+    count = 100
+
+    def callback(deadline):
+        lateness.append( max( service.clock() - deadline, 0 ) )
+        if len( lateness ) == count:
+            loop.quit()
+
+    for index in range( count ):
+        interval = 0.005 + index * 0.003
+        service.schedule( interval, lambda deadline=service.clock() + interval: callback( deadline ) )
+
+    QTimer.singleShot( 10000, loop.quit )
+    loop.exec_()
+    driver.deleteLater()
+    return lateness
+
+
+def benchmark_next_eye_rest_loop():
+    mainWin, mainTray = createMainWindowAndTray( 60 )
+    mainWin.cycle.start()
+    try:
+        return measure( mainWin.cycle.nextLoop, 2000 )
+    finally:
+        if mainWin.cycle.eyeRestTimer:
+            mainWin.cycle.eyeRestTimer.cancel()
+        mainWin.cycle.pause()
+        mainTray.hide()
+
+
+def benchmark_update_time():
+    mainWin, mainTray = createMainWindowAndTray( 60 )
+    mainWin.cycle.start()
+
+    # The next cue, which is also a timer callback
+    def runCue():
+        mainWin.cycle.nextCue = 0
+        mainWin.cycle.runCues()
+
+    mainWin.cycle.routine = parseRoutine( [{"at": 0, "do": "playCue", "name": "alarm"}] * 100 )
+    try:
+        return measure( mainWin.cycle.tick, 1000 ) + measure( runCue, 10 )
+    finally:
+        mainWin.cycle.pause()
+        mainTray.hide()
+
+
+def startTimeTray(*arguments):
+    return subprocess.run( [sys.executable, TimeTray.__file__, "--audio-backend", "fake", "--speech-backend", "silent",
+            "--log-file", str( g_logFile[0] ), *arguments], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True )
+
+
+def benchmark_startup():
+    """ Time to the tray icon, from starting a new python until the main window and tray exist. """
+    return measure( lambda: startTimeTray( "--quit-after-startup" ), 5 )
+
+
+g_benchmarks = {name[len("benchmark_"):]: function for name, function in globals().items() if name.startswith("benchmark_")}
+
+
+def summarizeDurations(durations):
+    ordered = sorted( durations )
+    return {
+        "runs": len( ordered ),
+        "median": ordered[len( ordered ) // 2],
+        "p95": ordered[min( int( len( ordered ) * 0.95 ), len( ordered ) - 1 )],
+        "min": ordered[0],
+        "mean": sum( ordered ) / len( ordered ),
+    }
+
+
+def compareBenchmarks(results, baseline, tolerance=0.5):
+    """ Returns the benchmarks whose median is more than `tolerance` slower than the `baseline`. """
+    regressions = {}
+    for name, result in results.items():
+        if name in baseline and result["median"] > baseline[name]["median"] * ( 1 + tolerance ):
+            regressions[name] = result["median"] / baseline[name]["median"]
+    return regressions
+
+
+def runBenchmarks(names, output, baselineFile, saveBaseline=False):
+    """ Runs the `names` benchmarks, or all of them, writing the results as json to `output`, and
+    compares them with the `baselineFile` results. Returns the regressions found. """
+    os.environ.setdefault( "QT_QPA_PLATFORM", "offscreen" )
+    app = QApplication.instance() or QApplication( [] )
+    setAudioBackend( FakeAudioBackend( applications={"AIMP.exe": 1.0} ) )
+    g_audioCues[0] = AudioCues( createEffect=FakeSoundEffect )
+    g_audioCues[0].configure( {} )
+    g_history[0] = EyeRestHistory( pathlib.Path( tempfile.mkdtemp() ) / "TimeTray.history" )
+
+    results = {}
+    for name in names or g_benchmarks:
+        results[name] = summarizeDurations( g_benchmarks[name]() )
+        # Deletes what the benchmark left to the event loop, which does not run between them
+        app.sendPostedEvents( None, QtCore.QEvent.DeferredDelete )
+
+    report = {
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "time": datetime.datetime.now().isoformat( timespec="seconds" ),
+        "unit": "seconds",
+        "results": results,
+    }
+    pathlib.Path( output ).write_text( json.dumps( report, indent=4 ) + "\n" )
+
+    baseline = {}
+    if os.path.exists( baselineFile ):
+        baseline = json.loads( pathlib.Path( baselineFile ).read_text() )["results"]
+    elif not saveBaseline:
+        print( f"There is no baseline on {baselineFile}, save one on this machine with --benchmark-save-baseline" )
+
+    regressions = compareBenchmarks( results, baseline )
+    for name, result in results.items():
+        reference = baseline.get( name, {} ).get( "median" )
+        change = f"{result['median'] / reference:6.2f}x" if reference else "   new"
+        flag = "  REGRESSION" if name in regressions else ""
+        print( f"{name:32} median {result['median'] * 1000:10.4f} ms  p95 {result['p95'] * 1000:10.4f} ms  {change}{flag}" )
+
+    if saveBaseline:
+        pathlib.Path( baselineFile ).write_text( json.dumps( report, indent=4 ) + "\n" )
+    return regressions
+
+
+def test_compare_benchmarks():
+    baseline = {"fast": {"median": 1.0}, "slow": {"median": 1.0}}
+    results = {"fast": summarizeDurations( [1.2, 1.4, 0.8] ), "slow": summarizeDurations( [1.6, 2.0, 1.9] ), "new": summarizeDurations( [5] )}
+    assert results["fast"] == {"runs": 3, "median": 1.2, "p95": 1.4, "min": 0.8, "mean": approx( 1.1333, abs=1e-3 )}
+    assert compareBenchmarks( results, baseline ) == {"slow": 1.9}
+
+
+def test_run_benchmarks(tmp_path):
+    output = tmp_path / "results.json"
+    baseline = tmp_path / "baseline.json"
+    backend = g_audioBackend[0]
+
+    assert runBenchmarks( ["volume_conversion_cached", "update_time"], output, baseline, saveBaseline=True ) == {}
+    report = json.loads( output.read_text() )
+    assert sorted( report["results"] ) == ["update_time", "volume_conversion_cached"]
+    assert json.loads( baseline.read_text() ) == report
+
+    report["results"]["update_time"]["median"] /= 100
+    baseline.write_text( json.dumps( report ) )
+    assert list( runBenchmarks( ["update_time"], output, baseline ) ) == ["update_time"]
+    g_audioBackend[0] = backend
+
+
+@pytest.fixture
+def instance_address(tmp_path):
+    if sys.platform == "win32":
+        return f"\\\\.\\pipe\\TimeTray-test-{os.getpid()}"
+    return str( tmp_path / "TimeTray.socket" )
+
+
+def runEventsUntil(condition, timeout=5):
+    deadline = time.perf_counter() + timeout
+    while not condition() and time.perf_counter() < deadline:
+        QApplication.processEvents( QtCore.QEventLoop.AllEvents, 50 )
+    return condition()
+
+
+def test_send_instance_command_without_an_instance(instance_address):
+    assert not sendInstanceCommand( "show", instance_address )
+
+
+def test_launch_hands_off_its_command_once(monkeypatch):
+    sent = []
+    monkeypatch.setattr( TimeTray, "sendInstanceCommand", lambda command: sent.append( command ) or False )
+    monkeypatch.setattr( TimeTray, "g_handOff", [None] )
+    assert not TimeTray.handOffCommand( "pause" )
+    assert not TimeTray.handOffCommand( "pause" )
+    assert sent == ["pause"]
+
+
+def test_single_instance_server_runs_the_commands(qapplication, instance_address):
+    commands = []
+    server = SingleInstanceServer( {name: lambda name=name: commands.append( name ) for name in INSTANCE_COMMANDS}, instance_address )
+    assert server.listen()
+    try:
+        assert sendInstanceCommand( "pause", instance_address )
+        assert sendInstanceCommand( "unknown", instance_address )
+        assert sendInstanceCommand( "start", instance_address )
+        # Each launch has its own connection, so they can be read in any order
+        assert runEventsUntil( lambda: len( commands ) == 2 )
+        assert sorted( commands ) == ["pause", "start"]
+
+        # Only one server can listen on the address
+        other = SingleInstanceServer( {}, instance_address )
+        assert not other.listen()
+    finally:
+        server.close()
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Only unix leaves a socket file behind")
+def test_single_instance_server_replaces_a_stale_socket(qapplication, instance_address):
+    pathlib.Path( instance_address ).write_bytes( b"" )
+    server = SingleInstanceServer( {}, instance_address )
+    try:
+        assert server.listen()
+    finally:
+        server.close()
+
+
+def test_second_launch_forwards_its_command_without_qt(qapplication, instance_address):
+    commands = []
+    server = SingleInstanceServer( {"reset": lambda: commands.append( "reset" )}, instance_address )
+    assert server.listen()
+    try:
+        process = subprocess.run( [sys.executable, "-X", "importtime", TimeTray.__file__, "reset"],
+                env={**os.environ, "TIMETRAY_INSTANCE_ADDRESS": instance_address}, capture_output=True, text=True )
+        assert process.returncode == 0, process.stderr
+        assert "PyQt5" not in process.stderr
+        assert runEventsUntil( lambda: commands )
+    finally:
+        server.close()
+
+
+def test_launch_forwards_its_command_before_starting_the_servers(qapplication, instance_address):
+    import socket
+    commands = []
+    server = SingleInstanceServer( {"pause": lambda: commands.append( "pause" )}, instance_address )
+    assert server.listen()
+    with socket.socket() as metrics:
+        metrics.bind( ( "127.0.0.1", 0 ) )
+        metrics.listen()
+        port = metrics.getsockname()[1]
+        try:
+            process = subprocess.run( [sys.executable, TimeTray.__file__, "--stats-port", str( port ), "pause"],
+                    env={**os.environ, "TIMETRAY_INSTANCE_ADDRESS": instance_address}, capture_output=True, text=True, timeout=60 )
+            assert process.returncode == 0, process.stderr
+            assert runEventsUntil( lambda: commands )
+        finally:
+            server.close()
+
+
+def test_startup_does_not_import_the_test_and_audio_machinery():
+    deferred = ["pytest", "asyncio", "comtypes", "pycaw", "debug_tools", "PyQt5.QtMultimedia", "test_TimeTray"]
+    process = subprocess.run( [sys.executable, "-c",
+            f"import sys, TimeTray; print([name for name in {deferred} if name in sys.modules])"],
+            cwd=os.path.dirname( TimeTray.__file__ ), stdout=subprocess.PIPE, check=True, encoding="UTF-8" )
+    assert process.stdout.strip() == "[]"
+
+
+def test_quit_after_startup():
+    startTimeTray( "--quit-after-startup" )